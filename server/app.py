@@ -4,19 +4,249 @@
 import json
 import os
 import sys
-from io import BytesIO
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from io import BytesIO, RawIOBase
+from typing import Iterator
 
-from flask import Flask, request, send_file
+import numpy as np
+from flask import Flask, Response, g, request, send_file, url_for
 from flask_cors import CORS
+from PIL import Image
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from server.pixelator import tile_image
+from server.bom import bill_of_materials, bom_to_csv, bom_to_json
+from server.cache import LRUCache, ResultCache, make_key
+from server.colors import hex_to_rgb, rgb_to_hex
+from server.jobs import JobStore
+from server.metrics import Counter, Gauge, Histogram, Registry
+from server.pixelator import (
+    COLOR_SPACES,
+    DITHERS,
+    MATCHES,
+    MAX_CLUSTERS,
+    MAX_OUTPUT_PIXELS,
+    MAX_TILE_COLORS,
+    QUANTIZERS,
+    PreparedImage,
+    StageTimer,
+    cluster_cache,
+    encode_animation,
+    iter_upscaled_png,
+    record_stage,
+    record_stages,
+    stage_hooks,
+    tile_animation,
+    tile_grid,
+    tile_image,
+    tile_ladder,
+    tile_images,
+    upscale_grid,
+    warm_up,
+)
+from server.workers import PoolFullError, WorkerPool
 
 
 app = Flask(__name__)
 CORS(app)
-UPLOAD_FOLDER = "./uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# Cache of encoded results, keyed on the image bytes and the parameters
+result_cache = ResultCache(
+    max_entries=int(os.environ.get("PIXELATOR_CACHE_ENTRIES", 64)),
+    max_bytes=int(os.environ.get("PIXELATOR_CACHE_BYTES", 256 * 1024**2)),
+    directory=os.environ.get("PIXELATOR_CACHE_DIR"),
+    disk_max_bytes=int(os.environ.get("PIXELATOR_CACHE_DISK_BYTES", 1024**3)),
+    ttl=(
+        float(os.environ["PIXELATOR_CACHE_TTL"])
+        if "PIXELATOR_CACHE_TTL" in os.environ
+        else None
+    ),
+)
+
+# Pool of worker processes that run the tiling, if enabled
+worker_pool = (
+    WorkerPool(
+        workers=int(os.environ["PIXELATOR_WORKERS"]),
+        threads_per_worker=int(os.environ.get("PIXELATOR_WORKER_THREADS", 1)),
+        max_queue=(
+            int(os.environ["PIXELATOR_QUEUE_SIZE"])
+            if "PIXELATOR_QUEUE_SIZE" in os.environ
+            else None
+        ),
+        timeout=(
+            float(os.environ["PIXELATOR_TIMEOUT"])
+            if "PIXELATOR_TIMEOUT" in os.environ
+            else None
+        ),
+        shared_min_bytes=(
+            int(os.environ.get("PIXELATOR_SHARED_MIN_BYTES", 64 * 1024)) or None
+        ),
+    )
+    if int(os.environ.get("PIXELATOR_WORKERS", 0)) > 0
+    else None
+)
+
+# Images uploaded to /images, prepared to be tiled repeatedly
+image_store = LRUCache(
+    max_entries=int(os.environ.get("PIXELATOR_IMAGE_ENTRIES", 32)),
+    max_bytes=int(os.environ.get("PIXELATOR_IMAGE_BYTES", 512 * 1024**2)),
+)
+
+# Background jobs, whose results are the encoded result and its mimetype
+job_store = JobStore(
+    max_workers=int(os.environ.get("PIXELATOR_JOB_WORKERS", 2)),
+    max_pending=int(os.environ.get("PIXELATOR_JOB_QUEUE_SIZE", 64)),
+    max_bytes=int(os.environ.get("PIXELATOR_JOB_BYTES", 256 * 1024**2)),
+    size=lambda job: len(job[0]),
+)
+
+# Metrics exposed by the /metrics route
+metrics = Registry()
+request_seconds = metrics.register(
+    Histogram("pixelator_request_seconds", "Request latency.", ("route",))
+)
+stage_seconds = metrics.register(
+    Histogram("pixelator_stage_seconds", "Pipeline stage duration.", ("stage",))
+)
+stage_peak_bytes = metrics.register(
+    Histogram(
+        "pixelator_stage_peak_bytes",
+        "Peak traced memory of pipeline stages, if allocation tracing is on.",
+        ("stage",),
+        buckets=tuple(2**power for power in range(16, 32, 2)),
+    )
+)
+input_megapixels = metrics.register(
+    Histogram(
+        "pixelator_input_megapixels",
+        "Size of the processed images.",
+        buckets=(0.1, 0.5, 1, 2, 5, 12, 24, 48, 100),
+    )
+)
+grid_size = metrics.register(
+    Histogram(
+        "pixelator_grid_size",
+        "Side length of the tile grid.",
+        buckets=(10, 25, 50, 100, 200, 500, 1000, 2000),
+    )
+)
+palette_size = metrics.register(
+    Histogram(
+        "pixelator_palette_size",
+        "Number of tile colors.",
+        buckets=(2, 4, 8, 16, 32, 64, 128, 256),
+    )
+)
+# The cluster cache hits and misses of the jobs run in the worker pool, each of
+# which has its own cluster cache, see call_with_stages
+worker_cluster_counts = {"hits": 0, "misses": 0}
+worker_cluster_lock = threading.Lock()
+
+
+def cache_counts(counter: str) -> dict:
+    """Get the hits or misses of every cache, for the cache metrics.
+
+    The "results" series counts lookups of the result cache as a whole, so a
+    value found on disk is a hit, and "results_disk" counts those of its disk
+    tier alone. The "clusters" series adds up the cluster caches of this
+    process and of the worker processes.
+
+    Args:
+        counter (str): "hits" or "misses".
+
+    Returns:
+        dict: The count of every cache, by its label values.
+    """
+    disk = result_cache.disk
+    if counter == "hits":
+        results = result_cache.memory.hits + (disk.hits if disk else 0)
+    else:
+        results = disk.misses if disk else result_cache.memory.misses
+
+    counts = {
+        ("results",): results,
+        ("clusters",): getattr(cluster_cache, counter) + worker_cluster_counts[counter],
+        ("images",): getattr(image_store, counter),
+    }
+    if disk is not None:
+        counts[("results_disk",)] = getattr(disk, counter)
+    return counts
+
+
+metrics.register(
+    Counter(
+        "pixelator_cache_hits_total",
+        "Cache hits.",
+        ("cache",),
+        function=lambda: cache_counts("hits"),
+    )
+)
+metrics.register(
+    Counter(
+        "pixelator_cache_misses_total",
+        "Cache misses.",
+        ("cache",),
+        function=lambda: cache_counts("misses"),
+    )
+)
+metrics.register(
+    Gauge(
+        "pixelator_queue_depth",
+        "Jobs submitted and not yet finished.",
+        ("queue",),
+        function=lambda: {
+            ("workers",): worker_pool.stats()["active"] if worker_pool else 0,
+            ("jobs",): job_store.stats()["pending"],
+        },
+    )
+)
+
+startup_seconds = metrics.register(
+    Gauge("pixelator_startup_seconds", "Duration of the startup phases.", ("phase",))
+)
+
+# Set once warm_up_app has finished, see the /readyz route
+ready = threading.Event()
+
+# Warm-up duration above which a warning is logged
+startup_budget = float(os.environ.get("PIXELATOR_STARTUP_BUDGET", 10))
+
+
+def observe_stage(name: str, seconds: float, peak_bytes: int | None):
+    """Stage hook recording the duration and memory of pipeline stages."""
+    stage_seconds.observe(seconds, stage=name)
+    if peak_bytes is not None:
+        stage_peak_bytes.observe(peak_bytes, stage=name)
+
+
+stage_hooks.append(observe_stage)
+
+# Maximum number of grid sizes in a /ladder request
+MAX_LADDER_SIZES = 16
+
+# Maximum grid size in a /ladder request
+MAX_LADDER_SIDE = 500
+
+# The outputs that are a bill of materials, computed from the grid alone
+BOM_OUTPUTS = ("bom", "bom_csv")
+
+# The outputs of a tiling request; "image_bom" is a zip of the PNG and its
+# bill of materials
+OUTPUTS = ("image", "indices", *BOM_OUTPUTS, "image_bom")
+
+# The file extension of each output in a /batch zip
+BATCH_EXTENSIONS = {
+    "image": "png",
+    "indices": "json",
+    "bom": "json",
+    "bom_csv": "csv",
+    "image_bom": "zip",
+}
+
+# Maximum number of frames in an /animate request
+MAX_ANIMATION_FRAMES = int(os.environ.get("PIXELATOR_MAX_FRAMES", 500))
 
 default_tile_colors = (
     "#FF0000",  # Red
@@ -26,6 +256,22 @@ default_tile_colors = (
 )
 
 
+@app.before_request
+def start_timer():
+    """Record the start time of the request."""
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    """Record the request latency and report it in the Server-Timing header."""
+    seconds = time.perf_counter() - g.start_time
+    route = request.url_rule.rule if request.url_rule else "unknown"
+    request_seconds.observe(seconds, route=route)
+    response.headers.add("Server-Timing", f"total;dur={seconds * 1000:.1f}")
+    return response
+
+
 @app.route("/", methods=["POST"])
 def process_image():
     """Route for processing an image and returning the tiled version."""
@@ -36,50 +282,1138 @@ def process_image():
     image_file = request.files["image"]
 
     # Get optional parameters from the request
-    tile_colors = request.form.get(
-        "tile_colors", json.dumps(default_tile_colors), type=str
+    try:
+        params = parse_tiling_params(request.form)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    # Return the cached result if this image was processed the same way before
+    image_data = image_file.read()
+    cache_key = make_key(image_data, **params)
+    result = result_cache.get(cache_key)
+    cache_status = "HIT"
+
+    try:
+        if result is None and params["output"] == "image" and is_streamed(request.form):
+            with record_stages() as stages:
+                grid, size = run_grid(image_data, params)
+            return stream_result(grid, size, cache_key, stages)
+
+        with record_stages() as stages:
+            if result is None:
+                cache_status = "MISS"
+
+                # Process the image
+                result = run_render(image_data, params)
+                result_cache.set(cache_key, result)
+
+        response = send_file(
+            BytesIO(result), mimetype=result_mimetype(params["output"])
+        )
+        response.headers["X-Cache"] = cache_status
+        if stages:
+            response.headers["Server-Timing"] = ", ".join(
+                f"{name};dur={seconds * 1000:.1f}" for name, seconds, _ in stages
+            )
+        return response
+
+    except PoolFullError as e:
+        return {"error": str(e)}, 429, {"Retry-After": "1"}
+
+    except TimeoutError as e:
+        return {"error": str(e)}, 504
+
+    except ValueError as e:
+        # e.g. an inventory with fewer tiles than the grid
+        return {"error": str(e)}, 400
+
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+
+def stream_result(
+    grid: Image.Image, size: tuple[int, int], cache_key: str, stages: list
+) -> Response:
+    """Respond with a PNG that is upscaled and encoded while it is being sent.
+
+    The tile grid is computed before responding, so errors are still reported
+    with their status code. The encoded result is cached once it is complete.
+
+    Args:
+        grid (Image): The grid returned by tile_grid.
+        size (tuple[int, int]): The size to upscale the grid to.
+        cache_key (str): The key to cache the result under.
+        stages (list): The stages of computing the grid, from record_stages.
+
+    Returns:
+        Response: The streamed PNG.
+    """
+
+    def generate():
+        chunks = []
+        for chunk in iter_upscaled_png(grid, size):
+            chunks.append(chunk)
+            yield chunk
+        result_cache.set(cache_key, b"".join(chunks))
+
+    response = Response(generate(), mimetype="image/png")
+    response.headers["X-Cache"] = "MISS"
+    response.headers["Server-Timing"] = ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds, _ in stages
     )
+    return response
+
+
+@app.route("/ladder", methods=["POST"])
+def process_ladder():
+    """Route for tiling an image at several grid sizes in one request.
+
+    Takes the same fields as process_image, plus "ladder", the comma-separated
+    grid sizes. The colors are clustered once and reused for every size.
+    """
+
+    if "image" not in request.files:
+        return {"error": "No image file provided"}, 400
+
     try:
-        if tile_colors:
-            tile_colors = validate_tile_colors(tile_colors)
-            tile_colors = [hex_to_rgb(color[1:]) for color in tile_colors]
+        params = parse_tiling_params(request.form)
+        ladder = parse_ladder(request.form.get("ladder", ""))
+        if isinstance(params["grid"], list):
+            raise ValueError('grid must be "auto" or omitted for a ladder')
+        if params["inventory"] is not None:
+            raise ValueError("inventory cannot be used with a ladder")
+        if params["output"] not in ("image", "indices"):
+            raise ValueError("output must be one of image, indices for a ladder")
     except ValueError as e:
         return {"error": str(e)}, 400
 
-    pixel_dimensions = request.form.get("pixel_dimensions", 50, type=int)
+    image_data = request.files["image"].read()
+    cache_key = make_key(image_data, ladder=ladder, **params)
+    result = result_cache.get(cache_key)
+    cache_status = "HIT"
+
+    try:
+        if result is None:
+            cache_status = "MISS"
+            observe_input(image_data, params)
+            result = run_in_pool(render_ladder, image_data, params, ladder)
+            result_cache.set(cache_key, result)
 
-    # Save the uploaded file
-    input_path = os.path.join(UPLOAD_FOLDER, image_file.filename)
-    image_file.save(input_path)
+    except PoolFullError as e:
+        return {"error": str(e)}, 429, {"Retry-After": "1"}
 
+    except TimeoutError as e:
+        return {"error": str(e)}, 504
+
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+    if params["output"] == "indices":
+        response = send_file(BytesIO(result), mimetype="application/json")
+    else:
+        response = send_file(
+            BytesIO(result),
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name="ladder.zip",
+        )
+    response.headers["X-Cache"] = cache_status
+    return response
+
+
+@app.route("/animate", methods=["POST"])
+def process_animation():
+    """Route for tiling every frame of an animated GIF or WebP.
+
+    Takes the same fields as process_image, plus "format", "gif" or "webp",
+    the format of the result. It defaults to the format of the image if that is
+    WebP, and to GIF otherwise. The colors are clustered once for all frames.
+    """
+
+    if "image" not in request.files:
+        return {"error": "No image file provided"}, 400
+
+    image_data = request.files["image"].read()
     try:
-        # Process the image
-        processed_image = tile_image(input_path, tile_colors, pixel_dimensions)
+        params = parse_tiling_params(request.form)
+        output_format = parse_animation_format(request.form, image_data)
+        if params["inventory"] is not None:
+            raise ValueError("inventory cannot be used with an animation")
+        if params["output"] not in ("image", "indices"):
+            raise ValueError("output must be one of image, indices for an animation")
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
-        # Save the processed image to an in-memory buffer
-        buffer = BytesIO()
-        processed_image.save(buffer, format="PNG")
-        buffer.seek(0)
+    cache_key = make_key(image_data, format=output_format, **params)
+    result = result_cache.get(cache_key)
+    cache_status = "HIT"
+
+    try:
+        if result is None:
+            cache_status = "MISS"
+            observe_input(image_data, params)
+            result = run_in_pool(render_animation, image_data, params, output_format)
+            result_cache.set(cache_key, result)
+
+    except PoolFullError as e:
+        return {"error": str(e)}, 429, {"Retry-After": "1"}
+
+    except TimeoutError as e:
+        return {"error": str(e)}, 504
+
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+    if params["output"] == "indices":
+        mimetype = "application/json"
+    else:
+        mimetype = f"image/{output_format.lower()}"
+    response = send_file(BytesIO(result), mimetype=mimetype)
+    response.headers["X-Cache"] = cache_status
+    return response
+
+
+@app.route("/batch", methods=["POST"])
+def process_batch():
+    """Route for processing many images and returning a zip of the tiled versions.
+
+    Every image uses the parameters of the form, which can be overridden per
+    image by the "params" field: a JSON list with one object per image.
+    Images that fail are listed in errors.json inside the zip.
+    """
+
+    image_files = request.files.getlist("images")
+    if not image_files:
+        return {"error": "No image files provided"}, 400
+
+    try:
+        parse_tiling_params(request.form)
+        overrides = json.loads(request.form.get("params", "[]"))
+        if not isinstance(overrides, list) or not all(
+            isinstance(override, dict) for override in overrides
+        ):
+            raise ValueError("params must be a JSON list of objects")
+        if overrides and len(overrides) != len(image_files):
+            raise ValueError("params must have one entry per image")
+    except (json.JSONDecodeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    # Read every image before the response starts streaming
+    items = []
+    for index, image_file in enumerate(image_files):
+        item = {"index": index, "filename": image_file.filename}
+        try:
+            values = request.form.to_dict()
+            values.update(overrides[index] if overrides else {})
+            item["params"] = parse_tiling_params(values)
+            item["data"] = image_file.read()
+            item["key"] = make_key(item["data"], **item["params"])
+        except ValueError as e:
+            item["error"] = str(e)
+        items.append(item)
+
+    def generate():
+        stream = ZipStream()
+        errors = []
+
+        def add(item, result):
+            stem = os.path.splitext(os.path.basename(item["filename"] or ""))[0]
+            extension = BATCH_EXTENSIONS[item["params"]["output"]]
+            archive.writestr(f"{item['index']:03d}_{stem}.{extension}", result)
+
+        with zipfile.ZipFile(stream, "w") as archive:
+            # Add the cached results first, and process the rest concurrently
+            pending = []
+            for item in items:
+                if "error" in item:
+                    errors.append(item)
+                    continue
+                result = result_cache.get(item["key"])
+                if result is None:
+                    pending.append(item)
+                else:
+                    add(item, result)
+                    yield stream.drain()
+
+            for item, result, error in render_results(pending):
+                if error is None:
+                    result_cache.set(item["key"], result)
+                    add(item, result)
+                else:
+                    item["error"] = str(error)
+                    errors.append(item)
+                yield stream.drain()
+
+            archive.writestr(
+                "errors.json",
+                json.dumps(
+                    [
+                        {key: item[key] for key in ("index", "filename", "error")}
+                        for item in sorted(errors, key=lambda item: item["index"])
+                    ]
+                ),
+            )
+        yield stream.drain()
+
+    return Response(
+        generate(),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=tiles.zip"},
+    )
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Route for queueing an image to be tiled in the background.
+
+    Takes the same fields as process_image and returns the id of the job.
+    """
+
+    if "image" not in request.files:
+        return {"error": "No image file provided"}, 400
+
+    try:
+        params = parse_tiling_params(request.form)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    image_data = request.files["image"].read()
+    cache_key = make_key(image_data, **params)
+    result = result_cache.get(cache_key)
+    mimetype = result_mimetype(params["output"])
+
+    if result is None:
+
+        def run(progress):
+            result = run_render(image_data, params, progress)
+            result_cache.set(cache_key, result)
+            return result, mimetype
+
+        try:
+            job_id = job_store.submit(run)
+        except PoolFullError as e:
+            return {"error": str(e)}, 429, {"Retry-After": "1"}
+    else:
+        job_id = job_store.add_result((result, mimetype))
 
-        # Clean up the input file
-        os.remove(input_path)
+    status_url = url_for("job_status", job_id=job_id)
+    return (
+        {
+            "id": job_id,
+            "status_url": status_url,
+            "result_url": url_for("job_result", job_id=job_id),
+        },
+        202,
+        {"Location": status_url},
+    )
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Route for the status and pipeline stage of a job."""
+    status = job_store.status(job_id)
+    if status is None:
+        return {"error": "Job not found"}, 404
+    return status
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    """Route for the result of a finished job."""
+    status = job_store.status(job_id)
+    if status is None:
+        return {"error": "Job not found"}, 404
+    if status["status"] == "failed":
+        return {"error": status["error"]}, 500
+    if status["status"] != "done":
+        return {"error": "Job is not finished", "status": status["status"]}, 409
+
+    job = job_store.result(job_id)
+    if job is None:
+        return {"error": "Job not found"}, 404
 
-        return send_file(buffer, mimetype="image/png")
+    result, mimetype = job
+    return send_file(BytesIO(result), mimetype=mimetype)
+
+
+@app.route("/images", methods=["POST"])
+def upload_image():
+    """Route for uploading an image once, to tile it many times.
+
+    The image is decoded and kept in memory, and can then be tiled by its id
+    with tile_uploaded_image until it is deleted or evicted.
+    """
+
+    if "image" not in request.files:
+        return {"error": "No image file provided"}, 400
+
+    image_data = request.files["image"].read()
+    image_id = make_key(image_data)
+    prepared = image_store.get(image_id)
+
+    if prepared is None:
+        try:
+            with Image.open(BytesIO(image_data)) as image:
+                input_megapixels.observe(image.width * image.height / 1e6)
+            prepared = PreparedImage(image_data)
+        except Exception as e:
+            return {"error": str(e)}, 400
+        image_store.set(image_id, prepared, size=prepared.nbytes)
+
+    tile_url = url_for("tile_uploaded_image", image_id=image_id)
+    return (
+        {
+            "id": image_id,
+            "width": prepared.size[0],
+            "height": prepared.size[1],
+            "tile_url": tile_url,
+        },
+        201,
+        {"Location": url_for("delete_uploaded_image", image_id=image_id)},
+    )
+
+
+@app.route("/images/<image_id>/tile", methods=["POST"])
+def tile_uploaded_image(image_id):
+    """Route for tiling an uploaded image.
+
+    Takes the same fields as process_image, without the image. Responds with
+    404 if the image is unknown or was evicted, and should be uploaded again.
+    """
+
+    try:
+        params = parse_tiling_params(request.form)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    cache_key = make_key(image_id.encode(), source="images", **params)
+    result = result_cache.get(cache_key)
+    cache_status = "HIT"
+
+    try:
+        with record_stages() as stages:
+            if result is None:
+                cache_status = "MISS"
+                prepared = image_store.get(image_id)
+                if prepared is None:
+                    return {"error": "Image not found"}, 404
+
+                grid_size.observe(params["pixel_dimensions"])
+                palette_size.observe(len(params["tile_colors"]))
+                grid, size = prepared.tile(**grid_kwargs(params))
+                if params["output"] == "image" and is_streamed(request.form):
+                    return stream_result(grid, size, cache_key, stages)
+
+                timer = StageTimer()
+                processed_image = grid
+                if params["output"] not in BOM_OUTPUTS:
+                    timer.start("upscale")
+                    processed_image = upscale_grid(grid, size)
+                    if params["output"] == "image_bom":
+                        processed_image = (processed_image, bill_of_materials(grid))
+                timer.start("encode")
+                result = encode_result(processed_image, params["output"])
+                timer.finish()
+                result_cache.set(cache_key, result)
+
+        response = send_file(
+            BytesIO(result), mimetype=result_mimetype(params["output"])
+        )
+        response.headers["X-Cache"] = cache_status
+        if stages:
+            response.headers["Server-Timing"] = ", ".join(
+                f"{name};dur={seconds * 1000:.1f}" for name, seconds, _ in stages
+            )
+        return response
+
+    except ValueError as e:
+        # e.g. an inventory with fewer tiles than the grid
+        return {"error": str(e)}, 400
 
     except Exception as e:
         return {"error": str(e)}, 500
 
 
-def hex_to_rgb(hex_color: str) -> tuple:
-    """Convert a hex color code to an RGB tuple.
+@app.route("/images/<image_id>", methods=["DELETE"])
+def delete_uploaded_image(image_id):
+    """Route for deleting an uploaded image."""
+    if not image_store.delete(image_id):
+        return {"error": "Image not found"}, 404
+    return "", 204
+
+
+@app.route("/healthz", methods=["GET"])
+def health():
+    """Route for the liveness of the server."""
+    return {"status": "ok"}
+
+
+@app.route("/readyz", methods=["GET"])
+def readiness():
+    """Route for the readiness of the server, which waits for the warm-up."""
+    if not ready.is_set():
+        return {"status": "warming up"}, 503
+    return {"status": "ready"}
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Route for the metrics in the Prometheus text exposition format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/cache", methods=["GET"])
+def cache_stats():
+    """Route for the hit and miss counters of the result, cluster and image caches."""
+    return {
+        "results": result_cache.stats(),
+        "clusters": cluster_cache.stats(),
+        "images": image_store.stats(),
+    }
+
+
+def warm_up_app():
+    """Warm up the pipeline, and start the worker pool if it is enabled.
+
+    The first request then does not pay for importing the clustering backends
+    and starting their thread pools. The server reports ready once this has
+    finished, even if the warm-up failed.
+    """
+    start = time.perf_counter()
+    try:
+        warm_up()
+        if worker_pool is not None:
+            worker_pool.start()
+    except Exception:
+        app.logger.exception("Warm-up failed")
+    finally:
+        seconds = time.perf_counter() - start
+        startup_seconds.set(seconds, phase="warm_up")
+        if seconds > startup_budget:
+            app.logger.warning(
+                "Warm-up took %.1fs, over the startup budget of %.1fs",
+                seconds,
+                startup_budget,
+            )
+        ready.set()
+
+
+def start_warm_up() -> threading.Thread:
+    """Run warm_up_app in a background thread, so the server can answer
+    /healthz and /readyz while it warms up.
+
+    Returns:
+        threading.Thread: The started thread.
+    """
+    thread = threading.Thread(target=warm_up_app, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def render_result(image_data: bytes, params: dict, progress=None) -> bytes:
+    """Tile an image and encode the result.
+
+    Args:
+        image_data (bytes): The encoded image.
+        params (dict): The parameters returned by parse_tiling_params.
+        progress (optional): Called with the name of each stage as it starts.
+        Defaults to None.
+
+    Returns:
+        bytes: The encoded result.
+    """
+    if params["output"] in BOM_OUTPUTS:
+        # The bill of materials only needs the grid, so skip the upscale
+        processed_image, _ = tile_grid(
+            BytesIO(image_data), **grid_kwargs(params), progress=progress
+        )
+    else:
+        processed_image = tile_image(
+            BytesIO(image_data), **tiling_kwargs(params), progress=progress
+        )
+
+    stages = StageTimer(progress)
+    stages.start("encode")
+    result = encode_result(processed_image, params["output"])
+    stages.finish()
+
+    return result
+
+
+def render_grid(image_data: bytes, params: dict) -> tuple:
+    """Tile an image without upscaling it.
+
+    Args:
+        image_data (bytes): The encoded image.
+        params (dict): The parameters returned by parse_tiling_params.
+
+    Returns:
+        tuple: The grid and output size returned by tile_grid.
+    """
+    return tile_grid(BytesIO(image_data), **grid_kwargs(params))
+
+
+def render_ladder(image_data: bytes, params: dict, ladder: list[int]) -> bytes:
+    """Tile an image at several grid sizes and encode the results.
+
+    Args:
+        image_data (bytes): The encoded image.
+        params (dict): The parameters returned by parse_tiling_params.
+        ladder (list[int]): The grid sizes, as returned by parse_ladder.
+
+    Returns:
+        bytes: For "image" output, a zip of one PNG per size, named after the
+        size. For "indices" output, a JSON object whose "grids" list has the
+        pixel_dimensions and grid_to_json of every size.
+    """
+    kwargs = grid_kwargs(params)
+    del kwargs["pixel_dimensions"], kwargs["inventory"]
+    results = tile_ladder(BytesIO(image_data), pixel_dimensions=ladder, **kwargs)
+
+    stages = StageTimer()
+    stages.start("encode")
+    if params["output"] == "indices":
+        result = json.dumps(
+            {
+                "grids": [
+                    {"pixel_dimensions": side, **grid_to_json(tiles)}
+                    for side, (tiles, _) in zip(ladder, results)
+                ]
+            }
+        ).encode()
+    else:
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for side, (tiles, size) in zip(ladder, results):
+                archive.writestr(
+                    f"{side}.png", b"".join(iter_upscaled_png(tiles, size))
+                )
+        result = buffer.getvalue()
+    stages.finish()
+
+    return result
+
+
+def render_animation(image_data: bytes, params: dict, output_format: str) -> bytes:
+    """Tile every frame of an animation and encode the result.
+
+    Args:
+        image_data (bytes): The encoded animation.
+        params (dict): The parameters returned by parse_tiling_params.
+        output_format (str): "GIF" or "WEBP", see parse_animation_format.
+
+    Returns:
+        bytes: For "image" output, the encoded animation. For "indices" output,
+        a JSON object whose "frames" list has the grid_to_json of every frame,
+        and whose "durations" list has their durations in milliseconds.
+    """
+    kwargs = grid_kwargs(params)
+    del kwargs["inventory"]
+    frames, size, info = tile_animation(
+        BytesIO(image_data), **kwargs, max_frames=MAX_ANIMATION_FRAMES
+    )
+
+    if params["output"] != "indices":
+        return encode_animation(frames, size, info, output_format)
+
+    stages = StageTimer()
+    stages.start("encode")
+    result = json.dumps(
+        {
+            "frames": [grid_to_json(tiles) for tiles in frames],
+            "durations": info["durations"],
+        }
+    ).encode()
+    stages.finish()
+
+    return result
+
+
+def call_with_stages(fn, *args, **kwargs) -> tuple:
+    """Call fn, also returning its stages and cluster cache counts so they can
+    be recorded in the web process with record_worker. This is how functions
+    run in the worker pool.
+
+    Args:
+        fn: The function to call.
+        *args: Positional arguments of fn.
+        **kwargs: Keyword arguments of fn.
+
+    Returns:
+        tuple: The result of fn, the stages returned by record_stages, and the
+        cluster cache hits and misses of fn.
+    """
+    hits, misses = cluster_cache.hits, cluster_cache.misses
+    with record_stages() as stages:
+        result = fn(*args, **kwargs)
+    return result, stages, (cluster_cache.hits - hits, cluster_cache.misses - misses)
+
+
+def record_worker(stages: list, cluster_counts: tuple[int, int]):
+    """Record the stages and cluster cache counts returned by call_with_stages."""
+    for stage in stages:
+        record_stage(*stage)
+    with worker_cluster_lock:
+        worker_cluster_counts["hits"] += cluster_counts[0]
+        worker_cluster_counts["misses"] += cluster_counts[1]
+
+
+def run_in_pool(fn, *args, progress=None):
+    """Run fn in the worker pool if it is enabled, or in this thread.
+
+    Args:
+        fn: The function to run. It and its arguments must be picklable.
+        *args: Positional arguments of fn.
+        progress (optional): Called in this process with the name of each stage
+        fn reports through its progress keyword argument. Defaults to None,
+        which does not give fn a progress argument.
+
+    Returns:
+        The result of fn.
+    """
+    if worker_pool is None:
+        return fn(*args) if progress is None else fn(*args, progress=progress)
+
+    result, stages, cluster_counts = worker_pool.run(
+        call_with_stages, fn, *args, progress=progress
+    )
+    record_worker(stages, cluster_counts)
+    return result
+
+
+def observe_input(image_data: bytes, params: dict):
+    """Record the input size, grid size and palette size of a request."""
+    try:
+        with Image.open(BytesIO(image_data)) as image:
+            input_megapixels.observe(image.width * image.height / 1e6)
+    except Exception:
+        pass
+    grid_size.observe(params["pixel_dimensions"])
+    palette_size.observe(len(params["tile_colors"]))
+
+
+def run_render(image_data: bytes, params: dict, progress=None) -> bytes:
+    """Run render_result in the worker pool if it is enabled, or in this thread.
+
+    Args:
+        image_data (bytes): The encoded image.
+        params (dict): The parameters returned by parse_tiling_params.
+        progress (optional): Called with the name of each stage as it starts.
+        Defaults to None.
+
+    Returns:
+        bytes: The encoded result.
+    """
+    observe_input(image_data, params)
+    return run_in_pool(render_result, image_data, params, progress=progress)
+
+
+def run_grid(image_data: bytes, params: dict) -> tuple:
+    """Run render_grid in the worker pool if it is enabled, or in this thread.
+
+    Args:
+        image_data (bytes): The encoded image.
+        params (dict): The parameters returned by parse_tiling_params.
+
+    Returns:
+        tuple: The grid and output size returned by tile_grid.
+    """
+    observe_input(image_data, params)
+    return run_in_pool(render_grid, image_data, params)
+
+
+def render_results(items: list[dict]) -> Iterator[tuple[dict, bytes, Exception]]:
+    """Tile and encode many images concurrently.
+
+    The images are processed by the worker pool if it is enabled, and by
+    tile_images otherwise.
+
+    Args:
+        items (list[dict]): The images, each with its encoded "data" and the
+        "params" returned by parse_tiling_params.
+
+    Yields:
+        tuple[dict, bytes, Exception]: Each item as it finishes, with either its
+        encoded result or the error raised while processing it.
+    """
+    for item in items:
+        observe_input(item["data"], item["params"])
+
+    if worker_pool is None:
+        results = tile_images(
+            [BytesIO(item["data"]) for item in items],
+            [tiling_kwargs(item["params"]) for item in items],
+        )
+        for position, processed_image, error in results:
+            result = None
+            if error is None:
+                try:
+                    result = encode_result(
+                        processed_image, items[position]["params"]["output"]
+                    )
+                except Exception as e:
+                    error = e
+            yield items[position], result, error
+        return
+
+    def finish(future):
+        error = future.exception()
+        if error is not None:
+            return futures.pop(future), None, error
+
+        result, stages, cluster_counts = future.result()
+        record_worker(stages, cluster_counts)
+        return futures.pop(future), result, None
+
+    # Keep at most as many jobs in flight as the pool can take, and wait for a
+    # free slot rather than failing the images that do not fit
+    futures = {}
+    for item in items:
+        while len(futures) >= worker_pool.workers + worker_pool.max_queue:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield finish(future)
+        try:
+            future = worker_pool.submit(
+                call_with_stages,
+                render_result,
+                item["data"],
+                item["params"],
+                block=True,
+            )
+            futures[future] = item
+        except PoolFullError as e:
+            yield item, None, e
+
+    for future in as_completed(list(futures)):
+        yield finish(future)
+
+
+def parse_tiling_params(values) -> dict:
+    """Parse and validate the tiling parameters of a request.
+
+    Args:
+        values (Mapping): The form fields of the request, or a JSON object of
+        the same fields. tile_colors can be a JSON string or a list.
+
+    Returns:
+        dict: The tile_colors as RGB tuples, pixel_dimensions, grid ("auto",
+        [columns, rows] or None), downscale, quantizer, color_space, dither,
+        clusters ("auto", a number or None), match, inventory (a count per tile
+        color or None), output and scale.
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    tile_colors = values.get("tile_colors") or json.dumps(default_tile_colors)
+    if not isinstance(tile_colors, str):
+        tile_colors = json.dumps(tile_colors)
+    tile_colors = validate_tile_colors(tile_colors)
+    tile_colors = [hex_to_rgb(color[1:]) for color in tile_colors]
+    if len(tile_colors) > MAX_TILE_COLORS:
+        raise ValueError(f"tile_colors can have at most {MAX_TILE_COLORS} colors")
+
+    try:
+        pixel_dimensions = int(values.get("pixel_dimensions", 50))
+        scale = values.get("scale")
+        scale = None if scale in (None, "") else int(scale)
+    except (TypeError, ValueError) as exc:
+        raise ValueError("pixel_dimensions and scale must be integers") from exc
+    if pixel_dimensions < 1:
+        raise ValueError("pixel_dimensions must be a positive integer")
+    if scale is not None and scale < 1:
+        raise ValueError("scale must be a positive integer")
+
+    grid = values.get("grid") or None
+    if grid not in (None, "auto"):
+        try:
+            grid = [int(side) for side in str(grid).lower().split("x")]
+        except ValueError as exc:
+            raise ValueError('grid must be "auto" or COLUMNSxROWS') from exc
+        if len(grid) != 2 or min(grid) < 1:
+            raise ValueError('grid must be "auto" or COLUMNSxROWS')
+
+    downscale = values.get("downscale", "bicubic")
+    if downscale not in ("bicubic", "block"):
+        raise ValueError("downscale must be one of bicubic, block")
+
+    quantizer = values.get("quantizer", "kmeans")
+    if quantizer not in (*QUANTIZERS, "direct"):
+        raise ValueError(f"quantizer must be one of {', '.join(QUANTIZERS)}, direct")
+
+    dither = values.get("dither", "none")
+    if dither not in DITHERS:
+        raise ValueError(f"dither must be one of {', '.join(DITHERS)}")
+
+    color_space = values.get("color_space", "rgb")
+    if color_space not in COLOR_SPACES:
+        raise ValueError(f"color_space must be one of {', '.join(COLOR_SPACES)}")
+
+    clusters = values.get("clusters") or None
+    if clusters not in (None, "auto"):
+        try:
+            clusters = int(clusters)
+        except (TypeError, ValueError) as exc:
+            raise ValueError('clusters must be "auto" or a positive integer') from exc
+        if clusters < 1:
+            raise ValueError('clusters must be "auto" or a positive integer')
+        if clusters > MAX_CLUSTERS:
+            raise ValueError(f"clusters can be at most {MAX_CLUSTERS}")
+
+    match = values.get("match", "unique")
+    if match not in MATCHES:
+        raise ValueError(f"match must be one of {', '.join(MATCHES)}")
+
+    inventory = values.get("inventory") or None
+    if inventory is not None:
+        try:
+            if isinstance(inventory, str):
+                inventory = json.loads(inventory)
+            if not all(isinstance(count, int) and count >= 0 for count in inventory):
+                raise ValueError
+        except (TypeError, ValueError) as exc:
+            raise ValueError(
+                "inventory must be a JSON list of tile counts, e.g. [100, 50]"
+            ) from exc
+        if len(inventory) != len(tile_colors):
+            raise ValueError("inventory must have one count per tile color")
+        if quantizer == "direct":
+            raise ValueError('inventory cannot be used with the "direct" quantizer')
+
+    output = values.get("output", "image")
+    if output not in OUTPUTS:
+        raise ValueError(f"output must be one of {', '.join(OUTPUTS)}")
+    if output not in ("image", "image_bom"):
+        scale = 1
+    elif scale is not None:
+        # An "auto" grid has at most pixel_dimensions tiles along each side
+        columns, rows = grid if isinstance(grid, list) else (pixel_dimensions,) * 2
+        if columns * rows * scale**2 > MAX_OUTPUT_PIXELS:
+            raise ValueError(
+                f"the grid at this scale exceeds {MAX_OUTPUT_PIXELS} pixels"
+            )
+
+    return {
+        "tile_colors": tile_colors,
+        "pixel_dimensions": pixel_dimensions,
+        "grid": grid,
+        "downscale": downscale,
+        "quantizer": quantizer,
+        "color_space": color_space,
+        "dither": dither,
+        "clusters": clusters,
+        "match": match,
+        "inventory": inventory,
+        "output": output,
+        "scale": scale,
+    }
+
+
+def parse_ladder(value: str) -> list[int]:
+    """Parse the grid sizes of a ladder request.
+
+    Args:
+        value (str): Comma-separated grid sizes, e.g. "10,20,40".
+
+    Returns:
+        list[int]: The distinct grid sizes, in increasing order.
+
+    Raises:
+        ValueError: If a size is invalid or too large, or there are none or
+        too many.
+    """
+    try:
+        ladder = sorted({int(side) for side in value.split(",") if side.strip()})
+    except ValueError as exc:
+        raise ValueError("ladder must be comma-separated integers") from exc
+    if not ladder or ladder[0] < 1:
+        raise ValueError("ladder must be comma-separated positive integers")
+    if len(ladder) > MAX_LADDER_SIZES:
+        raise ValueError(f"ladder can have at most {MAX_LADDER_SIZES} sizes")
+    if ladder[-1] > MAX_LADDER_SIDE:
+        raise ValueError(f"ladder sizes can be at most {MAX_LADDER_SIDE}")
+    return ladder
+
+
+def parse_animation_format(values, image_data: bytes) -> str:
+    """Parse the output format of an animation request.
+
+    Args:
+        values (Mapping): The form fields of the request.
+        image_data (bytes): The encoded animation, whose format is the default
+        if it is WebP.
+
+    Returns:
+        str: "GIF" or "WEBP".
+
+    Raises:
+        ValueError: If the format is not gif or webp.
+    """
+    output_format = values.get("format", "")
+    if not output_format:
+        try:
+            with Image.open(BytesIO(image_data)) as image:
+                output_format = "webp" if image.format == "WEBP" else "gif"
+        except Exception:
+            output_format = "gif"
+
+    if output_format.lower() not in ("gif", "webp"):
+        raise ValueError("format must be one of gif, webp")
+    return output_format.upper()
+
+
+def tiling_kwargs(params: dict) -> dict:
+    """Convert parsed request parameters to keyword arguments of tile_image.
+
+    Args:
+        params (dict): The parameters returned by parse_tiling_params.
+
+    Returns:
+        dict: The keyword arguments of tile_image.
+    """
+    return {
+        "tile_colors": params["tile_colors"],
+        "pixel_dimensions": params["pixel_dimensions"],
+        "grid": params["grid"],
+        "quantizer": params["quantizer"],
+        "color_space": params["color_space"],
+        "dither": params["dither"],
+        "resample": (
+            "block" if params["downscale"] == "block" else Image.Resampling.BICUBIC
+        ),
+        "output_scale": params["scale"],
+        "n_clusters": params["clusters"],
+        "match": params["match"],
+        "inventory": params["inventory"],
+        "palettized": True,
+        "bom": params["output"] == "image_bom",
+    }
+
+
+def grid_kwargs(params: dict) -> dict:
+    """Convert parsed request parameters to keyword arguments of tile_grid.
+
+    Args:
+        params (dict): The parameters returned by parse_tiling_params.
+
+    Returns:
+        dict: The keyword arguments of tile_grid.
+    """
+    kwargs = tiling_kwargs(params)
+    del kwargs["palettized"], kwargs["bom"]
+    return kwargs
+
+
+def encode_result(processed_image, output: str) -> bytes:
+    """Encode a processed image in the requested output format.
+
+    Args:
+        processed_image (Image | tuple[Image, dict]): The palettized image
+        returned by tile_image, with its bill of materials for "image_bom".
+        output (str): "image" for a PNG, "indices" for JSON palette indices,
+        "bom" or "bom_csv" for the bill of materials of the grid as JSON or
+        CSV, see bill_of_materials, or "image_bom" for a zip of the PNG as
+        "tiled.png" and the JSON bill of materials as "bom.json".
+
+    Returns:
+        bytes: The encoded result.
+    """
+    if output == "indices":
+        return json.dumps(grid_to_json(processed_image)).encode()
+    if output == "bom":
+        return bom_to_json(bill_of_materials(processed_image)).encode()
+    if output == "bom_csv":
+        return bom_to_csv(bill_of_materials(processed_image)).encode()
+    if output == "image_bom":
+        image, bom = processed_image
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("tiled.png", encode_result(image, "image"))
+            archive.writestr("bom.json", bom_to_json(bom))
+        return buffer.getvalue()
+
+    # Save the processed image to an in-memory buffer
+    buffer = BytesIO()
+    processed_image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def is_streamed(values) -> bool:
+    """Whether a request asks for its PNG to be streamed, see stream_result.
+
+    Args:
+        values (Mapping): The form fields of the request.
+
+    Returns:
+        bool: True if the "stream" field is "1" or "true".
+    """
+    return str(values.get("stream", "")).lower() in ("1", "true")
+
+
+def result_mimetype(output: str) -> str:
+    """Get the mimetype of an encoded result.
+
+    Args:
+        output (str): One of OUTPUTS.
+
+    Returns:
+        str: The mimetype of the result.
+    """
+    if output == "bom_csv":
+        return "text/csv"
+    if output == "image_bom":
+        return "application/zip"
+    return "image/png" if output == "image" else "application/json"
+
+
+class ZipStream(RawIOBase):
+    """A write-only stream that buffers a zip file as it is written.
+
+    zipfile writes to it like an unseekable file, and drain() takes what has
+    been written so far, so the zip can be sent while it is being built.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        return len(data)
+
+    def drain(self) -> bytes:
+        """Take the bytes written since the last call."""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def grid_to_json(grid_image) -> dict:
+    """Convert a palettized tile grid to a JSON-serializable dictionary.
 
     Args:
-        hex_color (str): A hex color code without the octothorpe (e.g., "FF0000").
+        grid_image (Image): A "P" mode image with one pixel per tile.
 
     Returns:
-        tuple: An RGB tuple (e.g., (255, 0, 0)).
+        dict: The grid width and height, the palette as hex color codes, and
+        the rows of palette indices.
     """
-    return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
+    palette = grid_image.getpalette()
+    return {
+        "width": grid_image.width,
+        "height": grid_image.height,
+        "palette": [rgb_to_hex(palette[i : i + 3]) for i in range(0, len(palette), 3)],
+        "indices": np.array(grid_image).tolist(),
+    }
 
 
 def validate_tile_colors(tile_colors):
@@ -112,4 +1446,5 @@ def validate_tile_colors(tile_colors):
 
 
 if __name__ == "__main__":
+    start_warm_up()
     app.run(debug=True)
@@ -0,0 +1,313 @@
+"""Benchmark the stages of the pixelator pipeline.
+
+Times each stage of tile_image, and the streamed encoding of
+iter_upscaled_png, with its peak traced memory, across a matrix of image sizes, grid sizes and palette sizes, and compares the results
+with a stored baseline:
+
+    python -m server.benchmark --output bench.json
+    python -m server.benchmark --baseline bench.json --threshold 0.2
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+import PIL
+import sklearn
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from server import pixelator
+
+STAGES = (
+    "decode",
+    "downscale",
+    "cluster",
+    "remap",
+    "upscale",
+    "encode",
+    "stream",
+)
+
+DEFAULT_MATRIX = {
+    "image_sizes": [(640, 480), (1920, 1080), (4000, 3000)],
+    "pixel_dimensions": [25, 100, 250, 1000],
+    "n_colors": [2, 4, 8, 16],
+}
+
+QUICK_MATRIX = {
+    "image_sizes": [(640, 480)],
+    "pixel_dimensions": [25, 100],
+    "n_colors": [4, 8],
+}
+
+
+def make_test_image(size: tuple[int, int], seed=0) -> bytes:
+    """Make a JPEG of smooth gradients and noise, so clustering has real work.
+
+    Args:
+        size (tuple[int, int]): The (width, height) of the image.
+        seed (int, optional): Seed of the noise. Defaults to 0.
+
+    Returns:
+        bytes: The encoded JPEG.
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width)[None, :]
+    y = np.linspace(0, 1, height)[:, None]
+    channels = [
+        255 * x * np.ones_like(y),
+        255 * y * np.ones_like(x),
+        255 * (0.5 + 0.5 * np.sin(6 * x + 4 * y)),
+    ]
+    image_data = np.stack(channels, axis=-1) + rng.normal(0, 12, (height, width, 3))
+
+    buffer = BytesIO()
+    Image.fromarray(image_data.clip(0, 255).astype(np.uint8)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def make_palette(n_colors: int, seed=0) -> list[tuple]:
+    """Make a palette of random tile colors.
+
+    Args:
+        n_colors (int): The number of colors.
+        seed (int, optional): Seed of the colors. Defaults to 0.
+
+    Returns:
+        list[tuple]: The RGB tuples of the palette.
+    """
+    rng = np.random.default_rng(seed)
+    return [tuple(color) for color in rng.integers(0, 256, (n_colors, 3)).tolist()]
+
+
+def _measure(fn, *args):
+    """Run fn, returning its result, the seconds taken and the peak traced bytes."""
+    tracemalloc.reset_peak()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+    return result, seconds, peak_bytes
+
+
+def run_case(
+    image_data: bytes, pixel_dimensions: int, tile_colors: list[tuple]
+) -> dict:
+    """Run each stage of the pipeline once.
+
+    The decode, downscale, cluster and remap stages are timed by tile_grid
+    itself, see record_stages, with the cluster cache cleared so every run
+    clusters. The grid is then upscaled and encoded as a palettized PNG the
+    way the server renders it, and encoded again with iter_upscaled_png as
+    streamed responses do.
+
+    Args:
+        image_data (bytes): The encoded image.
+        pixel_dimensions (int): The side length of the grid.
+        tile_colors (list[tuple]): The tile colors.
+
+    Returns:
+        dict: The seconds and peak traced bytes of each stage.
+    """
+
+    def encode(image):
+        buffer = BytesIO()
+        image.save(buffer, "PNG")
+        return buffer
+
+    def stream(grid, size):
+        return b"".join(pixelator.iter_upscaled_png(grid, size))
+
+    results = {}
+    pixelator.cluster_cache.clear()
+    tracemalloc.start()
+    try:
+        with pixelator.record_stages() as stages:
+            grid, size = pixelator.tile_grid(image_data, tile_colors, pixel_dimensions)
+        for stage, seconds, peak_bytes in stages:
+            results[stage] = [seconds, peak_bytes]
+
+        upscaled, *results["upscale"] = _measure(pixelator.upscale_grid, grid, size)
+        _, *results["encode"] = _measure(encode, upscaled)
+        _, *results["stream"] = _measure(stream, grid, size)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        stage: {"seconds": seconds, "peak_bytes": peak_bytes}
+        for stage, (seconds, peak_bytes) in results.items()
+    }
+
+
+def run_benchmark(matrix=None, repeats=3) -> dict:
+    """Benchmark every combination of the matrix.
+
+    Args:
+        matrix (dict, optional): Lists of "image_sizes", "pixel_dimensions" and
+        "n_colors". Defaults to DEFAULT_MATRIX.
+        repeats (int, optional): Number of runs of each case. The median time
+        and the maximum peak memory are reported. Defaults to 3.
+
+    Returns:
+        dict: The library versions in "meta", and one entry per case in
+        "results" with its parameters and per-stage timings.
+    """
+    matrix = matrix or DEFAULT_MATRIX
+    results = []
+
+    # Run a small case first so one-time setup costs are not measured
+    run_case(make_test_image((64, 48)), 8, make_palette(4))
+
+    for image_size in matrix["image_sizes"]:
+        image_data = make_test_image(tuple(image_size))
+        cases = itertools.product(matrix["pixel_dimensions"], matrix["n_colors"])
+
+        for pixel_dimensions, n_colors in cases:
+            tile_colors = make_palette(n_colors)
+            runs = [
+                run_case(image_data, pixel_dimensions, tile_colors)
+                for _ in range(repeats)
+            ]
+            stages = {
+                stage: {
+                    "seconds": statistics.median(run[stage]["seconds"] for run in runs),
+                    "peak_bytes": max(run[stage]["peak_bytes"] for run in runs),
+                }
+                for stage in STAGES
+            }
+            results.append(
+                {
+                    "case": case_name(image_size, pixel_dimensions, n_colors),
+                    "image_size": list(image_size),
+                    "pixel_dimensions": pixel_dimensions,
+                    "n_colors": n_colors,
+                    "stages": stages,
+                    "total_seconds": sum(stage["seconds"] for stage in stages.values()),
+                }
+            )
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "scikit-learn": sklearn.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def case_name(image_size, pixel_dimensions: int, n_colors: int) -> str:
+    """Name a benchmark case, e.g. "640x480/25px/4colors"."""
+    return f"{image_size[0]}x{image_size[1]}/{pixel_dimensions}px/{n_colors}colors"
+
+
+def compare_results(
+    current: dict, baseline: dict, threshold=0.2, min_seconds=0.001
+) -> list[dict]:
+    """Find the stages that got slower than the baseline.
+
+    Args:
+        current (dict): Results of run_benchmark.
+        baseline (dict): Earlier results of run_benchmark.
+        threshold (float, optional): Relative slowdown that counts as a
+        regression. Defaults to 0.2, i.e. 20% slower.
+        min_seconds (float, optional): Absolute slowdown below which timings
+        are considered noise. Defaults to 0.001.
+
+    Returns:
+        list[dict]: The case, stage, baseline and current seconds, and their
+        ratio for every regression. Cases missing from either side are skipped.
+    """
+    baseline_cases = {result["case"]: result for result in baseline["results"]}
+    regressions = []
+
+    for result in current["results"]:
+        if result["case"] not in baseline_cases:
+            continue
+
+        baseline_stages = baseline_cases[result["case"]]["stages"]
+        for stage, timing in result["stages"].items():
+            if stage not in baseline_stages:
+                continue
+
+            before = baseline_stages[stage]["seconds"]
+            after = timing["seconds"]
+            if after > before * (1 + threshold) and after - before > min_seconds:
+                regressions.append(
+                    {
+                        "case": result["case"],
+                        "stage": stage,
+                        "baseline_seconds": before,
+                        "current_seconds": after,
+                        "ratio": after / before if before else float("inf"),
+                    }
+                )
+
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Run the benchmark from the command line.
+
+    Returns:
+        int: The exit code, 1 if there are regressions against the baseline.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="run a small matrix")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each case")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative slowdown that counts as a regression (default: 0.2)",
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(QUICK_MATRIX if args.quick else None, args.repeats)
+
+    for result in results["results"]:
+        stages = ", ".join(
+            f"{stage} {timing['seconds'] * 1000:.1f}ms"
+            for stage, timing in result["stages"].items()
+        )
+        print(f"{result['case']}: {result['total_seconds'] * 1000:.1f}ms ({stages})")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['case']} {regression['stage']}: "
+                f"{regression['baseline_seconds'] * 1000:.1f}ms -> "
+                f"{regression['current_seconds'] * 1000:.1f}ms "
+                f"({regression['ratio']:.2f}x)"
+            )
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# pylint: disable=missing-module-docstring
+
+import csv
+import io
+import json
+from typing import Sequence
+
+import numpy as np
+from PIL import Image
+
+from server.colors import rgb_to_hex
+
+
+def bill_of_materials(
+    grid: Image.Image | np.ndarray,
+    tile_colors: Sequence[tuple[int, int, int]] | None = None,
+) -> dict:
+    """Counts the tiles of each tile color needed to build a tile grid.
+
+    The counts are the np.bincount of the palette indices of the grid, which
+    has one value per tile, so they never need a pass over an upscaled image.
+
+    Args:
+        grid (Image.Image | np.ndarray): The "P" mode grid returned by
+        tile_grid, or the (rows, columns) tile color indices returned by
+        tile_array.
+        tile_colors (Sequence[tuple[int, int, int]], optional): The RGB tuples
+        of the tile colors. Defaults to None, which uses the palette of grid;
+        it is required for arrays.
+
+    Returns:
+        dict: The "width" and "height" of the grid, the "total" number of
+        tiles, the "colors" list with the "index", "color" as a hex color code
+        and "count" of each tile color, and the "indices" array of the tile
+        color index at each (row, column) of the grid.
+    """
+    if tile_colors is None:
+        if not isinstance(grid, Image.Image):
+            raise ValueError("tile_colors is required for an array of indices")
+        palette = grid.getpalette()
+        tile_colors = [palette[i : i + 3] for i in range(0, len(palette), 3)]
+
+    indices = np.asarray(grid)
+    counts = np.bincount(indices.ravel(), minlength=len(tile_colors))
+    if len(counts) > len(tile_colors):
+        raise ValueError("grid has indices outside of tile_colors")
+
+    return {
+        "width": indices.shape[1],
+        "height": indices.shape[0],
+        "total": int(indices.size),
+        "colors": [
+            {
+                "index": index,
+                "color": rgb_to_hex(color),
+                "count": int(count),
+            }
+            for index, (color, count) in enumerate(zip(tile_colors, counts))
+        ],
+        "indices": indices,
+    }
+
+
+def bom_to_json(bom: dict) -> str:
+    """Encode a bill of materials as JSON, with the indices as rows of lists."""
+    return json.dumps({**bom, "indices": bom["indices"].tolist()})
+
+
+def bom_to_csv(bom: dict) -> str:
+    """Encode the tile counts of a bill of materials as CSV.
+
+    Returns:
+        str: A header row, then the index, hex color code and count of each
+        tile color, one row each.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["index", "color", "count"])
+    for color in bom["colors"]:
+        writer.writerow([color["index"], color["color"], color["count"]])
+    return buffer.getvalue()
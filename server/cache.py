@@ -0,0 +1,346 @@
+# pylint: disable=missing-module-docstring
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(data: bytes, **params) -> str:
+    """Build a content-addressed cache key.
+
+    Args:
+        data (bytes): The content being processed, e.g. the uploaded image.
+        **params: The parameters the content is processed with. They must be
+        JSON-serializable; tuples and lists are treated the same.
+
+    Returns:
+        str: A hex digest of the content and the normalized parameters.
+    """
+    digest = hashlib.sha256(data)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """A thread-safe in-memory cache that evicts the least recently used entries.
+
+    The cache is bounded by its number of entries and, optionally, by the total
+    size of its values. Values must support len() for the size bound, or be
+    given an explicit size when set.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None):
+        """Create the cache.
+
+        Args:
+            max_entries (int, optional): Maximum number of entries. Defaults to 128.
+            max_bytes (int, optional): Maximum total size of the values.
+            Defaults to None, which does not bound the size.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a value, marking it as the most recently used.
+
+        Args:
+            key: The key of the value.
+            default (optional): Returned if the key is not cached. Defaults to None.
+
+        Returns:
+            The cached value, or default.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def set(self, key, value, size=None):
+        """Add or replace a value, evicting old entries to stay within bounds.
+
+        Args:
+            key: The key of the value.
+            value: The value to cache.
+            size (int, optional): The size of the value. Defaults to len(value)
+            if the cache is bounded by size, and 0 otherwise.
+        """
+        if size is None:
+            size = len(value) if self.max_bytes is not None else 0
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+            # Values larger than the whole cache are not stored
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size)
+            self.size += size
+
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def delete(self, key) -> bool:
+        """Remove a value.
+
+        Args:
+            key: The key of the value.
+
+        Returns:
+            bool: Whether the key was cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self.size -= self._entries.pop(key)[1]
+            return True
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Get the cache counters.
+
+        Returns:
+            dict: The number of hits, misses, entries and the total size.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "bytes": self.size,
+        }
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache:
+    """A cache of bytes values stored as files in a directory.
+
+    The cache is bounded by the total size of its files. When it grows past
+    max_bytes, the least recently used files are removed first. Files older
+    than ttl seconds are treated as missing and removed.
+    """
+
+    def __init__(self, directory: str, max_bytes=1024**3, ttl=None):
+        """Create the cache, and its directory if necessary.
+
+        Args:
+            directory (str): The directory to store the files in.
+            max_bytes (int, optional): Maximum total size of the files.
+            Defaults to 1 GiB.
+            ttl (float, optional): Maximum age of a file in seconds.
+            Defaults to None, which keeps files until they are evicted.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str, default=None):
+        """Get a value, marking it as the most recently used.
+
+        Args:
+            key (str): The key of the value. It must be a valid file name.
+            default (optional): Returned if the key is not cached. Defaults to None.
+
+        Returns:
+            bytes: The cached value, or default.
+        """
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+
+            with open(path, "rb") as file:
+                value = file.read()
+
+            # Record the access time for the eviction order
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes):
+        """Add or replace a value, evicting old files to stay within bounds.
+
+        Args:
+            key (str): The key of the value. It must be a valid file name.
+            value (bytes): The value to cache.
+        """
+        if len(value) > self.max_bytes:
+            return
+
+        # Write to a temporary file first so readers never see a partial file
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(value)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """Remove expired files, then the least recently used ones over the size bound."""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                files.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Remove every file and reset the counters."""
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                self._remove(entry.path)
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Get the cache counters.
+
+        Returns:
+            dict: The number of hits, misses, files and their total size.
+        """
+        sizes = [
+            entry.stat().st_size
+            for entry in os.scandir(self.directory)
+            if not entry.name.endswith(".tmp")
+        ]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(sizes),
+            "bytes": sum(sizes),
+        }
+
+
+class ResultCache:
+    """A two-tier cache of bytes values: in memory, then optionally on disk.
+
+    Values found on disk are promoted to the memory tier.
+    """
+
+    def __init__(
+        self,
+        max_entries=64,
+        max_bytes=256 * 1024**2,
+        directory=None,
+        disk_max_bytes=1024**3,
+        ttl=None,
+    ):
+        """Create the cache.
+
+        Args:
+            max_entries (int, optional): Maximum number of entries in memory.
+            Defaults to 64.
+            max_bytes (int, optional): Maximum total size in memory.
+            Defaults to 256 MiB.
+            directory (str, optional): Directory of the disk tier.
+            Defaults to None, which disables the disk tier.
+            disk_max_bytes (int, optional): Maximum total size on disk.
+            Defaults to 1 GiB.
+            ttl (float, optional): Maximum age of a file on disk in seconds.
+            Defaults to None, which keeps files until they are evicted.
+        """
+        self.memory = LRUCache(max_entries, max_bytes)
+        self.disk = DiskCache(directory, disk_max_bytes, ttl) if directory else None
+
+    def get(self, key: str, default=None):
+        """Get a value from the first tier that has it.
+
+        Args:
+            key (str): The key of the value.
+            default (optional): Returned if the key is not cached. Defaults to None.
+
+        Returns:
+            bytes: The cached value, or default.
+        """
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return default if value is None else value
+
+    def set(self, key: str, value: bytes):
+        """Add a value to every tier.
+
+        Args:
+            key (str): The key of the value.
+            value (bytes): The value to cache.
+        """
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        """Remove every entry from every tier."""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        """Get the counters of every tier.
+
+        Returns:
+            dict: The counters of the memory tier, and of the disk tier if enabled.
+        """
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
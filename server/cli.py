@@ -0,0 +1,409 @@
+"""Tile many images from the command line.
+
+Takes image files, directories of images, or glob patterns, and writes one
+tiled PNG per image to the output directory, using a pool of worker processes:
+
+    python -m server.pixelator photos/ "more/**/*.jpg" --output tiled -n 60
+
+The name of every output includes a hash of its input and parameters, so
+running the same command again skips the images that are already done. With
+--bom csv or --bom json, the bill of materials of every image, the number of
+tiles of each color and the color of each tile, is written next to its PNG.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import as_completed
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from server.bom import bill_of_materials, bom_to_csv, bom_to_json
+from server.cache import make_key
+from server.pixelator import (
+    COLOR_SPACES,
+    DITHERS,
+    MATCHES,
+    MAX_CLUSTERS,
+    MAX_OUTPUT_PIXELS,
+    QUANTIZERS,
+    default_tile_colors,
+    tile_grid,
+    upscale_grid,
+)
+from server.workers import WorkerPool
+
+IMAGE_EXTENSIONS = (".bmp", ".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp")
+
+
+def find_images(inputs: list[str]) -> list[str]:
+    """Find the image files of the inputs.
+
+    Args:
+        inputs (list[str]): Image files, directories whose images are included,
+        or glob patterns, which can use ** to match subdirectories.
+
+    Returns:
+        list[str]: The paths of the images, without duplicates, in order.
+    """
+    paths = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                paths.extend(
+                    os.path.join(match, name)
+                    for name in sorted(os.listdir(match))
+                    if name.lower().endswith(IMAGE_EXTENSIONS)
+                )
+            elif os.path.isfile(match):
+                paths.append(match)
+
+    return list(dict.fromkeys(paths))
+
+
+def parse_colors(value: str) -> list[tuple[int, int, int]]:
+    """Parse comma-separated hex colors, e.g. "#FF0000,#000000".
+
+    Raises:
+        argparse.ArgumentTypeError: If a color is not a 6 digit hex code.
+    """
+    colors = []
+    for color in value.split(","):
+        color = color.strip().lstrip("#")
+        try:
+            if len(color) != 6:
+                raise ValueError
+            colors.append(tuple(int(color[i : i + 2], 16) for i in (0, 2, 4)))
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(
+                f"invalid hex color {color!r}, expected e.g. #FF0000"
+            ) from exc
+    return colors
+
+
+def parse_grid(value: str):
+    """Parse a grid of "auto" or COLUMNSxROWS.
+
+    Raises:
+        argparse.ArgumentTypeError: If the grid is invalid.
+    """
+    if value == "auto":
+        return value
+    try:
+        columns, rows = (int(side) for side in value.lower().split("x"))
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError('grid must be "auto" or COLUMNSxROWS') from exc
+    return (columns, rows)
+
+
+def parse_scale(value: str) -> int:
+    """Parse a tile size in pixels, a positive integer.
+
+    Raises:
+        argparse.ArgumentTypeError: If the size is invalid.
+    """
+    try:
+        scale = int(value)
+        if scale < 1:
+            raise ValueError
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError("scale must be a positive integer") from exc
+    return scale
+
+
+def parse_clusters(value: str):
+    """Parse a cluster count of "auto" or a positive integer up to MAX_CLUSTERS.
+
+    Raises:
+        argparse.ArgumentTypeError: If the count is invalid.
+    """
+    if value == "auto":
+        return value
+    try:
+        clusters = int(value)
+        if clusters < 1:
+            raise ValueError
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(
+            'clusters must be "auto" or a positive integer'
+        ) from exc
+    if clusters > MAX_CLUSTERS:
+        raise argparse.ArgumentTypeError(f"clusters can be at most {MAX_CLUSTERS}")
+    return clusters
+
+
+def parse_inventory(value: str) -> list[int]:
+    """Parse comma-separated tile counts, one per tile color, e.g. "500,120".
+
+    Raises:
+        argparse.ArgumentTypeError: If a count is not a non-negative integer.
+    """
+    try:
+        inventory = [int(count) for count in value.split(",")]
+        if min(inventory) < 0:
+            raise ValueError
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(
+            "inventory must be comma-separated non-negative integers"
+        ) from exc
+    return inventory
+
+
+def output_path(path: str, data: bytes, params: dict, output_dir: str) -> str:
+    """Get the output path of an image, named after its content and parameters.
+
+    Args:
+        path (str): The path of the image.
+        data (bytes): The content of the image.
+        params (dict): The keyword arguments of tile_image.
+        output_dir (str): The directory of the outputs.
+
+    Returns:
+        str: The path of the tiled PNG.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, f"{stem}-{make_key(data, **params)[:12]}.png")
+
+
+def bom_path(destination: str, bom: str) -> str:
+    """Get the path of the bill of materials of an output, in the bom format."""
+    return f"{os.path.splitext(destination)[0]}.{bom}"
+
+
+def write_atomic(destination: str, write):
+    """Write a file through a temporary file, so an interrupted run never leaves
+    a partial output behind.
+
+    Args:
+        destination (str): The path of the file.
+        write: Called with the path of the temporary file to write.
+    """
+    temporary = f"{destination}.{os.getpid()}.tmp"
+    try:
+        write(temporary)
+        os.replace(temporary, destination)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def tile_file(path: str, destination: str, params: dict, bom=None) -> str:
+    """Tile an image file and write the result as a PNG.
+
+    Args:
+        path (str): The path of the image.
+        destination (str): The path to write the PNG to.
+        params (dict): The keyword arguments of tile_grid.
+        bom (str, optional): "csv" or "json" to also write the bill of
+        materials of the grid, see bom_path. Defaults to None.
+
+    Returns:
+        str: The destination.
+    """
+    tiles, size = tile_grid(path, **params)
+
+    if bom is not None:
+        materials = bill_of_materials(tiles)
+        text = bom_to_csv(materials) if bom == "csv" else bom_to_json(materials)
+
+        def write_bom(temporary: str):
+            with open(temporary, "w", encoding="utf-8") as file:
+                file.write(text)
+
+        write_atomic(bom_path(destination, bom), write_bom)
+
+    tiled = upscale_grid(tiles, size)
+    write_atomic(destination, lambda temporary: tiled.save(temporary, format="PNG"))
+    return destination
+
+
+def format_progress(done: int, total: int, seconds: float, width=30) -> str:
+    """Format a progress bar, e.g. "[######------] 12/30 2.4 images/s"."""
+    filled = width * done // total if total else width
+    rate = done / seconds if seconds > 0 else 0.0
+    return (
+        f"[{'#' * filled}{'-' * (width - filled)}] {done}/{total} {rate:.1f} images/s"
+    )
+
+
+def main(argv=None) -> int:
+    """Run the command line tool.
+
+    Returns:
+        int: The exit code, 1 if an image failed or no images were found.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="image files, directories or globs")
+    parser.add_argument(
+        "-o", "--output", default="tiled", help="output directory (default: tiled)"
+    )
+    parser.add_argument(
+        "-c",
+        "--colors",
+        type=parse_colors,
+        default=list(default_tile_colors),
+        help="comma-separated hex tile colors (default: red, black, gray, white)",
+    )
+    parser.add_argument(
+        "-n",
+        "--pixel-dimensions",
+        type=int,
+        default=50,
+        help="side length of the grid in tiles (default: 50)",
+    )
+    parser.add_argument(
+        "--grid", type=parse_grid, help='"auto" or COLUMNSxROWS (default: square)'
+    )
+    parser.add_argument(
+        "--quantizer",
+        choices=[*QUANTIZERS, "direct"],
+        default="kmeans",
+        help="color clustering backend (default: kmeans)",
+    )
+    parser.add_argument(
+        "--color-space",
+        choices=list(COLOR_SPACES),
+        default="rgb",
+        help="(default: rgb)",
+    )
+    parser.add_argument(
+        "--dither", choices=DITHERS, default="none", help="(default: none)"
+    )
+    parser.add_argument(
+        "--scale",
+        type=parse_scale,
+        help="tile size in pixels (default: the original size)",
+    )
+    parser.add_argument(
+        "--clusters",
+        type=parse_clusters,
+        help='number of color clusters, or "auto" (default: one per tile color)',
+    )
+    parser.add_argument(
+        "--match",
+        choices=MATCHES,
+        default="unique",
+        help="use each tile color for at most one cluster, or the nearest "
+        "(default: unique)",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=parse_inventory,
+        help="comma-separated number of tiles of each tile color",
+    )
+    parser.add_argument(
+        "--bom",
+        choices=("csv", "json"),
+        help="also write the tile counts of each image in this format",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes, or 0 to run in this process (default: CPU count)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="process images whose output exists"
+    )
+    args = parser.parse_args(argv)
+    if args.inventory is not None and len(args.inventory) != len(args.colors):
+        parser.error("--inventory must have one count per tile color")
+    if args.scale is not None:
+        columns, rows = (
+            args.grid
+            if isinstance(args.grid, tuple)
+            else (args.pixel_dimensions, args.pixel_dimensions)
+        )
+        if columns * rows * args.scale**2 > MAX_OUTPUT_PIXELS:
+            parser.error(f"the grid at this --scale exceeds {MAX_OUTPUT_PIXELS} pixels")
+
+    params = {
+        "tile_colors": args.colors,
+        "pixel_dimensions": args.pixel_dimensions,
+        "grid": args.grid,
+        "quantizer": args.quantizer,
+        "color_space": args.color_space,
+        "dither": args.dither,
+        "output_scale": args.scale,
+        "n_clusters": args.clusters,
+        "match": args.match,
+        "inventory": args.inventory,
+    }
+
+    paths = find_images(args.inputs)
+    if not paths:
+        print("No images found", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+
+    # Skip the images whose output already exists
+    tasks = []
+    for path in paths:
+        with open(path, "rb") as file:
+            destination = output_path(path, file.read(), params, args.output)
+        done = os.path.exists(destination) and (
+            args.bom is None or os.path.exists(bom_path(destination, args.bom))
+        )
+        if args.force or not done:
+            tasks.append((path, destination))
+    skipped = len(paths) - len(tasks)
+
+    # Spawn and warm up the workers before timing the images
+    pool = None
+    if args.workers > 0:
+        pool = WorkerPool(
+            workers=min(args.workers, len(tasks) or 1), max_queue=len(tasks)
+        )
+        pool.start()
+
+    start = time.perf_counter()
+    failures = []
+
+    def report(done: int):
+        print(
+            "\r" + format_progress(done, len(tasks), time.perf_counter() - start),
+            end="",
+            file=sys.stderr,
+        )
+
+    report(0)
+    if pool is None:
+        for done, (path, destination) in enumerate(tasks, 1):
+            try:
+                tile_file(path, destination, params, args.bom)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                failures.append((path, e))
+            report(done)
+    else:
+        try:
+            futures = {
+                pool.submit(tile_file, path, destination, params, args.bom): path
+                for path, destination in tasks
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                if future.exception() is not None:
+                    failures.append((futures[future], future.exception()))
+                report(done)
+        finally:
+            pool.shutdown()
+    print(file=sys.stderr)
+
+    seconds = time.perf_counter() - start
+    for path, error in failures:
+        print(f"FAILED {path}: {error}", file=sys.stderr)
+
+    processed = len(tasks) - len(failures)
+    rate = processed / seconds if seconds > 0 else 0.0
+    print(
+        f"Tiled {processed} images in {seconds:.1f}s ({rate:.2f} images/s), "
+        f"skipped {skipped} already done, {len(failures)} failed"
+    )
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
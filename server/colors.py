@@ -0,0 +1,25 @@
+# pylint: disable=missing-module-docstring
+
+
+def hex_to_rgb(hex_color: str) -> tuple:
+    """Convert a hex color code to an RGB tuple.
+
+    Args:
+        hex_color (str): A hex color code without the octothorpe (e.g., "FF0000").
+
+    Returns:
+        tuple: An RGB tuple (e.g., (255, 0, 0)).
+    """
+    return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
+
+
+def rgb_to_hex(rgb_color) -> str:
+    """Convert an RGB tuple to a hex color code.
+
+    Args:
+        rgb_color (tuple): An RGB tuple (e.g., (255, 0, 0)).
+
+    Returns:
+        str: A hex color code with the octothorpe (e.g., "#FF0000").
+    """
+    return "#" + "".join(f"{int(channel):02X}" for channel in rgb_color)
@@ -0,0 +1,22 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=invalid-name
+
+import sys
+
+# Gunicorn configuration, loaded automatically when gunicorn is started from
+# this directory, e.g. with `gunicorn app:app`.
+
+# Import the app once in the master process, so every worker starts with it
+# already imported
+preload_app = True
+
+
+def post_fork(_server, worker):
+    """Warm up each worker in the background after it is forked.
+
+    The clustering backends start thread pools that must not be shared across
+    a fork, so the warm-up runs in the workers rather than in the master.
+    Until it finishes, /readyz reports the worker as warming up.
+    """
+    app = worker.app.wsgi()
+    sys.modules[app.import_name].start_warm_up()
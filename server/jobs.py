@@ -0,0 +1,216 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=broad-exception-caught
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from server.workers import PoolFullError
+
+# The stages a job goes through, in order
+STAGES = (
+    "queued",
+    "decode",
+    "downscale",
+    "cluster",
+    "remap",
+    "upscale",
+    "encode",
+    "done",
+)
+
+
+class JobStore:
+    """An in-process queue of background jobs with pollable status and results.
+
+    Jobs run on a thread pool. While running, a job reports the pipeline stage
+    it has reached through the progress callback it is given. Finished jobs are
+    kept until more than max_jobs jobs exist, or their results take more than
+    max_bytes, oldest first.
+    """
+
+    def __init__(
+        self, max_workers=2, max_pending=64, max_jobs=256, max_bytes=None, size=len
+    ):
+        """Create the store.
+
+        Args:
+            max_workers (int, optional): Number of jobs run at once. Defaults to 2.
+            max_pending (int, optional): Maximum number of queued and running
+            jobs. Defaults to 64.
+            max_jobs (int, optional): Maximum number of jobs kept, including
+            finished ones. Defaults to 256.
+            max_bytes (int, optional): Maximum total size of the results kept.
+            Defaults to None, which does not bound the size.
+            size (optional): Function giving the size of a result. Defaults to
+            len.
+        """
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._size = size
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+
+    def submit(self, fn, *args, **kwargs) -> str:
+        """Queue a job.
+
+        Args:
+            fn: The function to run. It is called with a progress keyword
+            argument, a callback taking the name of the stage it has reached.
+            Its return value is the result of the job.
+            *args: Positional arguments of fn.
+            **kwargs: Keyword arguments of fn.
+
+        Returns:
+            str: The id of the job.
+
+        Raises:
+            PoolFullError: If max_pending jobs are already queued or running.
+        """
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "stage": "queued",
+            "error": None,
+            "created": time.time(),
+            "finished": None,
+            "result": None,
+            "size": 0,
+        }
+
+        with self._lock:
+            pending = sum(
+                other["status"] in ("queued", "running")
+                for other in self._jobs.values()
+            )
+            if pending >= self.max_pending:
+                raise PoolFullError("The job queue is full")
+
+            self._jobs[job["id"]] = job
+            self._evict()
+
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job["id"]
+
+    def add_result(self, result) -> str:
+        """Add a job that is already done, e.g. because its result was cached.
+
+        Args:
+            result: The result of the job.
+
+        Returns:
+            str: The id of the job.
+        """
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "done",
+            "stage": "done",
+            "error": None,
+            "created": time.time(),
+            "finished": time.time(),
+            "result": result,
+            "size": self._result_size(result),
+        }
+
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self.size += job["size"]
+            self._evict()
+
+        return job["id"]
+
+    def _run(self, job: dict, fn, args, kwargs):
+        def progress(stage: str):
+            # Stages forwarded from a worker process may arrive late
+            if job["status"] == "running":
+                job["stage"] = stage
+
+        job["status"] = "running"
+        try:
+            result = fn(*args, progress=progress, **kwargs)
+        except Exception as e:
+            job.update(status="failed", error=str(e), finished=time.time())
+        else:
+            size = self._result_size(result)
+            with self._lock:
+                job.update(
+                    status="done",
+                    stage="done",
+                    result=result,
+                    size=size,
+                    finished=time.time(),
+                )
+                self.size += size
+                self._evict()
+
+    def _result_size(self, result) -> int:
+        return self._size(result) if self.max_bytes is not None else 0
+
+    def _evict(self):
+        """Remove the oldest finished jobs while over max_jobs or max_bytes."""
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_jobs and (
+                self.max_bytes is None or self.size <= self.max_bytes
+            ):
+                break
+            if self._jobs[job_id]["status"] in ("done", "failed"):
+                self.size -= self._jobs.pop(job_id)["size"]
+
+    def status(self, job_id: str) -> dict | None:
+        """Get the status of a job.
+
+        Args:
+            job_id (str): The id of the job.
+
+        Returns:
+            dict | None: The id, status ("queued", "running", "done" or
+            "failed"), current stage, fraction of stages completed, error,
+            and creation and finish times of the job, or None if it is unknown.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        status = {
+            key: value for key, value in job.items() if key not in ("result", "size")
+        }
+        if job["stage"] in STAGES:
+            status["progress"] = STAGES.index(job["stage"]) / (len(STAGES) - 1)
+        else:
+            status["progress"] = None
+        return status
+
+    def result(self, job_id: str):
+        """Get the result of a finished job.
+
+        Args:
+            job_id (str): The id of the job.
+
+        Returns:
+            The result of the job, or None if it is unknown or not done.
+        """
+        job = self._jobs.get(job_id)
+        return job["result"] if job else None
+
+    def stats(self) -> dict:
+        """Get the number of jobs and the size of their results.
+
+        Returns:
+            dict: The number of jobs kept, of those queued or running, and the
+            total size of the results kept.
+        """
+        jobs = list(self._jobs.values())
+        return {
+            "jobs": len(jobs),
+            "pending": sum(job["status"] in ("queued", "running") for job in jobs),
+            "bytes": self.size,
+        }
+
+    def shutdown(self):
+        """Stop running jobs after the current ones finish."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,167 @@
+# pylint: disable=missing-module-docstring
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names: tuple, values: tuple, extra="") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A metric with a value per combination of label values."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels=(), function=None):
+        """Create the metric.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labels (tuple, optional): The label names. Defaults to none.
+            function (optional): Called at render time instead of using the
+            recorded values, returning the value, or a dictionary mapping tuples
+            of label values to values. Defaults to None.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _current(self) -> dict:
+        """Get the value of each combination of label values."""
+        if self.function is None:
+            with self._lock:
+                return dict(self._values)
+
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return {
+            tuple(str(label) for label in key): value for key, value in values.items()
+        }
+
+    def _samples(self):
+        """Yield the (suffix, label values, extra label, value) of each sample."""
+        for key, value in self._current().items():
+            yield "", key, "", value
+
+    def render(self) -> str:
+        """Render the metric in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, values, extra, value in self._samples():
+            labels = _format_labels(self.labels, values, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A value that only increases, such as a number of requests.
+
+    By convention the name of a counter ends with _total.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter of the given label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, such as a queue depth."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        """Set the gauge of the given label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Counts of observed values in cumulative buckets, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS
+    ):
+        """Create the histogram.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labels (tuple, optional): The label names. Defaults to none.
+            buckets (tuple, optional): The upper bounds of the buckets, in
+            increasing order. Defaults to DEFAULT_BUCKETS, suited to seconds.
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        """Record a value for the given label values."""
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()
+            }
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", key, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", key, "", total
+            yield "_count", key, "", cumulative
+
+
+class Registry:
+    """A set of metrics rendered together for a /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add a metric to the registry.
+
+        Returns:
+            The metric, so it can be created and registered in one statement.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
@@ -1,14 +1,31 @@
 # pylint: disable=missing-module-docstring
 # pylint: disable=no-member
 # pylint: disable=protected-access
+# pylint: disable=import-outside-toplevel
 
-import itertools
-from math import inf
+import contextvars
+import functools
+import logging
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from io import BytesIO
+from typing import BinaryIO, Callable, Iterable, Iterator, Sequence
 
 import numpy as np
-from PIL import Image
-from scipy.spatial.distance import cdist
-from sklearn.cluster import KMeans
+from PIL import Image, ImageSequence
+
+# scikit-learn and SciPy are imported where they are used, so importing this
+# module stays fast on a cold start. warm_up() imports them ahead of time.
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from server.bom import bill_of_materials
+from server.cache import LRUCache, make_key
 
 default_tile_colors = (
     (255, 0, 0),  # Red
@@ -17,156 +34,2052 @@ default_tile_colors = (
     (255, 255, 255),  # White
 )
 
+# Maximum number of tile colors, so every tile color index fits in a uint8 and a
+# PNG palette
+MAX_TILE_COLORS = 256
+
+# The largest output the server and command line upscale a grid to with a tile
+# scale, Pillow's limit for decompression bombs
+MAX_OUTPUT_PIXELS = Image.MAX_IMAGE_PIXELS or 89_478_485
+
+# Clusters of recently pixelated images, so a new palette with the same number
+# of colors does not need to cluster the same grid again
+cluster_cache = LRUCache(max_entries=256, max_bytes=64 * 1024**2)
+
+# Functions called with the name, duration in seconds, and peak traced memory in
+# bytes (None unless allocation tracing is on) of every pipeline stage
+stage_hooks: list[Callable[[str, float, int | None], None]] = []
+_stage_records = contextvars.ContextVar("stage_records", default=None)
+
+logger = logging.getLogger(__name__)
+
+if os.environ.get("PIXELATOR_TRACE_ALLOCATIONS") == "1":
+    tracemalloc.start()
+
+if os.environ.get("PIXELATOR_LOG_STAGES") == "1":
+    stage_hooks.append(
+        lambda name, seconds, peak_bytes: logger.info(
+            "stage %s took %.1fms (peak %s bytes)", name, seconds * 1000, peak_bytes
+        )
+    )
+
+
+def record_stage(name: str, seconds: float, peak_bytes: int | None = None):
+    """Reports a finished pipeline stage to the stage hooks and record_stages.
+
+    Args:
+        name (str): The name of the stage.
+        seconds (float): How long the stage took.
+        peak_bytes (int | None, optional): The peak traced memory of the stage.
+        Defaults to None.
+    """
+    records = _stage_records.get()
+    if records is not None:
+        records.append((name, seconds, peak_bytes))
+    for hook in stage_hooks:
+        hook(name, seconds, peak_bytes)
+
+
+@contextmanager
+def record_stages() -> Iterator[list[tuple[str, float, int | None]]]:
+    """Collects the pipeline stages that finish in the current context.
+
+    Yields:
+        list[tuple[str, float, int | None]]: The name, seconds and peak traced
+        bytes of each stage, appended to as the stages finish.
+    """
+    records = []
+    token = _stage_records.set(records)
+    try:
+        yield records
+    finally:
+        _stage_records.reset(token)
+
+
+class StageTimer:
+    """Times consecutive stages of the pipeline and reports them with record_stage.
+
+    Starting a stage finishes the previous one. Allocations are only measured
+    when tracemalloc is tracing, e.g. with PIXELATOR_TRACE_ALLOCATIONS=1.
+    Concurrent requests share the tracemalloc peak, so it is approximate.
+    """
+
+    def __init__(self, progress: Callable[[str], None] | None = None):
+        """Create the timer.
+
+        Args:
+            progress (optional): Called with the name of each stage as it starts.
+            Defaults to None.
+        """
+        self.progress = progress
+        self._stage = None
+        self._start = 0.0
+        self._start_bytes = 0
+
+    def start(self, name: str):
+        """Finish the current stage, if any, and start the next one."""
+        self.finish()
+        if self.progress:
+            self.progress(name)
+
+        self._stage = name
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._start_bytes = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+
+    def finish(self):
+        """Finish the current stage, if any."""
+        if self._stage is None:
+            return
+
+        seconds = time.perf_counter() - self._start
+        peak_bytes = None
+        if tracemalloc.is_tracing():
+            peak_bytes = tracemalloc.get_traced_memory()[1] - self._start_bytes
+
+        name, self._stage = self._stage, None
+        record_stage(name, seconds, peak_bytes)
+
+
+def rgb_to_lab(colors: np.ndarray) -> np.ndarray:
+    """Converts sRGB colors to CIELAB under the D65 white point.
+
+    Args:
+        colors (np.ndarray): An array of RGB colors with 0-255 channels, with
+        the channels in the last axis.
+
+    Returns:
+        np.ndarray: The L*, a* and b* of each color.
+    """
+    xyz = _srgb_to_linear(colors) @ _SRGB_TO_XYZ.T / _D65_WHITE
+    epsilon = (6 / 29) ** 3
+    f = np.where(xyz > epsilon, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack(
+        [
+            116 * f[..., 1] - 16,
+            500 * (f[..., 0] - f[..., 1]),
+            200 * (f[..., 1] - f[..., 2]),
+        ],
+        axis=-1,
+    )
+
+
+def rgb_to_oklab(colors: np.ndarray) -> np.ndarray:
+    """Converts sRGB colors to Oklab.
+
+    Args:
+        colors (np.ndarray): An array of RGB colors with 0-255 channels, with
+        the channels in the last axis.
+
+    Returns:
+        np.ndarray: The L, a and b of each color.
+    """
+    lms = np.cbrt(_srgb_to_linear(colors) @ _SRGB_TO_LMS.T)
+    return lms @ _LMS_TO_OKLAB.T
+
+
+def _srgb_to_linear(colors: np.ndarray) -> np.ndarray:
+    """Converts 0-255 sRGB channels to linear 0-1 channels."""
+    channels = np.asarray(colors, dtype=float) / 255
+    return np.where(
+        channels <= 0.04045, channels / 12.92, ((channels + 0.055) / 1.055) ** 2.4
+    )
+
+
+_SRGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+_SRGB_TO_LMS = np.array(
+    [
+        [0.4122214708, 0.5363325363, 0.0514459929],
+        [0.2119034982, 0.6806995451, 0.1073969566],
+        [0.0883024619, 0.2817188376, 0.6299787005],
+    ]
+)
+_LMS_TO_OKLAB = np.array(
+    [
+        [0.2104542553, 0.7936177850, -0.0040720468],
+        [1.9779984951, -2.4285922050, 0.4505937099],
+        [0.0259040371, 0.7827717662, -0.8086757660],
+    ]
+)
+
+# Converters from sRGB to the color spaces colors can be clustered and matched in
+COLOR_SPACES = {
+    "rgb": lambda colors: np.asarray(colors, dtype=float),
+    "lab": rgb_to_lab,
+    "oklab": rgb_to_oklab,
+}
+
+
+def delta_e_2000(lab_1: np.ndarray, lab_2: np.ndarray, pairwise=True) -> np.ndarray:
+    """Computes the CIEDE2000 color difference between every pair of colors.
+
+    Args:
+        lab_1 (np.ndarray): An (n, 3) array of CIELAB colors.
+        lab_2 (np.ndarray): An (m, 3) array of CIELAB colors.
+        pairwise (bool, optional): Whether to compare every color of lab_1 with
+        every color of lab_2. If False, the arrays of shape (..., 3) are
+        compared element by element, with broadcasting. Defaults to True.
+
+    Returns:
+        np.ndarray: The (n, m) array of color differences, or the differences
+        of the broadcast shape of lab_1 and lab_2 without its last axis.
+    """
+    lab_1, lab_2 = np.asarray(lab_1, float), np.asarray(lab_2, float)
+    if pairwise:
+        lab_1, lab_2 = lab_1[:, None], lab_2[None, :]
+    l_1, a_1, b_1 = np.moveaxis(lab_1, -1, 0)
+    l_2, a_2, b_2 = np.moveaxis(lab_2, -1, 0)
+
+    # Stretch the a* axis of low chroma colors
+    c_mean = (np.hypot(a_1, b_1) + np.hypot(a_2, b_2)) / 2
+    g = 0.5 * (1 - np.sqrt(c_mean**7 / (c_mean**7 + 25.0**7)))
+    a_1, a_2 = a_1 * (1 + g), a_2 * (1 + g)
+    c_1, c_2 = np.hypot(a_1, b_1), np.hypot(a_2, b_2)
+    h_1 = np.degrees(np.arctan2(b_1, a_1)) % 360
+    h_2 = np.degrees(np.arctan2(b_2, a_2)) % 360
+    chromatic = c_1 * c_2 != 0
+
+    # Differences in lightness, chroma and hue
+    delta_l = l_2 - l_1
+    delta_c = c_2 - c_1
+    delta_h = h_2 - h_1
+    delta_h = np.where(delta_h > 180, delta_h - 360, delta_h)
+    delta_h = np.where(delta_h < -180, delta_h + 360, delta_h)
+    delta_h = np.where(chromatic, delta_h, 0)
+    delta_h = 2 * np.sqrt(c_1 * c_2) * np.sin(np.radians(delta_h / 2))
+
+    # Means of the pair, with the mean hue taken around the shorter arc
+    l_mean = (l_1 + l_2) / 2
+    c_mean = (c_1 + c_2) / 2
+    h_mean = (h_1 + h_2) / 2
+    h_mean = np.where(
+        np.abs(h_1 - h_2) > 180,
+        np.where(h_mean < 180, h_mean + 180, h_mean - 180),
+        h_mean,
+    )
+    h_mean = np.where(chromatic, h_mean, h_1 + h_2)
+
+    # Weighting functions
+    t = (
+        1
+        - 0.17 * np.cos(np.radians(h_mean - 30))
+        + 0.24 * np.cos(np.radians(2 * h_mean))
+        + 0.32 * np.cos(np.radians(3 * h_mean + 6))
+        - 0.20 * np.cos(np.radians(4 * h_mean - 63))
+    )
+    s_l = 1 + 0.015 * (l_mean - 50) ** 2 / np.sqrt(20 + (l_mean - 50) ** 2)
+    s_c = 1 + 0.045 * c_mean
+    s_h = 1 + 0.015 * c_mean * t
+    rotation = (
+        -2
+        * np.sqrt(c_mean**7 / (c_mean**7 + 25.0**7))
+        * np.sin(np.radians(60 * np.exp(-(((h_mean - 275) / 25) ** 2))))
+    )
+
+    return np.sqrt(
+        (delta_l / s_l) ** 2
+        + (delta_c / s_c) ** 2
+        + (delta_h / s_h) ** 2
+        + rotation * (delta_c / s_c) * (delta_h / s_h)
+    )
+
+
+def color_distances(
+    colors_1: np.ndarray, colors_2: np.ndarray, color_space="rgb"
+) -> np.ndarray:
+    """Computes the distance between every pair of colors in a color space.
+
+    Args:
+        colors_1 (np.ndarray): An (n, 3) array of colors in the color space.
+        colors_2 (np.ndarray): An (m, 3) array of colors in the color space.
+        color_space (str, optional): The color space, see COLOR_SPACES. Colors
+        are compared with CIEDE2000 in "lab", and Euclidean distance otherwise.
+        Defaults to "rgb".
+
+    Returns:
+        np.ndarray: The (n, m) array of distances.
+    """
+    if color_space == "lab":
+        return delta_e_2000(colors_1, colors_2)
+    from scipy.spatial.distance import cdist
+
+    return cdist(colors_1, colors_2, metric="euclidean")
+
+
+@functools.lru_cache(maxsize=256)
+def convert_palette(palette: tuple[tuple[int, int, int]], color_space="rgb"):
+    """Converts a palette to a color space, caching the result.
+
+    Requests tend to reuse a handful of palettes, so their conversion is cached.
+
+    Args:
+        palette (tuple[tuple[int, int, int]]): The RGB tuples of the palette.
+        color_space (str, optional): The color space, see COLOR_SPACES.
+        Defaults to "rgb".
+
+    Returns:
+        np.ndarray: The read-only (n, 3) array of converted colors.
+    """
+    colors = COLOR_SPACES[color_space](np.array(palette, dtype=float).reshape(-1, 3))
+    colors.flags.writeable = False
+    return colors
+
+
+@functools.lru_cache(maxsize=32)
+def palette_index(palette: tuple[tuple[int, int, int]], color_space="rgb"):
+    """Builds a KD-tree over a palette in a color space, caching the result.
+
+    Args:
+        palette (tuple[tuple[int, int, int]]): The RGB tuples of the palette.
+        color_space (str, optional): The color space, see COLOR_SPACES.
+        Defaults to "rgb".
+
+    Returns:
+        cKDTree: The tree of the converted colors, by Euclidean distance.
+    """
+    from scipy.spatial import cKDTree
+
+    return cKDTree(convert_palette(palette, color_space))
+
+
+# Number of nearest colors by Euclidean distance in CIELAB that nearest_colors
+# compares with CIEDE2000
+LAB_CANDIDATES = 32
+
+# Number of colors nearest_colors compares with CIEDE2000 at once, which bounds
+# the size of its temporaries
+LAB_CHUNK = 4096
+
+
+def nearest_colors(
+    colors: np.ndarray, palette: Sequence[tuple[int, int, int]], color_space="rgb"
+) -> np.ndarray:
+    """Finds the nearest palette color of every color, using palette_index.
+
+    Searching the tree takes time logarithmic in the size of the palette, so
+    this suits large palettes. CIEDE2000 is not a distance a KD-tree can
+    search, so in "lab" the LAB_CANDIDATES nearest colors by Euclidean
+    distance are compared with CIEDE2000 instead. This is exact for palettes of
+    up to LAB_CANDIDATES colors.
+
+    Args:
+        colors (np.ndarray): An (n, 3) array of RGB colors.
+        palette (Sequence[tuple[int, int, int]]): The RGB tuples of the palette.
+        color_space (str, optional): The color space distances are measured in,
+        see color_distances. Defaults to "rgb".
+
+    Returns:
+        np.ndarray: The index of the nearest palette color of every color.
+    """
+    palette = tuple(map(tuple, palette))
+    converted = COLOR_SPACES[color_space](np.asarray(colors, float).reshape(-1, 3))
+    tree = palette_index(palette, color_space)
+    if color_space != "lab":
+        return tree.query(converted)[1]
+
+    k = min(len(palette), LAB_CANDIDATES)
+    lab_palette = convert_palette(palette, "lab")
+    nearest = np.empty(len(converted), dtype=np.intp)
+    for start in range(0, len(converted), LAB_CHUNK):
+        chunk = converted[start : start + LAB_CHUNK]
+        candidates = tree.query(chunk, k=k)[1].reshape(len(chunk), k)
+        differences = delta_e_2000(
+            chunk[:, None], lab_palette[candidates], pairwise=False
+        )
+        nearest[start : start + len(chunk)] = np.take_along_axis(
+            candidates, differences.argmin(axis=1)[:, None], 1
+        )[:, 0]
+    return nearest
+
+
+def _check_palette(palette: Sequence[tuple[int, int, int]]):
+    """Raises a ValueError if a palette has more than MAX_TILE_COLORS colors."""
+    if len(palette) > MAX_TILE_COLORS:
+        raise ValueError(
+            f"a palette can have at most {MAX_TILE_COLORS} colors, not {len(palette)}"
+        )
+
+
+def _quantize_kmeans(
+    pixels: np.ndarray, n_colors: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the pixels with a full KMeans run."""
+    from sklearn.cluster import KMeans
+
+    kmeans = KMeans(n_clusters=n_colors, random_state=42)
+    kmeans.fit(pixels)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+
+def _quantize_kmeans_fast(
+    pixels: np.ndarray, n_colors: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the pixels with a single, capped KMeans run."""
+    from sklearn.cluster import KMeans
+
+    kmeans = KMeans(n_clusters=n_colors, random_state=42, n_init=1, max_iter=50)
+    kmeans.fit(pixels)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+
+def _quantize_minibatch(
+    pixels: np.ndarray, n_colors: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the pixels with MiniBatchKMeans."""
+    from sklearn.cluster import MiniBatchKMeans
+
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_colors, random_state=42, n_init=3, batch_size=1024
+    )
+    kmeans.fit(pixels)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+
+def _quantize_histogram(
+    pixels: np.ndarray, n_colors: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the unique colors of the pixels, weighted by how often they occur."""
+    from sklearn.cluster import KMeans
+
+    colors, inverse, counts = np.unique(
+        pixels, axis=0, return_inverse=True, return_counts=True
+    )
+    kmeans = KMeans(n_clusters=min(n_colors, len(colors)), random_state=42)
+    kmeans.fit(colors, sample_weight=counts)
+    return kmeans.labels_[inverse.ravel()], kmeans.cluster_centers_
+
+
+def _quantize_pillow(method: Image.Quantize):
+    """Creates a quantizer that uses one of Pillow's native quantize methods."""
+
+    def quantize(pixels: np.ndarray, n_colors: int) -> tuple[np.ndarray, np.ndarray]:
+        image = Image.fromarray(pixels.reshape(1, -1, 3))
+        quantized = image.quantize(n_colors, method=method)
+        labels = np.asarray(quantized).ravel()
+        palette = np.array(quantized.getpalette()).reshape(-1, 3)
+        return labels, palette[: labels.max() + 1]
+
+    return quantize
+
+
+# Quantizers that only cluster 8-bit RGB pixels, whatever the color space
+RGB_ONLY_QUANTIZERS = {"median_cut", "octree"}
+
+QUANTIZERS = {
+    "kmeans": _quantize_kmeans,
+    "kmeans_fast": _quantize_kmeans_fast,
+    "minibatch": _quantize_minibatch,
+    "histogram": _quantize_histogram,
+    "median_cut": _quantize_pillow(Image.Quantize.MEDIANCUT),
+    "octree": _quantize_pillow(Image.Quantize.FASTOCTREE),
+}
+
+
+# The cluster counts tried by cluster_image_colors with n_colors="auto", and the
+# fraction of the variance of the pixels the clusters may leave unexplained
+AUTO_CLUSTER_COUNTS = (2, 4, 8, 16, 32)
+AUTO_INERTIA_BUDGET = 0.05
+
+# The largest cluster count the server and command line accept
+MAX_CLUSTERS = 256
+
+
+def cluster_image_colors(
+    image: Image.Image | np.ndarray, n_colors=4, quantizer="kmeans", color_space="rgb"
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clusters the colors of an image into n_colors groups.
+
+    By default this method uses KMeans clustering to find the dominant colors in
+    the image. Faster backends can be selected with quantizer:
+
+    - "kmeans": Full KMeans clustering.
+    - "kmeans_fast": KMeans with a single initialization and capped iterations.
+    - "minibatch": MiniBatchKMeans clustering.
+    - "histogram": KMeans over the unique colors, weighted by their pixel counts.
+    - "median_cut": Pillow's native median cut quantization.
+    - "octree": Pillow's native fast octree quantization.
+
+    The Pillow backends may return fewer than n_colors colors, and always
+    cluster in RGB.
+
+    With n_colors="auto", the number of clusters is the smallest of
+    AUTO_CLUSTER_COUNTS whose inertia, the sum of the squared distances between
+    the pixels and the mean of their cluster in the clustering color space, is
+    at most AUTO_INERTIA_BUDGET times the total inertia of the pixels.
+
+    Args:
+        image (Image.Image | np.ndarray): The image to process, or its RGB pixels
+        as a (height, width, 3) array, e.g. a view of shared memory, which is
+        used without copying it.
+        n_colors (int | str, optional): Number of colors to cluster into, or
+        "auto". Defaults to 4.
+        quantizer (str, optional): Name of the clustering backend.
+        Defaults to "kmeans".
+        color_space (str, optional): The color space the pixels are clustered
+        in, see COLOR_SPACES. Defaults to "rgb".
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Returns a tuple of the per-pixel cluster
+        labels (with the same height and width as the image) and the RGB color
+        of each cluster.
+    """
+    if quantizer not in QUANTIZERS:
+        raise ValueError(
+            f"quantizer must be one of {', '.join(QUANTIZERS)}, not {quantizer!r}"
+        )
+    if color_space not in COLOR_SPACES:
+        raise ValueError(
+            f"color_space must be one of {', '.join(COLOR_SPACES)}, not {color_space!r}"
+        )
+
+    # Convert image data to a numpy array
+    if isinstance(image, np.ndarray):
+        image_data = image
+    else:
+        image_data = np.asarray(image.convert("RGB"))
+    pixels = image_data.reshape(-1, 3)
+
+    # Find clusters (colors)
+    if color_space == "rgb" or quantizer in RGB_ONLY_QUANTIZERS:
+        points = pixels
+    else:
+        points = COLOR_SPACES[color_space](pixels)
+
+    if n_colors == "auto":
+        total = _inertia(points, np.zeros(len(points), dtype=int))
+        counts = [n for n in AUTO_CLUSTER_COUNTS if n < len(points)] or [1]
+        for n in counts:
+            labels, centers = QUANTIZERS[quantizer](points, n)
+            if _inertia(points, labels) <= AUTO_INERTIA_BUDGET * total:
+                break
+    else:
+        labels, centers = QUANTIZERS[quantizer](points, n_colors)
+
+    if points is not pixels:
+        centers = _cluster_means(pixels, labels)
+
+    new_colors = centers.astype(int)
+    labels = labels.reshape(image_data.shape[:2])
+
+    return labels, new_colors
+
+
+def _cluster_means(points: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """Computes the mean of the points of each cluster."""
+    counts = np.bincount(labels, minlength=labels.max() + 1)
+    sums = np.stack(
+        [
+            np.bincount(labels, weights=points[:, channel], minlength=len(counts))
+            for channel in range(points.shape[1])
+        ],
+        axis=-1,
+    )
+    return sums / np.maximum(counts, 1)[:, None]
+
+
+def _inertia(points: np.ndarray, labels: np.ndarray) -> float:
+    """Computes the sum of the squared distances of points to their cluster mean."""
+    deviations = np.asarray(points, float) - _cluster_means(points, labels)[labels]
+    return float(np.einsum("ij,ij->", deviations, deviations))
+
+
+def compare_quantizers(image: Image, n_colors=4, quantizers=None) -> list[dict]:
+    """Reports the speed and quality of the clustering backends on an image.
+
+    Args:
+        image (Image): The image to cluster.
+        n_colors (int, optional): Number of colors to cluster into. Defaults to 4.
+        quantizers (list[str], optional): Names of the backends to compare.
+        Defaults to all of them.
+
+    Returns:
+        list[dict]: One report per backend with its name, the number of colors
+        found, the time taken in seconds, and the mean squared error between the
+        pixels and their cluster colors.
+    """
+    pixels = np.array(image.convert("RGB")).reshape(-1, 3)
+    reports = []
+
+    for quantizer in quantizers or QUANTIZERS:
+        start = time.perf_counter()
+        labels, colors = cluster_image_colors(image, n_colors, quantizer)
+        seconds = time.perf_counter() - start
+
+        error = pixels - colors[labels.ravel()]
+        reports.append(
+            {
+                "quantizer": quantizer,
+                "n_colors": len(colors),
+                "seconds": seconds,
+                "mse": float(np.mean(error.astype(float) ** 2)),
+            }
+        )
+
+    return reports
+
 
 def reduce_image_colors(
-    image: Image, n_colors=4
+    image: Image.Image | np.ndarray, n_colors=4, quantizer="kmeans"
 ) -> tuple[Image, list[tuple]]:  # type: ignore
     """Reduces the number of colors in an image to n_colors.
 
     This method uses KMeans clustering to find the dominant colors in the image.
 
     Args:
-        image (Image): The image to process.
+        image (Image.Image | np.ndarray): The image to process, or its RGB
+        pixels, see cluster_image_colors.
         n_colors (int, optional): Number of colors to reduce to. Defaults to 4.
+        quantizer (str, optional): Name of the clustering backend, see
+        cluster_image_colors. Defaults to "kmeans".
 
     Returns:
         tuple[Image, list[tuple]]: Returns a tuple of the image and the colors used.
     """
-
-    # Convert image data to a numpy array
-    org_image = image.convert("RGB")
-    image_data = np.array(org_image)
-    original_shape = image_data.shape
-    pixels = image_data.reshape(-1, 3)
-
-    # Apply KMeans to find clusters (colors)
-    kmeans = KMeans(n_clusters=n_colors, random_state=42)
-    kmeans.fit(pixels)
-    new_colors = kmeans.cluster_centers_.astype(int)
-    labels = kmeans.labels_
-
-    # Create new image data with reduced colors
-    new_image_data = new_colors[labels].reshape(original_shape)
+    labels, new_colors = cluster_image_colors(image, n_colors, quantizer)
 
     # Create a new image from the reduced color data
-    new_image = Image.fromarray(new_image_data.astype("uint8"))
+    new_image = apply_color_remapping(labels, new_colors)
 
     # Return the image
     return (new_image, [tuple(color) for color in new_colors.tolist()])
 
 
-def remap_colors(found_colors: list[tuple], specified_colors: list[tuple]) -> dict:
-    """Generates a map between the found colors and the closest specified colors,
-    based on the Euclidean distance between the colors.
+# The ways match_colors can match found colors to specified colors
+MATCHES = ("unique", "nearest")
+
+
+def match_colors(
+    found_colors: list[tuple],
+    specified_colors: list[tuple],
+    color_space="rgb",
+    match="unique",
+) -> np.ndarray:
+    """Finds the optimal assignment of found colors to specified colors.
+
+    With the "unique" match, the assignment minimizes the sum of the distances
+    between each found color and the specified color it is assigned to, with
+    every specified color used at most once. This is solved as a linear sum
+    assignment problem (Hungarian algorithm) in polynomial time. If there are
+    more found colors than specified colors, the found colors left over after
+    the one-to-one assignment are matched to their closest specified color.
+
+    With the "nearest" match, every found color is matched to its closest
+    specified color through a KD-tree of the specified colors, see
+    nearest_colors. This suits large palettes with far fewer found colors.
 
     Args:
         found_colors (list[tuple]): List of RGB tuples of starting colors.
         specified_colors (list[tuple]): List of RGB tuples of target colors.
+        color_space (str, optional): The color space the distances are measured
+        in, see color_distances. Defaults to "rgb", i.e. Euclidean distances.
+        match (str, optional): "unique" or "nearest". Defaults to "unique".
 
     Returns:
-        dict: A dictionary mapping the found colors to the specified colors.
+        np.ndarray: For each found color, the index of its specified color.
     """
+    if match not in MATCHES:
+        raise ValueError(f"match must be one of {', '.join(MATCHES)}")
+    if match == "nearest":
+        return nearest_colors(found_colors, specified_colors, color_space)
 
     # Calculate distances between each found color and each specified color
-    distances = cdist(found_colors, specified_colors, metric="euclidean")
+    distances = color_distances(
+        COLOR_SPACES[color_space](np.asarray(found_colors).reshape(-1, 3)),
+        convert_palette(tuple(map(tuple, specified_colors)), color_space),
+        color_space,
+    )
+
+    # Find the one-to-one assignment with the minimum total distance
+    from scipy.optimize import linear_sum_assignment
+
+    rows, cols = linear_sum_assignment(distances)
+    indices = distances.argmin(axis=1)
+    indices[rows] = cols
+
+    return indices
+
+
+def assign_inventory(
+    labels: np.ndarray,
+    pixels: np.ndarray,
+    found_colors: np.ndarray,
+    tile_colors: Sequence[tuple[int, int, int]],
+    inventory: Sequence[int],
+    color_space="rgb",
+) -> np.ndarray:
+    """Assigns clustered tiles to tile colors with a limited number of each color.
+
+    The number of tiles of each cluster given each tile color is the minimum
+    cost flow from the clusters, supplying one unit per tile, to the tile
+    colors, taking at most their inventory, where a unit costs the distance
+    between the cluster color and the tile color. This transportation problem
+    is solved as a linear program, whose optimal vertex is integral. The tiles
+    of each cluster then go to its tile colors in order of distance, each color
+    taking the tiles closest to it.
+
+    Args:
+        labels (np.ndarray): The cluster of every tile, see cluster_image_colors.
+        pixels (np.ndarray): The RGB color of every tile, in the shape of labels
+        with a last axis of 3.
+        found_colors (np.ndarray): The RGB color of every cluster.
+        tile_colors (Sequence[tuple[int, int, int]]): The RGB tuples of the tile
+        colors.
+        inventory (Sequence[int]): The number of tiles of each tile color.
+        color_space (str, optional): The color space the distances are measured
+        in, see color_distances. Defaults to "rgb".
+
+    Returns:
+        np.ndarray: The index in tile_colors of every tile, in the shape of
+        labels.
+
+    Raises:
+        ValueError: If the inventory does not have a count per tile color, or
+        has fewer tiles than labels.
+    """
+    from scipy import sparse
+    from scipy.optimize import linprog
+
+    inventory = np.asarray(inventory, dtype=float)
+    if inventory.shape != (len(tile_colors),) or (inventory < 0).any():
+        raise ValueError("inventory must have a count of at least 0 per tile color")
+    if inventory.sum() < labels.size:
+        raise ValueError(
+            f"inventory has {int(inventory.sum())} tiles, but {labels.size} are needed"
+        )
+
+    flat_labels = labels.reshape(-1)
+    counts = np.bincount(flat_labels, minlength=len(found_colors))
+    palette = convert_palette(tuple(map(tuple, tile_colors)), color_space)
+    costs = color_distances(
+        COLOR_SPACES[color_space](np.asarray(found_colors, float).reshape(-1, 3)),
+        palette,
+        color_space,
+    )
+
+    # Flow out of every cluster equals its tiles, into every color is capped.
+    # Each flow appears in one constraint of each kind, so the matrices are sparse
+    n_clusters, n_colors = costs.shape
+    solution = linprog(
+        costs.reshape(-1),
+        A_ub=sparse.kron(np.ones((1, n_clusters)), sparse.identity(n_colors), "csr"),
+        b_ub=inventory,
+        A_eq=sparse.kron(sparse.identity(n_clusters), np.ones((1, n_colors)), "csr"),
+        b_eq=counts,
+        bounds=(0, None),
+        method="highs-ds",
+    )
+    if not solution.success:
+        raise ValueError(f"Could not assign the inventory: {solution.message}")
+    flows = np.rint(solution.x).astype(int).reshape(n_clusters, n_colors)
+
+    tiles = COLOR_SPACES[color_space](np.asarray(pixels, float).reshape(-1, 3))
+    indices = np.empty(len(flat_labels), dtype=int)
+    for cluster in np.flatnonzero(counts):
+        members = np.flatnonzero(flat_labels == cluster)
+        for color in np.argsort(costs[cluster], kind="stable"):
+            if not flows[cluster, color] or not len(members):
+                continue
+            distances = color_distances(tiles[members], palette[[color]], color_space)
+            closest = np.argsort(distances[:, 0], kind="stable")
+            taken = closest[: flows[cluster, color]]
+            indices[members[taken]] = color
+            members = np.delete(members, taken)
 
-    # Generate all permutations of the colors
-    items = list(range(len(found_colors)))
-    permutations = itertools.permutations(items)
-    perm_map = []
-    for perm in permutations:
-        perm_map.append([(items[i], perm[i]) for i in range(len(items))])
+    return indices.reshape(labels.shape)
 
-    # Calculate the sum of all distances for each permutation,
-    # and find the combination that produces the minimum
-    min_distance = [inf, None]
-    for m in perm_map:
-        total_distance = 0
 
-        for pair in m:
-            total_distance += distances[pair[0]][pair[1]]
+def remap_colors(found_colors: list[tuple], specified_colors: list[tuple]) -> dict:
+    """Generates a map between the found colors and the closest specified colors,
+    based on the Euclidean distance between the colors.
+
+    Args:
+        found_colors (list[tuple]): List of RGB tuples of starting colors.
+        specified_colors (list[tuple]): List of RGB tuples of target colors.
 
-        if total_distance < min_distance[0]:
-            min_distance = [total_distance, m]
+    Returns:
+        dict: A dictionary mapping the found colors to the specified colors.
+    """
+    indices = match_colors(found_colors, specified_colors)
 
     # Create a dictionary mapping the found colors to the specified colors
     final_mapping = {
-        found_colors[i[0]]: specified_colors[i[1]] for i in min_distance[1]
+        found_color: tuple(specified_colors[index])
+        for found_color, index in zip(found_colors, indices)
     }
 
     return final_mapping
 
 
-def apply_color_remapping(image: Image, color_mapping: dict) -> Image:
+@functools.lru_cache(maxsize=64)
+def palette_lut(palette: tuple[tuple[int, int, int]], bits=5, color_space="rgb"):
+    """Builds a lookup table from quantized RGB colors to their nearest palette color.
+
+    The table has 2**bits bins per channel, and each bin holds the index of
+    the palette color closest to the center of the bin, found with
+    nearest_colors. Tables are cached, so a palette only pays for building its
+    table once.
+
+    Args:
+        palette (tuple[tuple[int, int, int]]): The RGB tuples of the palette.
+        bits (int, optional): The bits per channel of the table. Defaults to 5,
+        a 32x32x32 table.
+        color_space (str, optional): The color space distances are measured in,
+        see color_distances. Defaults to "rgb".
+
+    Returns:
+        np.ndarray: The read-only table of palette indices, indexed by the red,
+        green and blue channels shifted right by 8 - bits.
+
+    Raises:
+        ValueError: If the palette has more than MAX_TILE_COLORS colors.
+    """
+    _check_palette(palette)
+    bins = 2**bits
+    centers = (np.arange(bins) + 0.5) * (256 / bins)
+    colors = np.stack(np.meshgrid(centers, centers, centers, indexing="ij"), -1)
+
+    lut = nearest_colors(colors.reshape(-1, 3), palette, color_space)
+    lut = lut.astype(np.uint8).reshape(bins, bins, bins)
+    lut.flags.writeable = False
+    return lut
+
+
+# Normalized 4x4 Bayer matrix, with thresholds centered on 0
+_BAYER_4X4 = (
+    np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) + 0.5
+) / 16 - 0.5
+
+DITHERS = ("none", "ordered", "floyd_steinberg")
+
+
+def map_to_palette(
+    image: Image.Image | np.ndarray,
+    palette: Sequence[tuple[int, int, int]],
+    dither="none",
+    color_space="rgb",
+    bits=5,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Maps every pixel of an image to its nearest palette color, without clustering.
+
+    Unlike match_colors, palette colors can be used any number of times, or
+    not at all.
+
+    Args:
+        image (Image.Image | np.ndarray): The image to map, or its RGB pixels as
+        a (height, width, 3) uint8 array.
+        palette (Sequence[tuple[int, int, int]]): The RGB tuples of the palette.
+        dither (str, optional): "none", "ordered" for a 4x4 Bayer matrix, or
+        "floyd_steinberg" for Pillow's error diffusion, which always measures
+        distances in RGB. Defaults to "none".
+        color_space (str, optional): The color space distances are measured in,
+        see color_distances. Defaults to "rgb".
+        bits (int, optional): The bits per channel of the lookup table, see
+        palette_lut. Defaults to 5.
+        out (np.ndarray, optional): A (height, width) uint8 array to write the
+        result to. Defaults to None, which allocates it.
+
+    Returns:
+        np.ndarray: The uint8 palette index of every pixel, with the same height
+        and width as the image.
+
+    Raises:
+        ValueError: If dither is unknown, or the palette has more than
+        MAX_TILE_COLORS colors.
+    """
+    if dither not in DITHERS:
+        raise ValueError(f"dither must be one of {', '.join(DITHERS)}, not {dither!r}")
+    _check_palette(palette)
+
+    palette = tuple(map(tuple, palette))
+
+    if dither == "floyd_steinberg":
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        palette_image = Image.new("P", (1, 1))
+        palette_image.putpalette(np.asarray(palette, dtype=np.uint8).tobytes())
+        quantized = image.convert("RGB").quantize(
+            palette=palette_image, dither=Image.Dither.FLOYDSTEINBERG
+        )
+        if out is None:
+            return np.asarray(quantized)
+        out[...] = np.asarray(quantized)
+        return out
+
+    pixels = image if isinstance(image, np.ndarray) else _rgb_pixels(image)
+    if dither == "ordered":
+        # Offset each pixel by a threshold around the typical palette spacing
+        spread = 256 / len(palette) ** (1 / 3)
+        height, width = pixels.shape[:2]
+        offsets = np.tile(
+            (_BAYER_4X4 * spread).astype(np.int16), (height // 4 + 1, width // 4 + 1)
+        )
+        pixels = pixels.astype(np.int16)
+        pixels += offsets[:height, :width, None]
+        np.clip(pixels, 0, 255, out=pixels)
+
+    # Look up the bin of every pixel, without widening the pixels
+    lut = palette_lut(palette, bits, color_space)
+    shift = 8 - bits
+    indices = lut[
+        pixels[..., 0] >> shift, pixels[..., 1] >> shift, pixels[..., 2] >> shift
+    ]
+    if out is None:
+        return indices
+    out[...] = indices
+    return out
+
+
+def apply_color_remapping(
+    image: Image.Image | np.ndarray, color_mapping: dict | np.ndarray
+) -> Image:
     """Apply the color remapping to the image.
 
+    The image can either be an RGB image, in which case color_mapping is a
+    dictionary mapping each of its colors to a new color, or a 2D array of
+    cluster labels, in which case color_mapping is the RGB color of each label.
+    In both cases the mapping is applied as a single lookup table gather.
+
     Args:
-        image (Image): The image to process.
-        color_mapping (dict): A dictionary mapping the original colors to the new colors.
+        image (Image.Image | np.ndarray): The image or label array to process.
+        color_mapping (dict | np.ndarray): A dictionary mapping the original
+        colors to the new colors, or the new color of each label.
 
     Returns:
         Image: The processed image.
     """
+    if isinstance(image, np.ndarray):
+        # Look up the color of every label
+        lut = np.asarray(color_mapping, dtype=np.uint8)
+        return Image.fromarray(lut[image])
+
     # Convert image data to a numpy array
     image_data = np.array(image)
     original_shape = image_data.shape
     pixels = image_data.reshape(-1, 3)
 
+    # Pack each color into a single integer so it can be searched for
+    keys = _pack_colors(np.array(list(color_mapping.keys())))
+    values = np.array(list(color_mapping.values()), dtype=np.uint8)
+    order = np.argsort(keys)
+    keys, values = keys[order], values[order]
+
+    # Find the position of every pixel's color in the mapping
+    packed = _pack_colors(pixels)
+    positions = np.searchsorted(keys, packed).clip(max=len(keys) - 1)
+    missing = keys[positions] != packed
+    if missing.any():
+        raise KeyError(tuple(pixels[missing.argmax()].tolist()))
+
     # Apply the color mapping
-    new_pixels = np.array([color_mapping[tuple(pixel)] for pixel in pixels])
-    new_image_data = new_pixels.reshape(original_shape)
+    new_image_data = values[positions].reshape(original_shape)
 
     # Create a new image from the mapped color data
-    new_image = Image.fromarray(new_image_data.astype("uint8"))
+    new_image = Image.fromarray(new_image_data)
 
     return new_image
 
 
-def tile_image(
-    image_path: str,
+def _pack_colors(colors: np.ndarray) -> np.ndarray:
+    """Packs an array of RGB colors into one 24-bit integer per color."""
+    colors = colors.astype(np.uint32)
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+
+def grid_size(image_size: tuple[int, int], pixel_dimensions: int) -> tuple[int, int]:
+    """Finds the grid that preserves the aspect ratio of an image.
+
+    Args:
+        image_size (tuple[int, int]): The (width, height) of the image.
+        pixel_dimensions (int): The number of tiles along the longest side.
+
+    Returns:
+        tuple[int, int]: The (columns, rows) of the grid.
+    """
+    width, height = image_size
+    longest = max(width, height)
+    return (
+        max(1, round(width * pixel_dimensions / longest)),
+        max(1, round(height * pixel_dimensions / longest)),
+    )
+
+
+def block_downscale(image: Image, size: tuple[int, int]) -> Image:
+    """Downscales an image by averaging exact blocks of pixels.
+
+    Every tile is the mean of a block of whole source pixels, so no pixel is
+    blended into two tiles. The image is cropped evenly on both sides to a
+    multiple of the block size. Images smaller than size are box-filtered.
+
+    Args:
+        image (Image): The image to downscale.
+        size (tuple[int, int]): The (columns, rows) to downscale to.
+
+    Returns:
+        Image: The downscaled RGB image.
+    """
+    image = image.convert("RGB")
+    columns, rows = size
+    block_width, block_height = image.width // columns, image.height // rows
+    if block_width == 0 or block_height == 0:
+        return image.resize(size, Image.Resampling.BOX)
+
+    left = (image.width - columns * block_width) // 2
+    top = (image.height - rows * block_height) // 2
+    image_data = np.asarray(
+        image.crop((left, top, left + columns * block_width, top + rows * block_height))
+    )
+
+    blocks = image_data.reshape(rows, block_height, columns, block_width, 3)
+    return Image.fromarray(np.rint(blocks.mean(axis=(1, 3))).astype(np.uint8))
+
+
+def downscale_image(
+    image: Image, size: tuple[int, int], resample=Image.Resampling.BICUBIC
+) -> Image:
+    """Downscales an image without fully decoding it where possible.
+
+    JPEG images are decoded directly at 1/2, 1/4 or 1/8 scale using Pillow's
+    draft mode, as long as the result is still at least as large as size. The
+    remaining reduction is done by box-filtering down by an integer factor,
+    followed by a final resample to the exact size.
+
+    Args:
+        image (Image): The image to downscale. It must not be loaded yet for
+        draft mode to take effect.
+        size (tuple[int, int]): The (width, height) to downscale to.
+        resample (optional): The resampling filter used for the final resize,
+        or "block" to average exact blocks of pixels, see block_downscale.
+        Defaults to Image.Resampling.BICUBIC.
+
+    Returns:
+        Image: The downscaled image.
+    """
+    image.draft("RGB", size)
+    image = _to_8_bit(image)
+    if resample == "block":
+        return block_downscale(image, size)
+    return image.resize(size, resample, reducing_gap=3.0)
+
+
+def _to_8_bit(image: Image.Image) -> Image.Image:
+    """Scales a 16 bit grayscale image down to an 8 bit "L" image.
+
+    Converting 16 bit images to RGB clips every value above 255, and
+    Image.reduce, used by reducing_gap, does not support them at all."""
+    if not image.mode.startswith("I;16"):
+        return image
+    return Image.fromarray((np.asarray(image) >> 8).astype(np.uint8))
+
+
+def upscale_indices(
+    tiles: np.ndarray,
+    size: tuple[int, int],
+    out: np.ndarray | None = None,
+    band_rows=64,
+) -> np.ndarray:
+    """Upscales an array of tiles with nearest neighbor resampling.
+
+    The result is the same as Pillow's NEAREST resize. The grid is upscaled one
+    band of grid rows at a time: each band is widened once, then copied into
+    every output row that samples it, so only a band-sized temporary is
+    allocated besides out.
+
+    Args:
+        tiles (np.ndarray): The (rows, columns) palette indices, or the
+        (rows, columns, channels) colors of the tiles.
+        size (tuple[int, int]): The (width, height) to upscale to.
+        out (np.ndarray, optional): A C-contiguous array of the upscaled shape
+        and the dtype of tiles to write the result to. Defaults to None, which
+        allocates it.
+        band_rows (int, optional): Number of grid rows upscaled at once.
+        Defaults to 64.
+
+    Returns:
+        np.ndarray: The upscaled tiles.
+    """
+    width, height = size
+    rows, columns = tiles.shape[:2]
+    if out is None:
+        out = np.empty((height, width, *tiles.shape[2:]), dtype=tiles.dtype)
+
+    if width % columns == 0 and height % rows == 0:
+        # Repeat every tile into an exact block of pixels
+        block_height, block_width = height // rows, width // columns
+        for start in range(0, rows, band_rows):
+            wide = np.repeat(tiles[start : start + band_rows], block_width, axis=1)
+            blocks = out[start * block_height : (start + len(wide)) * block_height]
+            shape = (len(wide), block_height, *wide.shape[1:])
+            blocks.reshape(shape)[...] = wide[:, None]
+        return out
+
+    row_indices = _nearest_indices(height, rows)
+    column_indices = _nearest_indices(width, columns)
+    for start in range(0, rows, band_rows):
+        wide = np.take(tiles[start : start + band_rows], column_indices, axis=1)
+        first, last = np.searchsorted(row_indices, (start, start + band_rows))
+        np.take(wide, row_indices[first:last] - start, axis=0, out=out[first:last])
+    return out
+
+
+def _nearest_indices(output_size: int, input_size: int) -> np.ndarray:
+    """Finds the input pixel sampled by each output pixel of a NEAREST resize.
+
+    The sample positions are accumulated the way Pillow does, so they round the
+    same way at exact pixel boundaries."""
+    steps = np.full(output_size, input_size / output_size)
+    steps[0] /= 2
+    return np.cumsum(steps).astype(np.intp)
+
+
+def upscale_grid(grid: Image, size: tuple[int, int]) -> Image:
+    """Upscales a tile grid with nearest neighbor resampling, see upscale_indices.
+
+    Args:
+        grid (Image): The grid to upscale.
+        size (tuple[int, int]): The (width, height) to upscale to.
+
+    Returns:
+        Image: The upscaled image, in the mode of grid.
+    """
+    upscaled_image = Image.fromarray(upscale_indices(np.asarray(grid), size), grid.mode)
+    if grid.mode == "P":
+        upscaled_image.putpalette(grid.getpalette())
+    return upscaled_image
+
+
+def tile_array(
+    pixels: np.ndarray,
+    tile_colors: Sequence[tuple[int, int, int]] = default_tile_colors,
+    quantizer="kmeans",
+    color_space="rgb",
+    dither="none",
+    n_clusters: int | str | None = None,
+    match="unique",
+    inventory: Sequence[int] | None = None,
+    out: np.ndarray | None = None,
+    progress: Callable[[str], None] | None = None,
+) -> np.ndarray:
+    """Assigns every tile of a pixelated grid to a tile color.
+
+    This is the array core of tile_grid: it runs the cluster and remap stages
+    on uint8 pixels and writes uint8 palette indices, without converting to and
+    from images. The clusters of an identical grid are reused from
+    cluster_cache.
+
+    Args:
+        pixels (np.ndarray): The (rows, columns, 3) uint8 RGB pixels of the
+        grid, e.g. as downscaled by downscale_image.
+        tile_colors (Sequence[tuple[int, int, int]], optional): The RGB tuples
+        of the tile colors. Defaults to default_tile_colors.
+        quantizer (str, optional): Name of the clustering backend, or "direct",
+        see tile_grid. Defaults to "kmeans".
+        color_space (str, optional): The color space the colors are clustered
+        and matched in, see COLOR_SPACES. Defaults to "rgb".
+        dither (str, optional): The dithering of the "direct" quantizer, see
+        map_to_palette. Defaults to "none".
+        n_clusters (int | str, optional): The number of clusters, or "auto" to
+        choose it from the image, see cluster_image_colors. It is capped at the
+        number of tiles. Defaults to None, which uses one cluster per tile
+        color.
+        match (str, optional): How clusters are matched to tile colors, see
+        match_colors. Defaults to "unique".
+        inventory (Sequence[int], optional): The number of tiles available of
+        each tile color, see assign_inventory. Defaults to None, which puts no
+        limit on them and matches the clusters with match.
+        out (np.ndarray, optional): A (rows, columns) uint8 array to write the
+        result to. Defaults to None, which allocates it.
+        progress (optional): Called with the name of each stage as it starts:
+        "cluster" and "remap". Defaults to None.
+
+    Returns:
+        np.ndarray: The index in tile_colors of every tile.
+
+    Raises:
+        ValueError: If there are more than MAX_TILE_COLORS tile colors.
+    """
+    _check_palette(tile_colors)
+    stages = StageTimer(progress)
+    if out is None:
+        out = np.empty(pixels.shape[:2], dtype=np.uint8)
+
+    if quantizer == "direct":
+        if inventory is not None:
+            raise ValueError('inventory cannot be used with the "direct" quantizer')
+
+        # Map every tile to its nearest tile color, without clustering
+        stages.start("remap")
+        map_to_palette(pixels, tile_colors, dither, color_space, out=out)
+    else:
+        # Reduce image colors, reusing the clusters of an identical grid
+        stages.start("cluster")
+        pixels = np.ascontiguousarray(pixels)
+        n_clusters = _cluster_count(
+            n_clusters, tile_colors, pixels.shape[0] * pixels.shape[1]
+        )
+        cluster_key = make_key(
+            pixels,
+            mode="RGB",
+            size=(pixels.shape[1], pixels.shape[0]),
+            n_colors=n_clusters,
+            quantizer=quantizer,
+            color_space=color_space,
+        )
+        clusters = cluster_cache.get(cluster_key)
+        if clusters is None:
+            clusters = cluster_image_colors(
+                pixels,
+                n_colors=n_clusters,
+                quantizer=quantizer,
+                color_space=color_space,
+            )
+            cluster_cache.set(
+                cluster_key, clusters, size=clusters[0].nbytes + clusters[1].nbytes
+            )
+        labels, found_colors = clusters
+
+        # Remap the clusters to the indices of the tile colors
+        stages.start("remap")
+        if inventory is not None:
+            out[:] = assign_inventory(
+                labels, pixels, found_colors, tile_colors, inventory, color_space
+            )
+        else:
+            indices = match_colors(found_colors, tile_colors, color_space, match)
+            np.take(indices.astype(np.uint8), labels, out=out)
+    stages.finish()
+
+    return out
+
+
+def _cluster_count(
+    n_clusters: int | str | None, tile_colors: Sequence, n_tiles: int
+) -> int | str:
+    """Finds the number of clusters of n_tiles tiles: n_clusters, or one per tile
+    color if it is None, but never more than there are tiles."""
+    n_clusters = n_clusters or len(tile_colors)
+    return n_clusters if n_clusters == "auto" else min(n_clusters, n_tiles)
+
+
+def tile_grid(
+    image_path: str | bytes | BinaryIO,
     tile_colors: tuple[tuple[int, int, int]] = default_tile_colors,
     pixel_dimensions=50,
-) -> Image:
-    """Pixelates and tiles an image using a specified set of colors.
+    grid: tuple[int, int] | str | None = None,
+    quantizer="kmeans",
+    color_space="rgb",
+    dither="none",
+    resample=Image.Resampling.BICUBIC,
+    output_scale=None,
+    n_clusters: int | str | None = None,
+    match="unique",
+    inventory: Sequence[int] | None = None,
+    progress: Callable[[str], None] | None = None,
+) -> tuple[Image.Image, tuple[int, int]]:
+    """Pixelates and tiles an image, without upscaling the result.
+
+    This runs every stage of tile_image except the upscale, so the caller can
+    upscale and encode the grid itself, e.g. with iter_upscaled_png.
 
     Args:
-        image_path: Path to the image file being processed.
+        image_path: Path to the image file being processed, a binary file-like
+        object to read it from, or its encoded bytes.
         tile_colors: List of RGB tuples to use for the final tiling.
         Defaults to default_tile_colors (red, black, gray, white).
-        pixel_dimensions: The side length of the square nxn grid. Defaults to 50.
+        pixel_dimensions: The side length of the square nxn grid, or of the
+        longest side of an "auto" grid. Defaults to 50.
+        grid: The (columns, rows) of the grid, "auto" for the grid with
+        pixel_dimensions tiles along the longest side that preserves the
+        aspect ratio of the image, see grid_size, or None for a square grid.
+        Defaults to None.
+        quantizer: Name of the clustering backend, see cluster_image_colors,
+        or "direct" to map every tile to its nearest tile color without
+        clustering, see map_to_palette. Defaults to "kmeans".
+        color_space: The color space the colors are clustered and matched in,
+        see COLOR_SPACES. Defaults to "rgb".
+        dither: The dithering of the "direct" quantizer, see map_to_palette.
+        Defaults to "none".
+        resample: The resampling filter used to pixelate the image, or "block",
+        see downscale_image. Defaults to Image.Resampling.BICUBIC.
+        output_scale: The size in pixels of each tile in the result. Defaults to
+        None, which upscales the result back to the size of the original image.
+        n_clusters: The number of clusters, or "auto", see tile_array.
+        Defaults to None, one per tile color.
+        match: How clusters are matched to tile colors, "unique" or "nearest",
+        see match_colors. Defaults to "unique".
+        inventory: The number of tiles available of each tile color, see
+        assign_inventory. Defaults to None, no limit.
+        progress: Called with the name of each stage of the pipeline as it
+        starts: "decode", "downscale", "cluster" and "remap". Defaults to None.
+        The stages are also timed, see StageTimer.
 
     Returns:
-        Image: The processed image.
+        tuple[Image, tuple[int, int]]: The grid as a "P" mode image whose
+        palette is tile_colors, rotated according to the EXIF orientation, and
+        the size the grid should be upscaled to.
+
+    Raises:
+        ValueError: If there are more than MAX_TILE_COLORS tile colors.
     """
-    # Open the image
-    org_image = Image.open(image_path)
-    exif_data = org_image._getexif()
-    orientation = exif_data.get(274) if exif_data else None
+    _check_palette(tile_colors)
+    stages = StageTimer(progress)
+
+    # Open the image, and decode it at reduced scale where possible
+    stages.start("decode")
+    org_image, orientation = _open_image(image_path)
+    org_size = org_image.size
+
+    # Find the grid size, as stored in the file, before any rotation
+    size = _resolve_grid(grid, pixel_dimensions, org_size)
+    if orientation in (6, 8) and grid not in (None, "auto"):
+        size = size[::-1]
+
+    org_image.draft("RGB", size)
+    org_image.load()
 
     # Pixelate (downscale) the image
-    pixelated = org_image.resize((pixel_dimensions, pixel_dimensions))
+    stages.start("downscale")
+    pixelated = downscale_image(org_image, size, resample)
+    stages.finish()
 
-    # Reduce image colors
-    reduced, found_colors = reduce_image_colors(pixelated, n_colors=len(tile_colors))
+    tile_indices = tile_array(
+        _rgb_pixels(pixelated),
+        tile_colors,
+        quantizer,
+        color_space,
+        dither,
+        n_clusters,
+        match,
+        inventory,
+        progress=progress,
+    )
+    return _make_tiles(tile_indices, tile_colors, orientation, org_size, output_scale)
 
-    # Remap image colors
-    color_map = remap_colors(found_colors, tile_colors)
-    remapped = apply_color_remapping(reduced, color_map)
 
-    # Upscale the image back
-    upscaled = remapped.resize(org_image.size, Image.Resampling.NEAREST)
+def tile_ladder(
+    image_path: str | bytes | BinaryIO,
+    tile_colors: tuple[tuple[int, int, int]] = default_tile_colors,
+    pixel_dimensions: Sequence[int] = (25, 50, 100),
+    grid: str | None = None,
+    quantizer="kmeans",
+    color_space="rgb",
+    dither="none",
+    resample=Image.Resampling.BICUBIC,
+    reference: int | None = None,
+    output_scale=None,
+    n_clusters: int | str | None = None,
+    match="unique",
+    progress: Callable[[str], None] | None = None,
+) -> list[tuple[Image.Image, tuple[int, int]]]:
+    """Pixelates and tiles an image at several grid sizes at once.
+
+    The image is decoded once into a base level a few times larger than the
+    largest grid, and every grid is downscaled from it. The colors are
+    clustered once, on the grid of the reference size, and matched to the
+    tile colors once; every grid then assigns its tiles to the nearest of
+    those clusters. This is much cheaper than tiling each size separately, at
+    the cost of small differences from tile_grid.
+
+    Args:
+        image_path: Path to the image file being processed, a binary file-like
+        object to read it from, or its encoded bytes.
+        tile_colors: List of RGB tuples to use for the final tiling.
+        Defaults to default_tile_colors (red, black, gray, white).
+        pixel_dimensions: The side length of each grid, or of its longest side
+        for "auto" grids. Defaults to (25, 50, 100).
+        grid: "auto" for grids that preserve the aspect ratio of the image, see
+        grid_size, or None for square grids. Defaults to None.
+        quantizer: Name of the clustering backend, or "direct", see tile_grid.
+        Defaults to "kmeans".
+        color_space: The color space the colors are clustered and matched in,
+        see COLOR_SPACES. Defaults to "rgb".
+        dither: The dithering of the "direct" quantizer, see map_to_palette.
+        Defaults to "none".
+        resample: The resampling filter used to pixelate the image, or "block",
+        see downscale_image. Defaults to Image.Resampling.BICUBIC.
+        reference: The grid size the colors are clustered at. Defaults to None,
+        which uses the largest of pixel_dimensions.
+        output_scale: The size in pixels of each tile in the results. Defaults
+        to None, which upscales the results to the size of the original image.
+        n_clusters: The number of clusters, or "auto", see tile_array.
+        Defaults to None, one per tile color.
+        match: How clusters are matched to tile colors, see match_colors.
+        Defaults to "unique".
+        progress: Called with the name of each stage of the pipeline as it
+        starts: "decode", "downscale", "cluster" and "remap". Defaults to None.
+
+    Returns:
+        list[tuple[Image, tuple[int, int]]]: The grid and output size of each
+        of pixel_dimensions, in order, as returned by tile_grid.
+    """
+    if grid not in (None, "auto"):
+        raise ValueError(f'grid must be "auto" or None, not {grid!r}')
+    if not pixel_dimensions or min(pixel_dimensions) < 1:
+        raise ValueError("pixel_dimensions must be positive integers")
+    _check_palette(tile_colors)
+
+    stages = StageTimer(progress)
+
+    # Open the image, and decode it once for every grid size
+    stages.start("decode")
+    org_image, orientation = _open_image(image_path)
+    org_size = org_image.size
+
+    def size_of(side: int) -> tuple[int, int]:
+        return (side, side) if grid is None else grid_size(org_size, side)
+
+    sizes = [size_of(side) for side in pixel_dimensions]
+    reference_size = size_of(reference or max(pixel_dimensions))
+    base_size = tuple(
+        min(org_side, 3 * max(size[axis] for size in sizes + [reference_size]))
+        for axis, org_side in enumerate(org_size)
+    )
+    org_image.draft("RGB", base_size)
+    org_image.load()
+
+    # Build the pyramid of grids from a shared base level
+    stages.start("downscale")
+    base = (
+        _to_8_bit(org_image)
+        .convert("RGB")
+        .resize(base_size, Image.Resampling.BOX, reducing_gap=3.0)
+    )
+    levels = [downscale_image(base, size, resample) for size in sizes]
+
+    if quantizer == "direct":
+        # Map every tile to its nearest tile color, without clustering
+        stages.start("remap")
+        level_indices = [
+            map_to_palette(level, tile_colors, dither, color_space) for level in levels
+        ]
+    else:
+        # Cluster the colors once, at the reference size
+        stages.start("cluster")
+        reference_grid = downscale_image(base, reference_size, resample)
+        _, found_colors = cluster_image_colors(
+            reference_grid,
+            n_colors=_cluster_count(
+                n_clusters, tile_colors, reference_grid.width * reference_grid.height
+            ),
+            quantizer=quantizer,
+            color_space=color_space,
+        )
+
+        # Assign every tile to its nearest cluster, and that to its tile color
+        stages.start("remap")
+        level_indices = _nearest_tiles(
+            levels, found_colors, tile_colors, color_space, match
+        )
+
+    results = [
+        _make_tiles(tile_indices, tile_colors, orientation, org_size, output_scale)
+        for tile_indices in level_indices
+    ]
+    stages.finish()
+
+    return results
+
+
+def tile_animation(
+    image_path: str | bytes | BinaryIO,
+    tile_colors: tuple[tuple[int, int, int]] = default_tile_colors,
+    pixel_dimensions=50,
+    grid: tuple[int, int] | str | None = None,
+    quantizer="kmeans",
+    color_space="rgb",
+    dither="none",
+    resample=Image.Resampling.BICUBIC,
+    output_scale=None,
+    sample_frames=8,
+    max_frames: int | None = None,
+    n_clusters: int | str | None = None,
+    match="unique",
+    progress: Callable[[str], None] | None = None,
+) -> tuple[list[Image.Image], tuple[int, int], dict]:
+    """Pixelates and tiles every frame of an animated image, such as a GIF.
+
+    The frames are decoded one at a time and only their grids are kept. The
+    colors are clustered once, on an evenly spaced sample of the grids, and
+    matched to the tile colors once; every frame then assigns its tiles to the
+    nearest of those clusters. Sharing the clusters keeps the cost of each
+    frame close to that of the "direct" quantizer, and keeps a color from
+    flickering between tile colors from one frame to the next.
+
+    Args:
+        image_path: Path to the image file being processed, a binary file-like
+        object to read it from, or its encoded bytes. Still images are treated
+        as a single frame.
+        tile_colors: List of RGB tuples to use for the final tiling.
+        Defaults to default_tile_colors (red, black, gray, white).
+        pixel_dimensions: The side length of the square nxn grid, or of the
+        longest side of an "auto" grid. Defaults to 50.
+        grid: The (columns, rows) of the grid, "auto" or None, see tile_grid.
+        Defaults to None.
+        quantizer: Name of the clustering backend, or "direct", see tile_grid.
+        Defaults to "kmeans".
+        color_space: The color space the colors are clustered and matched in,
+        see COLOR_SPACES. Defaults to "rgb".
+        dither: The dithering of the "direct" quantizer, see map_to_palette.
+        Defaults to "none".
+        resample: The resampling filter used to pixelate the frames, or
+        "block", see downscale_image. Defaults to Image.Resampling.BICUBIC.
+        output_scale: The size in pixels of each tile in the result. Defaults
+        to None, which keeps the size of the original image.
+        sample_frames: The number of frames the colors are clustered on.
+        Defaults to 8.
+        max_frames: The maximum number of frames. Defaults to None, no limit.
+        n_clusters: The number of clusters, or "auto", see tile_array.
+        Defaults to None, one per tile color.
+        match: How clusters are matched to tile colors, see match_colors.
+        Defaults to "unique".
+        progress: Called with the name of each stage of the pipeline as it
+        starts: "decode", "downscale", "cluster" and "remap". Defaults to None.
+
+    Returns:
+        tuple[list[Image], tuple[int, int], dict]: The "P" mode grid of every
+        frame, the size they should be upscaled to, and the "durations" of the
+        frames in milliseconds, "loop" count and "format" of the animation.
+
+    Raises:
+        ValueError: If the image has more than max_frames frames, or there are
+        more than MAX_TILE_COLORS tile colors.
+    """
+    _check_palette(tile_colors)
+    stages = StageTimer(progress)
+
+    stages.start("decode")
+    org_image, orientation = _open_image(image_path)
+    org_size = org_image.size
+    size = _resolve_grid(grid, pixel_dimensions, org_size)
+    if orientation in (6, 8) and grid not in (None, "auto"):
+        size = size[::-1]
+    info = {
+        "durations": [],
+        "loop": org_image.info.get("loop", 0),
+        "format": org_image.format,
+    }
+
+    # Decode the frames one at a time, keeping only their grids
+    stages.start("downscale")
+    grids = []
+    for frame in ImageSequence.Iterator(org_image):
+        if max_frames is not None and len(grids) >= max_frames:
+            raise ValueError(f"The animation has more than {max_frames} frames")
+        grids.append(downscale_image(_to_8_bit(frame).convert("RGB"), size, resample))
+        info["durations"].append(frame.info.get("duration", 100))
+
+    if quantizer == "direct":
+        stages.start("remap")
+        frame_indices = [
+            map_to_palette(pixelated, tile_colors, dither, color_space)
+            for pixelated in grids
+        ]
+    else:
+        # Cluster the colors once, on the sampled grids stacked into one image
+        stages.start("cluster")
+        samples = np.unique(
+            np.linspace(0, len(grids) - 1, min(sample_frames, len(grids))).round()
+        )
+        stacked = np.concatenate([np.asarray(grids[int(i)]) for i in samples])
+        _, found_colors = cluster_image_colors(
+            Image.fromarray(stacked),
+            n_colors=_cluster_count(
+                n_clusters, tile_colors, stacked.shape[0] * stacked.shape[1]
+            ),
+            quantizer=quantizer,
+            color_space=color_space,
+        )
+
+        stages.start("remap")
+        frame_indices = _nearest_tiles(
+            grids, found_colors, tile_colors, color_space, match
+        )
+
+    frames = []
+    for tile_indices in frame_indices:
+        tiles, output_size = _make_tiles(
+            tile_indices, tile_colors, orientation, org_size, output_scale
+        )
+        frames.append(tiles)
+    stages.finish()
+
+    return frames, output_size, info
+
+
+class PreparedImage:
+    """An image decoded once, to be tiled many times with different parameters.
+
+    The image is decoded at reduced scale where possible, rotated according to
+    its EXIF orientation, and kept as a pyramid of levels, each half the size
+    of the previous one. Tiling downscales from the smallest level that is a
+    few times larger than the grid, and reuses the clusters of earlier tilings
+    of the same grid through cluster_cache, so a new palette with the same
+    number of colors only reruns the remap stage.
+    """
+
+    def __init__(
+        self,
+        image_path: str | bytes | BinaryIO,
+        max_side=2048,
+        progress: Callable[[str], None] | None = None,
+    ):
+        """Decode the image.
+
+        Args:
+            image_path: Path to the image file, a binary file-like object to
+            read it from, or its encoded bytes.
+            max_side (int, optional): The longest side of the largest level.
+            Defaults to 2048.
+            progress (optional): Called with "decode" as it starts.
+            Defaults to None.
+        """
+        stages = StageTimer(progress)
+        stages.start("decode")
+
+        org_image, orientation = _open_image(image_path)
+        width, height = org_image.size
+        org_image = _to_8_bit(org_image)
+        org_image.thumbnail((max_side, max_side), Image.Resampling.BOX)
+        image = org_image.convert("RGB")
+
+        # Rotate the image if necessary
+        if orientation == 3:
+            image = image.transpose(Image.ROTATE_180)
+        elif orientation == 6:
+            image = image.transpose(Image.ROTATE_270)
+            width, height = height, width
+        elif orientation == 8:
+            image = image.transpose(Image.ROTATE_90)
+            width, height = height, width
+
+        self.size = (width, height)
+        self.levels = [image]
+        while min(self.levels[-1].size) >= 64:
+            self.levels.append(self.levels[-1].reduce(2))
+
+        stages.finish()
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the pyramid levels."""
+        return sum(level.width * level.height * 3 for level in self.levels)
+
+    def tile(
+        self,
+        tile_colors: tuple[tuple[int, int, int]] = default_tile_colors,
+        pixel_dimensions=50,
+        grid: tuple[int, int] | str | None = None,
+        quantizer="kmeans",
+        color_space="rgb",
+        dither="none",
+        resample=Image.Resampling.BICUBIC,
+        output_scale=None,
+        n_clusters: int | str | None = None,
+        match="unique",
+        inventory: Sequence[int] | None = None,
+        progress: Callable[[str], None] | None = None,
+    ) -> tuple[Image.Image, tuple[int, int]]:
+        """Pixelates and tiles the image, without upscaling the result.
+
+        Args:
+            The same as tile_grid, without image_path.
+
+        Returns:
+            tuple[Image, tuple[int, int]]: The grid and the size it should be
+            upscaled to, as returned by tile_grid.
+        """
+        stages = StageTimer(progress)
+        size = _resolve_grid(grid, pixel_dimensions, self.size)
+
+        # Downscale from the smallest level that is still large enough
+        stages.start("downscale")
+        level = next(
+            (
+                level
+                for level in reversed(self.levels)
+                if level.width >= 3 * size[0] and level.height >= 3 * size[1]
+            ),
+            self.levels[0],
+        )
+        pixelated = downscale_image(level, size, resample)
+        stages.finish()
+
+        tile_indices = tile_array(
+            _rgb_pixels(pixelated),
+            tile_colors,
+            quantizer,
+            color_space,
+            dither,
+            n_clusters,
+            match,
+            inventory,
+            progress=progress,
+        )
+        return _make_tiles(tile_indices, tile_colors, None, self.size, output_scale)
+
+
+def _resolve_grid(
+    grid: tuple[int, int] | str | None, pixel_dimensions: int, image_size
+) -> tuple[int, int]:
+    """Finds the (columns, rows) of a grid argument, see tile_grid."""
+    if grid is None:
+        return (pixel_dimensions, pixel_dimensions)
+    if grid == "auto":
+        return grid_size(image_size, pixel_dimensions)
+
+    size = tuple(grid)
+    if len(size) != 2 or min(size) < 1:
+        raise ValueError(f"grid must be positive (columns, rows), not {grid!r}")
+    return size
+
+
+def _nearest_tiles(
+    images: Sequence[Image.Image],
+    found_colors: np.ndarray,
+    tile_colors: Sequence[tuple[int, int, int]],
+    color_space: str,
+    match="unique",
+) -> list[np.ndarray]:
+    """Assigns every pixel of each image to its nearest found color, and that to
+    its matched tile color, returning the tile color indices of each image.
+
+    The nearest found colors are looked up once per distinct pixel color with
+    nearest_colors, so no pixels by clusters distance matrix is built."""
+    indices = match_colors(found_colors, tile_colors, color_space, match)
+    indices = indices.astype(np.uint8)
+    image_indices = []
+    for image in images:
+        packed, inverse = np.unique(
+            _pack_colors(_rgb_pixels(image).reshape(-1, 3)), return_inverse=True
+        )
+        colors = np.stack([packed >> 16, (packed >> 8) & 255, packed & 255], axis=-1)
+        labels = nearest_colors(colors, found_colors, color_space)
+        image_indices.append(
+            indices[labels][inverse].reshape(image.height, image.width)
+        )
+    return image_indices
+
+
+def _rgb_pixels(image: Image.Image) -> np.ndarray:
+    """Gets the (height, width, 3) uint8 pixels of an image, converting it only
+    if it is not RGB already."""
+    return np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+
+
+def _open_image(image_path: str | bytes | BinaryIO) -> tuple[Image.Image, int]:
+    """Opens an image without decoding it, returning it and its EXIF orientation."""
+    if isinstance(image_path, bytes):
+        image_path = BytesIO(image_path)
+    org_image = Image.open(image_path)
+    return org_image, org_image.getexif().get(274)
+
+
+def _make_tiles(
+    tile_indices: np.ndarray,
+    tile_colors: Sequence[tuple[int, int, int]],
+    orientation: int | None,
+    org_size: tuple[int, int],
+    output_scale: int | None,
+) -> tuple[Image.Image, tuple[int, int]]:
+    """Builds the "P" mode grid of tile indices, rotated according to the EXIF
+    orientation, and finds the size it should be upscaled to."""
+    tiles = Image.fromarray(np.asarray(tile_indices, dtype=np.uint8))
+    tiles.putpalette(np.asarray(tile_colors, dtype=np.uint8).tobytes())
 
     # Rotate the image if necessary
     if orientation == 3:
-        upscaled = upscaled.transpose(Image.ROTATE_180)
+        tiles = tiles.transpose(Image.ROTATE_180)
     elif orientation == 6:
-        upscaled = upscaled.transpose(Image.ROTATE_270)
+        tiles = tiles.transpose(Image.ROTATE_270)
+        org_size = org_size[::-1]
     elif orientation == 8:
-        upscaled = upscaled.transpose(Image.ROTATE_90)
+        tiles = tiles.transpose(Image.ROTATE_90)
+        org_size = org_size[::-1]
+
+    if output_scale is None:
+        return tiles, org_size
+    return tiles, (tiles.width * output_scale, tiles.height * output_scale)
+
+
+def tile_image(
+    image_path: str | bytes | BinaryIO,
+    tile_colors: tuple[tuple[int, int, int]] = default_tile_colors,
+    pixel_dimensions=50,
+    grid: tuple[int, int] | str | None = None,
+    quantizer="kmeans",
+    color_space="rgb",
+    dither="none",
+    resample=Image.Resampling.BICUBIC,
+    output_scale=None,
+    palettized=False,
+    n_clusters: int | str | None = None,
+    match="unique",
+    inventory: Sequence[int] | None = None,
+    bom=False,
+    progress: Callable[[str], None] | None = None,
+) -> Image.Image | tuple[Image.Image, dict]:
+    """Pixelates and tiles an image using a specified set of colors.
+
+    Args:
+        image_path: Path to the image file being processed, a binary file-like
+        object to read it from, or its encoded bytes.
+        tile_colors: List of RGB tuples to use for the final tiling.
+        Defaults to default_tile_colors (red, black, gray, white).
+        pixel_dimensions: The side length of the square nxn grid, or of the
+        longest side of an "auto" grid. Defaults to 50.
+        grid: The (columns, rows) of the grid, "auto" for the grid with
+        pixel_dimensions tiles along the longest side that preserves the
+        aspect ratio of the image, see grid_size, or None for a square grid.
+        Defaults to None.
+        quantizer: Name of the clustering backend, see cluster_image_colors,
+        or "direct" to map every tile to its nearest tile color without
+        clustering, see map_to_palette. Defaults to "kmeans".
+        color_space: The color space the colors are clustered and matched in,
+        see COLOR_SPACES. Defaults to "rgb".
+        dither: The dithering of the "direct" quantizer, see map_to_palette.
+        Defaults to "none".
+        resample: The resampling filter used to pixelate the image, or "block",
+        see downscale_image. Defaults to Image.Resampling.BICUBIC.
+        output_scale: The size in pixels of each tile in the result. Defaults to
+        None, which upscales the result back to the size of the original image.
+        Use 1 to get the nxn grid itself.
+        palettized: Whether to return a "P" mode image whose palette is
+        tile_colors, so each pixel value is the index of its tile color.
+        Defaults to False, which returns an RGB image.
+        n_clusters: The number of clusters, or "auto", see tile_array.
+        Defaults to None, one per tile color.
+        match: How clusters are matched to tile colors, "unique" or "nearest",
+        see match_colors. Defaults to "unique".
+        inventory: The number of tiles available of each tile color, see
+        assign_inventory. Defaults to None, no limit.
+        bom: Whether to also return the bill of materials of the grid, see
+        bill_of_materials. Defaults to False.
+        progress: Called with the name of each stage of the pipeline as it
+        starts: "decode", "downscale", "cluster", "remap" and "upscale".
+        Defaults to None. The stages are also timed, see StageTimer.
+
+    Returns:
+        Image | tuple[Image, dict]: The processed image, and its bill of
+        materials if bom is True.
+    """
+    tiles, size = tile_grid(
+        image_path,
+        tile_colors,
+        pixel_dimensions,
+        grid,
+        quantizer=quantizer,
+        color_space=color_space,
+        dither=dither,
+        resample=resample,
+        output_scale=output_scale,
+        n_clusters=n_clusters,
+        match=match,
+        inventory=inventory,
+        progress=progress,
+    )
+
+    # Upscale the image back
+    stages = StageTimer(progress)
+    stages.start("upscale")
+    upscaled = upscale_grid(tiles, size)
+    if not palettized:
+        upscaled = upscaled.convert("RGB")
+    stages.finish()
 
     # upscaled.show()
+    if bom:
+        return upscaled, bill_of_materials(tiles)
     return upscaled
 
 
+def iter_upscaled_png(
+    grid: Image.Image,
+    size: tuple[int, int],
+    palettized=True,
+    band_rows=64,
+    compress_level=6,
+) -> Iterator[bytes]:
+    """Encodes a tile grid as a PNG upscaled to size, in chunks.
+
+    The upscaled image is generated from the grid one band of rows at a time
+    and fed incrementally to the compressor, so memory use does not depend on
+    size and the first bytes are available before encoding finishes. The
+    result is the same image as upscaling with NEAREST resampling.
+
+    Args:
+        grid (Image): A "P" mode image, as returned by tile_grid.
+        size (tuple[int, int]): The (width, height) to upscale to.
+        palettized (bool, optional): Whether to encode a palette PNG, rather
+        than an RGB one. Defaults to True.
+        band_rows (int, optional): Number of rows generated at once.
+        Defaults to 64.
+        compress_level (int, optional): The zlib compression level. Defaults to 6.
+
+    Yields:
+        bytes: Consecutive chunks of the PNG file.
+    """
+    width, height = size
+    indices = np.asarray(grid)
+    palette = np.array(grid.getpalette(), dtype=np.uint8).reshape(-1, 3)
+
+    # The grid row and column of each output pixel, as sampled by NEAREST
+    rows = _nearest_indices(height, grid.height)
+    columns = _nearest_indices(width, grid.width)
+
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data))
+        )
+
+    color_type = 3 if palettized else 2
+    yield b"\x89PNG\r\n\x1a\n" + chunk(
+        b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    )
+    if palettized:
+        yield chunk(b"PLTE", palette.tobytes())
+
+    compressor = zlib.compressobj(compress_level)
+    for start in range(0, height, band_rows):
+        band = indices[rows[start : start + band_rows]][:, columns]
+        if not palettized:
+            band = palette[band].reshape(len(band), -1)
+
+        # Every scanline starts with filter type 0 (none)
+        scanlines = np.zeros((len(band), band.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 1:] = band
+
+        data = compressor.compress(scanlines.tobytes())
+        if data:
+            yield chunk(b"IDAT", data)
+
+    yield chunk(b"IDAT", compressor.flush()) + chunk(b"IEND", b"")
+
+
+# The formats encode_animation can write
+ANIMATION_FORMATS = ("GIF", "WEBP")
+
+
+def encode_animation(
+    frames: Sequence[Image.Image],
+    size: tuple[int, int],
+    info: dict,
+    output_format: str | None = None,
+) -> bytes:
+    """Upscales and encodes the frames returned by tile_animation.
+
+    Args:
+        frames (Sequence[Image]): The "P" mode grid of every frame.
+        size (tuple[int, int]): The size to upscale the frames to.
+        info (dict): The durations, loop count and format of the animation.
+        output_format (str, optional): "GIF", or "WEBP" for a lossless WebP.
+        Defaults to None, which keeps the format of a WebP input and uses GIF
+        otherwise.
+
+    Returns:
+        bytes: The encoded animation.
+    """
+    output_format = (output_format or info["format"] or "GIF").upper()
+    if output_format not in ANIMATION_FORMATS:
+        output_format = "GIF"
+
+    stages = StageTimer()
+    stages.start("upscale")
+    upscaled = [upscale_grid(tiles, size) for tiles in frames]
+    if output_format == "WEBP":
+        upscaled = [frame.convert("RGB") for frame in upscaled]
+
+    stages.start("encode")
+    buffer = BytesIO()
+    options = {"lossless": True} if output_format == "WEBP" else {"optimize": False}
+    upscaled[0].save(
+        buffer,
+        format=output_format,
+        save_all=True,
+        append_images=upscaled[1:],
+        duration=info["durations"],
+        loop=info["loop"],
+        **options,
+    )
+    stages.finish()
+
+    return buffer.getvalue()
+
+
+def tile_images(
+    images: Iterable[str | bytes | BinaryIO],
+    params: Sequence[dict] | None = None,
+    max_workers=None,
+    **kwargs,
+) -> Iterator[tuple[int, Image.Image | None, Exception | None]]:
+    """Tiles many images concurrently.
+
+    The images are processed on a thread pool and the results are yielded as
+    they finish, so they are not necessarily in the same order as images. An
+    error in one image does not stop the others from being processed.
+
+    Args:
+        images: The images to process, in any form accepted by tile_image.
+        params: Keyword arguments of tile_image for each image, which override
+        kwargs. Defaults to None, which uses kwargs for every image.
+        max_workers: Maximum number of images processed at once. Defaults to
+        None, which uses the ThreadPoolExecutor default.
+        **kwargs: Keyword arguments of tile_image shared by every image.
+
+    Yields:
+        tuple[int, Image | None, Exception | None]: The index of the image, and
+        either the processed image or the error raised while processing it.
+    """
+    images = list(images)
+    params = params or [{}] * len(images)
+    if len(params) != len(images):
+        raise ValueError("params must have one entry per image")
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {
+            executor.submit(tile_image, image, **{**kwargs, **image_params}): index
+            for index, (image, image_params) in enumerate(zip(images, params))
+        }
+
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
+
+
+def warm_up() -> float:
+    """Runs the pipeline once on a tiny synthetic image.
+
+    This pays the one-time costs of the first request ahead of time: importing
+    scikit-learn and SciPy, and starting the thread pools used by KMeans. The
+    stages are not timed, so the warm-up does not show up in stage metrics.
+
+    Returns:
+        float: The seconds taken.
+    """
+    start = time.perf_counter()
+
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8))
+    pixelated = downscale_image(image, (8, 8))
+    labels, found_colors = cluster_image_colors(pixelated, len(default_tile_colors))
+    indices = match_colors(found_colors, default_tile_colors)
+    tiles, size = _make_tiles(indices[labels], default_tile_colors, None, (32, 32), 4)
+    upscale_grid(tiles, size)
+
+    return time.perf_counter() - start
+
+
 if __name__ == "__main__":
-    tile_image("test_image_2.jpg", default_tile_colors, 200)
+    from server.cli import main
+
+    sys.exit(main())
@@ -0,0 +1,48 @@
+# pylint: disable=missing-module-docstring
+import unittest
+
+from server import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    """Tests for the pipeline benchmark."""
+
+    def test_run_benchmark(self):
+        matrix = {
+            "image_sizes": [(64, 48)],
+            "pixel_dimensions": [8],
+            "n_colors": [2, 3],
+        }
+
+        results = benchmark.run_benchmark(matrix, repeats=1)
+
+        self.assertEqual(
+            [result["case"] for result in results["results"]],
+            ["64x48/8px/2colors", "64x48/8px/3colors"],
+        )
+        for result in results["results"]:
+            self.assertEqual(list(result["stages"]), list(benchmark.STAGES))
+            self.assertTrue(
+                all(stage["seconds"] >= 0 for stage in result["stages"].values())
+            )
+            self.assertGreater(result["stages"]["upscale"]["peak_bytes"], 0)
+
+    def test_compare_results(self):
+        def results(**seconds):
+            stages = {stage: {"seconds": value} for stage, value in seconds.items()}
+            return {"results": [{"case": "case", "stages": stages}]}
+
+        baseline = results(downscale=0.010, encode=0.100, upscale=0.0001)
+        current = results(downscale=0.011, encode=0.150, upscale=0.0005)
+
+        regressions = benchmark.compare_results(current, baseline, threshold=0.2)
+
+        # Only the encode stage is both relatively and absolutely slower
+        self.assertEqual(
+            [regression["stage"] for regression in regressions], ["encode"]
+        )
+        self.assertAlmostEqual(regressions[0]["ratio"], 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
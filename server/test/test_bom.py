@@ -0,0 +1,75 @@
+# pylint: disable=missing-module-docstring
+import json
+import os
+import unittest
+
+import numpy as np
+
+from server import pixelator
+from server.bom import bill_of_materials, bom_to_csv, bom_to_json
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class TestBillOfMaterials(unittest.TestCase):
+    """Tests for the bill of materials of a tile grid."""
+
+    def test_counts_from_indices(self):
+        indices = np.array([[0, 2, 2], [2, 0, 2]], dtype=np.uint8)
+        bom = bill_of_materials(indices, [(255, 0, 0), (0, 0, 0), (255, 255, 255)])
+
+        self.assertEqual((bom["width"], bom["height"], bom["total"]), (3, 2, 6))
+        self.assertEqual(
+            bom["colors"],
+            [
+                {"index": 0, "color": "#FF0000", "count": 2},
+                {"index": 1, "color": "#000000", "count": 0},
+                {"index": 2, "color": "#FFFFFF", "count": 4},
+            ],
+        )
+        with self.assertRaises(ValueError):
+            bill_of_materials(indices, [(255, 0, 0)])
+        with self.assertRaises(ValueError):
+            bill_of_materials(indices)
+
+    def test_tile_grid(self):
+        palette = [(255, 0, 0), (0, 0, 0), (128, 128, 128), (255, 255, 255)]
+        tiles, _ = pixelator.tile_grid(
+            os.path.join(TEST_DIR, "test_image_1.jpg"), palette, 20
+        )
+        bom = bill_of_materials(tiles)
+
+        self.assertEqual(bom["total"], 400)
+        self.assertEqual(
+            [color["color"] for color in bom["colors"]][:2], ["#FF0000", "#000000"]
+        )
+        self.assertEqual(sum(color["count"] for color in bom["colors"]), 400)
+        np.testing.assert_array_equal(bom["indices"], np.asarray(tiles))
+
+    def test_tile_image(self):
+        palette = [(255, 0, 0), (0, 0, 0), (128, 128, 128), (255, 255, 255)]
+        image_path = os.path.join(TEST_DIR, "test_image_1.jpg")
+        tiles, _ = pixelator.tile_grid(image_path, palette, 20)
+
+        image, bom = pixelator.tile_image(
+            image_path, palette, 20, output_scale=3, bom=True
+        )
+
+        self.assertEqual(image.size, (60, 60))
+        np.testing.assert_array_equal(bom["indices"], np.asarray(tiles))
+
+    def test_export(self):
+        bom = bill_of_materials(
+            np.array([[1, 0], [1, 1]]), [(0, 0, 0), (255, 255, 255)]
+        )
+
+        self.assertEqual(
+            bom_to_csv(bom), "index,color,count\n0,#000000,1\n1,#FFFFFF,3\n"
+        )
+        data = json.loads(bom_to_json(bom))
+        self.assertEqual(data["indices"], [[1, 0], [1, 1]])
+        self.assertEqual(data["colors"][1]["count"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+# pylint: disable=missing-module-docstring
+import os
+import tempfile
+import time
+import unittest
+
+from server.cache import DiskCache, LRUCache, ResultCache, make_key
+
+
+class TestMakeKey(unittest.TestCase):
+    """Tests for the make_key function."""
+
+    def test_key_depends_on_data_and_params(self):
+        key = make_key(b"image", pixel_dimensions=50, quantizer="kmeans")
+
+        self.assertEqual(
+            key, make_key(b"image", quantizer="kmeans", pixel_dimensions=50)
+        )
+        self.assertNotEqual(
+            key, make_key(b"other", pixel_dimensions=50, quantizer="kmeans")
+        )
+        self.assertNotEqual(
+            key, make_key(b"image", pixel_dimensions=25, quantizer="kmeans")
+        )
+
+    def test_tuples_and_lists_are_equivalent(self):
+        self.assertEqual(
+            make_key(b"image", tile_colors=[(255, 0, 0)]),
+            make_key(b"image", tile_colors=[[255, 0, 0]]),
+        )
+
+
+class TestLRUCache(unittest.TestCase):
+    """Tests for the LRUCache class."""
+
+    def test_hits_and_misses(self):
+        cache = LRUCache()
+        cache.set("a", b"1")
+
+        self.assertEqual(cache.get("a"), b"1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", b"1")
+        cache.set("b", b"2")
+        cache.get("a")
+        cache.set("c", b"3")
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_evicts_to_stay_within_size(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set("a", b"12345")
+        cache.set("b", b"12345")
+        cache.set("c", b"123")
+
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.size, 8)
+
+        # Values larger than the whole cache are not stored
+        cache.set("d", b"12345678901")
+        self.assertNotIn("d", cache)
+
+    def test_delete(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set("a", b"123")
+
+        self.assertTrue(cache.delete("a"))
+        self.assertFalse(cache.delete("a"))
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+
+class TestDiskCache(unittest.TestCase):
+    """Tests for the DiskCache class."""
+
+    def setUp(self):
+        self.directory = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hits_and_misses(self):
+        cache = DiskCache(self.directory.name)
+        cache.set("a", b"1")
+
+        self.assertEqual(cache.get("a"), b"1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 1, "entries": 1, "bytes": 1}
+        )
+
+    def test_evicts_least_recently_used_file(self):
+        cache = DiskCache(self.directory.name, max_bytes=10)
+        cache.set("a", b"12345")
+        cache.set("b", b"12345")
+
+        # Make "a" the most recently used file
+        os.utime(os.path.join(self.directory.name, "b"), (1, time.time()))
+        cache.set("c", b"123")
+
+        self.assertEqual(cache.get("a"), b"12345")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"123")
+
+    def test_expires_old_files(self):
+        cache = DiskCache(self.directory.name, ttl=60)
+        cache.set("a", b"1")
+        os.utime(os.path.join(self.directory.name, "a"), (1, time.time() - 120))
+
+        self.assertIsNone(cache.get("a"))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "a")))
+
+
+class TestResultCache(unittest.TestCase):
+    """Tests for the ResultCache class."""
+
+    def test_promotes_disk_hits_to_memory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory=directory)
+            cache.set("a", b"1")
+            cache.memory.clear()
+
+            self.assertEqual(cache.get("a"), b"1")
+            self.assertIn("a", cache.memory)
+            self.assertEqual(cache.stats()["disk"]["hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# pylint: disable=missing-module-docstring
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from server import cli
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class TestCli(unittest.TestCase):
+    """Tests for the command line tool."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.inputs = os.path.join(self.directory, "inputs")
+        self.output = os.path.join(self.directory, "outputs")
+        os.makedirs(os.path.join(self.inputs, "nested"))
+        shutil.copy(os.path.join(TEST_DIR, "test_image_1.jpg"), self.inputs)
+        shutil.copy(
+            os.path.join(TEST_DIR, "test_image_2.bmp"),
+            os.path.join(self.inputs, "nested"),
+        )
+
+    def run_cli(self, *args) -> tuple[int, str]:
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            code = cli.main([*args, "--output", self.output, "-n", "8"])
+        return code, stdout.getvalue()
+
+    def test_find_images(self):
+        self.assertEqual(
+            cli.find_images([self.inputs]),
+            [os.path.join(self.inputs, "test_image_1.jpg")],
+        )
+        self.assertEqual(
+            cli.find_images([os.path.join(self.inputs, "**", "*.*")] * 2),
+            [
+                os.path.join(self.inputs, "nested", "test_image_2.bmp"),
+                os.path.join(self.inputs, "test_image_1.jpg"),
+            ],
+        )
+
+    def test_parse_colors(self):
+        self.assertEqual(
+            cli.parse_colors("#FF0000, 00ff80"), [(255, 0, 0), (0, 255, 128)]
+        )
+        with self.assertRaises(argparse.ArgumentTypeError):
+            cli.parse_colors("#FF00")
+
+    def test_parse_grid(self):
+        self.assertEqual(cli.parse_grid("auto"), "auto")
+        self.assertEqual(cli.parse_grid("16x9"), (16, 9))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            cli.parse_grid("16")
+
+    def test_parse_clusters_and_inventory(self):
+        self.assertEqual(cli.parse_clusters("auto"), "auto")
+        self.assertEqual(cli.parse_clusters("12"), 12)
+        self.assertEqual(cli.parse_inventory("500, 0,120"), [500, 0, 120])
+        for parse, value in (
+            (cli.parse_clusters, "0"),
+            (cli.parse_clusters, "257"),
+            (cli.parse_scale, "0"),
+            (cli.parse_inventory, "5,-1"),
+        ):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse(value)
+
+    def test_scale_limit(self):
+        with self.assertRaises(SystemExit):
+            self.run_cli(self.inputs, "--scale", "100000")
+
+    def test_skips_existing_outputs(self):
+        pattern = os.path.join(self.inputs, "**", "*.*")
+
+        code, summary = self.run_cli(pattern, "--workers", "0")
+        self.assertEqual(code, 0)
+        self.assertIn("Tiled 2 images", summary)
+        self.assertEqual(len(os.listdir(self.output)), 2)
+
+        code, summary = self.run_cli(pattern, "--workers", "0")
+        self.assertEqual(code, 0)
+        self.assertIn("Tiled 0 images", summary)
+        self.assertIn("skipped 2", summary)
+
+        # Other parameters give other outputs
+        code, summary = self.run_cli(pattern, "--workers", "0", "--dither", "ordered")
+        self.assertIn("Tiled 2 images", summary)
+        self.assertEqual(len(os.listdir(self.output)), 4)
+
+    def test_bom(self):
+        code, _ = self.run_cli(self.inputs, "--workers", "0", "--bom", "csv")
+        self.assertEqual(code, 0)
+        (name,) = [name for name in os.listdir(self.output) if name.endswith(".csv")]
+        with open(os.path.join(self.output, name), encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        self.assertEqual(lines[0], "index,color,count")
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(sum(int(line.split(",")[2]) for line in lines[1:]), 64)
+
+        # The PNG is done, but a BOM in another format is not
+        code, summary = self.run_cli(self.inputs, "--workers", "0", "--bom", "json")
+        self.assertIn("Tiled 1 images", summary)
+
+    def test_failures(self):
+        with open(os.path.join(self.inputs, "broken.png"), "wb") as file:
+            file.write(b"not an image")
+
+        code, summary = self.run_cli(self.inputs, "--workers", "0")
+
+        self.assertEqual(code, 1)
+        self.assertIn("Tiled 1 images", summary)
+        self.assertIn("1 failed", summary)
+        self.assertEqual(len(os.listdir(self.output)), 1)
+
+    def test_worker_pool(self):
+        code, summary = self.run_cli(self.inputs, "--workers", "1")
+
+        self.assertEqual(code, 0)
+        self.assertIn("Tiled 1 images", summary)
+        (name,) = os.listdir(self.output)
+        self.assertTrue(name.startswith("test_image_1-") and name.endswith(".png"))
+
+
+if __name__ == "__main__":
+    unittest.main()
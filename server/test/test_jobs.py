@@ -0,0 +1,102 @@
+# pylint: disable=missing-module-docstring
+import threading
+import time
+import unittest
+
+from server.jobs import JobStore
+from server.workers import PoolFullError
+
+
+class TestJobStore(unittest.TestCase):
+    """Tests for the JobStore class."""
+
+    def setUp(self):
+        self.store = JobStore(max_workers=1, max_pending=2, max_jobs=3)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.store.shutdown()
+
+    def wait(self, job_id):
+        """Wait for a job to finish and return its status."""
+        return self.wait_in(self.store, job_id)
+
+    def wait_in(self, store, job_id):
+        """Wait for a job of a store to finish and return its status."""
+        for _ in range(500):
+            status = store.status(job_id)
+            if status["status"] in ("done", "failed"):
+                return status
+            time.sleep(0.01)
+        self.fail(f"Job {job_id} did not finish")
+
+    def test_progress_and_result(self):
+        started = threading.Event()
+
+        def job(progress):
+            progress("cluster")
+            started.set()
+            self.release.wait()
+            return "result"
+
+        job_id = self.store.submit(job)
+        started.wait()
+
+        status = self.store.status(job_id)
+        self.assertEqual(status["status"], "running")
+        self.assertEqual(status["stage"], "cluster")
+        self.assertIsNone(self.store.result(job_id))
+
+        self.release.set()
+        status = self.wait(job_id)
+
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(status["progress"], 1)
+        self.assertEqual(self.store.result(job_id), "result")
+
+    def test_failure(self):
+        def job(progress):
+            progress("decode")
+            raise ValueError("broken image")
+
+        status = self.wait(self.store.submit(job))
+
+        self.assertEqual(status["status"], "failed")
+        self.assertEqual(status["stage"], "decode")
+        self.assertEqual(status["error"], "broken image")
+
+    def test_queue_full(self):
+        def job(progress):  # pylint: disable=unused-argument
+            self.release.wait()
+
+        self.store.submit(job)
+        self.store.submit(job)
+
+        with self.assertRaises(PoolFullError):
+            self.store.submit(job)
+
+    def test_evicts_oldest_finished_jobs(self):
+        job_ids = [self.store.add_result(index) for index in range(4)]
+
+        self.assertIsNone(self.store.status(job_ids[0]))
+        self.assertEqual(self.store.result(job_ids[3]), 3)
+
+    def test_evicts_jobs_over_max_bytes(self):
+        store = JobStore(max_workers=1, max_bytes=10)
+        self.addCleanup(store.shutdown)
+        old_id = store.add_result(b"x" * 6)
+        job_id = store.submit(lambda progress: b"y" * 6)
+
+        self.assertEqual(self.wait_in(store, job_id)["status"], "done")
+        self.assertIsNone(store.status(old_id))
+        self.assertEqual(store.result(job_id), b"y" * 6)
+        self.assertEqual(store.stats()["bytes"], 6)
+
+    def test_unknown_job(self):
+        self.assertIsNone(self.store.status("unknown"))
+        self.assertIsNone(self.store.result("unknown"))
+
+
+if __name__ == "__main__":
+    unittest.main()
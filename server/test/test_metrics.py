@@ -0,0 +1,55 @@
+# pylint: disable=missing-module-docstring
+import unittest
+
+from server.metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the Prometheus metrics."""
+
+    def test_counter(self):
+        counter = Counter("requests_total", "Requests.", ("route",))
+        counter.inc(route="/")
+        counter.inc(2, route="/")
+
+        self.assertIn('requests_total{route="/"} 3', counter.render())
+
+        with self.assertRaises(ValueError):
+            counter.inc(method="POST")
+
+    def test_gauge_function(self):
+        gauge = Gauge(
+            "queue_depth", "Queue depth.", ("queue",), function=lambda: {("jobs",): 4}
+        )
+
+        self.assertIn('queue_depth{queue="jobs"} 4', gauge.render())
+
+    def test_histogram(self):
+        histogram = Histogram(
+            "stage_seconds", "Stage duration.", ("stage",), buckets=(0.1, 1)
+        )
+        histogram.observe(0.05, stage="decode")
+        histogram.observe(0.5, stage="decode")
+        histogram.observe(5, stage="decode")
+
+        lines = histogram.render().splitlines()
+
+        self.assertEqual(lines[1], "# TYPE stage_seconds histogram")
+        self.assertIn('stage_seconds_bucket{stage="decode",le="0.1"} 1', lines)
+        self.assertIn('stage_seconds_bucket{stage="decode",le="1"} 2', lines)
+        self.assertIn('stage_seconds_bucket{stage="decode",le="+Inf"} 3', lines)
+        self.assertIn('stage_seconds_sum{stage="decode"} 5.55', lines)
+        self.assertIn('stage_seconds_count{stage="decode"} 3', lines)
+
+    def test_registry(self):
+        registry = Registry()
+        registry.register(Gauge("temperature", "Temperature.")).set(21)
+
+        self.assertEqual(
+            registry.render(),
+            "# HELP temperature Temperature.\n# TYPE temperature gauge\ntemperature 21\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
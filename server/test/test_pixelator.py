@@ -1,6 +1,11 @@
 # pylint: disable=missing-module-docstring
+import itertools
 import os
+import subprocess
+import sys
 import unittest
+from io import BytesIO
+from unittest import mock
 from PIL import Image
 import numpy as np
 
@@ -62,6 +67,37 @@ class TestImageProcessing(unittest.TestCase):
                 )
             )
 
+    def test_cluster_image_colors_quantizers(self):
+        """Test every clustering backend returns valid labels and colors."""
+        with Image.open(self.test_image_path_1) as mock_image:
+            pixelated = mock_image.resize((40, 30))
+
+            for quantizer in pixelator.QUANTIZERS:
+                with self.subTest(quantizer=quantizer):
+                    labels, colors = pixelator.cluster_image_colors(
+                        pixelated, n_colors=4, quantizer=quantizer
+                    )
+
+                    self.assertEqual(labels.shape, (30, 40))
+                    self.assertLessEqual(len(colors), 4)
+                    self.assertLess(labels.max(), len(colors))
+
+    def test_cluster_image_colors_unknown_quantizer(self):
+        """Test an unknown clustering backend is rejected."""
+        with Image.open(self.test_image_path_1) as mock_image:
+            with self.assertRaises(ValueError):
+                pixelator.cluster_image_colors(mock_image, quantizer="unknown")
+
+    def test_compare_quantizers(self):
+        """Test the quality/speed report of the clustering backends."""
+        with Image.open(self.test_image_path_1) as mock_image:
+            reports = pixelator.compare_quantizers(
+                mock_image.resize((25, 25)), quantizers=["kmeans", "median_cut"]
+            )
+
+        self.assertEqual([r["quantizer"] for r in reports], ["kmeans", "median_cut"])
+        self.assertTrue(all(r["seconds"] >= 0 and r["mse"] >= 0 for r in reports))
+
     def test_remap_colors(self):
         """Test the remapping of colors."""
         found_colors = [(250, 0, 0), (0, 0, 0)]
@@ -74,6 +110,272 @@ class TestImageProcessing(unittest.TestCase):
         self.assertEqual(color_map[(250, 0, 0)], (255, 0, 0))
         self.assertEqual(color_map[(0, 0, 0)], (128, 128, 128))
 
+    def test_remap_colors_matches_exhaustive_search(self):
+        """Test the assignment is optimal compared to trying every permutation."""
+        rng = np.random.default_rng(0)
+
+        for n_colors in range(1, 7):
+            found_colors = [tuple(c) for c in rng.integers(0, 256, (n_colors, 3))]
+            specified_colors = [tuple(c) for c in rng.integers(0, 256, (n_colors, 3))]
+
+            color_map = pixelator.remap_colors(found_colors, specified_colors)
+
+            def total(mapping):
+                return sum(
+                    np.linalg.norm(np.subtract(found, target))
+                    for found, target in mapping.items()
+                )
+
+            best = min(
+                total(dict(zip(found_colors, perm)))
+                for perm in itertools.permutations(specified_colors)
+            )
+
+            # Assert every specified color is used exactly once
+            self.assertEqual(set(color_map.values()), set(specified_colors))
+            self.assertAlmostEqual(total(color_map), best)
+
+    def test_remap_colors_rectangular(self):
+        """Test remapping when the number of found and specified colors differ."""
+        specified_colors = [(255, 0, 0), (0, 0, 0), (255, 255, 255)]
+
+        # Fewer found colors: each one gets a distinct specified color
+        color_map = pixelator.remap_colors(
+            [(10, 10, 10), (240, 10, 10)], specified_colors
+        )
+        self.assertEqual(color_map[(10, 10, 10)], (0, 0, 0))
+        self.assertEqual(color_map[(240, 10, 10)], (255, 0, 0))
+
+        # More found colors: the leftovers go to their closest specified color
+        found_colors = [(250, 0, 0), (5, 5, 5), (250, 250, 250), (0, 0, 0)]
+        color_map = pixelator.remap_colors(found_colors, specified_colors)
+        self.assertEqual(len(color_map), 4)
+        self.assertEqual(set(color_map.values()), set(specified_colors))
+        self.assertEqual(color_map[(5, 5, 5)], (0, 0, 0))
+        self.assertEqual(color_map[(0, 0, 0)], (0, 0, 0))
+
+    def test_remap_colors_large_palette(self):
+        """Test remapping scales to large palettes."""
+        rng = np.random.default_rng(1)
+        found_colors = [tuple(c) for c in rng.integers(0, 256, (256, 3)).tolist()]
+        specified_colors = [tuple(c) for c in rng.integers(0, 256, (256, 3)).tolist()]
+
+        color_map = pixelator.remap_colors(found_colors, specified_colors)
+
+        self.assertEqual(len(set(color_map.values())), len(set(specified_colors)))
+
+    def test_color_space_conversions(self):
+        """Test the sRGB conversions against reference values."""
+        colors = np.array([[255, 0, 0], [255, 255, 255], [0, 0, 0]])
+
+        np.testing.assert_allclose(
+            pixelator.rgb_to_lab(colors),
+            [[53.2408, 80.0925, 67.2032], [100, 0, 0], [0, 0, 0]],
+            atol=1e-3,
+        )
+        np.testing.assert_allclose(
+            pixelator.rgb_to_oklab(colors),
+            [[0.62796, 0.22486, 0.12585], [1, 0, 0], [0, 0, 0]],
+            atol=1e-4,
+        )
+
+    def test_delta_e_2000(self):
+        """Test CIEDE2000 against the reference pairs of Sharma et al."""
+        pairs = [
+            ((50, 2.6772, -79.7751), (50, 0, -82.7485), 2.0425),
+            ((50, -1.3802, -84.2814), (50, 0, -82.7485), 1.0),
+            ((50, 2.5, 0), (50, 0, -2.5), 4.3065),
+            ((50, 2.5, 0), (73, 25, -18), 27.1492),
+            ((2.0776, 0.0795, -1.135), (0.9033, -0.0636, -0.5514), 0.9082),
+        ]
+        distances = pixelator.delta_e_2000(
+            [first for first, _, _ in pairs], [second for _, second, _ in pairs]
+        )
+
+        np.testing.assert_allclose(
+            distances.diagonal(), [expected for _, _, expected in pairs], atol=1e-4
+        )
+
+    def test_convert_palette_cached(self):
+        """Test converted palettes are cached and read-only."""
+        palette = ((255, 0, 0), (0, 0, 255))
+        pixelator.convert_palette.cache_clear()
+
+        first = pixelator.convert_palette(palette, "oklab")
+        second = pixelator.convert_palette(palette, "oklab")
+
+        self.assertIs(first, second)
+        self.assertEqual(pixelator.convert_palette.cache_info().hits, 1)
+        self.assertFalse(first.flags.writeable)
+
+    def test_match_colors_color_space(self):
+        """Test perceptual color spaces change which colors match."""
+        found_colors = [(0, 255, 0)]
+        specified_colors = [(0, 0, 0), (192, 192, 192)]
+
+        # Green is closer to black in RGB, but perceptually closer to silver
+        self.assertEqual(
+            pixelator.match_colors(found_colors, specified_colors).tolist(), [0]
+        )
+        for color_space in ("lab", "oklab"):
+            self.assertEqual(
+                pixelator.match_colors(
+                    found_colors, specified_colors, color_space
+                ).tolist(),
+                [1],
+            )
+
+    def test_nearest_colors(self):
+        """Test the palette index finds the same colors as a brute force search."""
+        rng = np.random.default_rng(0)
+        palette = [tuple(color) for color in rng.integers(0, 256, (200, 3)).tolist()]
+        colors = rng.integers(0, 256, (300, 3))
+
+        for color_space in ("rgb", "oklab", "lab"):
+            expected = pixelator.color_distances(
+                pixelator.COLOR_SPACES[color_space](colors.astype(float)),
+                pixelator.convert_palette(tuple(palette), color_space),
+                color_space,
+            ).argmin(axis=1)
+            indices = pixelator.nearest_colors(colors, palette, color_space)
+            self.assertGreaterEqual((indices == expected).mean(), 0.99)
+
+        # Comparing in chunks finds the same colors
+        with mock.patch.object(pixelator, "LAB_CHUNK", 64):
+            np.testing.assert_array_equal(
+                pixelator.nearest_colors(colors, palette, "lab"), indices
+            )
+
+        self.assertEqual(
+            pixelator.match_colors(
+                [(0, 250, 0), (5, 255, 5)], palette[:3] + [(0, 255, 0)], match="nearest"
+            ).tolist(),
+            [3, 3],
+        )
+
+    def test_cluster_image_colors_auto(self):
+        """Test the automatic cluster count grows with the colors of an image."""
+        flat = np.zeros((20, 20, 3), dtype=np.uint8)
+        flat[:, 10:] = 255
+        labels, colors = pixelator.cluster_image_colors(flat, n_colors="auto")
+        self.assertEqual(len(colors), 2)
+        self.assertEqual(labels.shape, (20, 20))
+
+        with Image.open(self.test_image_path_1) as org_image:
+            _, colors = pixelator.cluster_image_colors(
+                org_image.resize((40, 40)), n_colors="auto", color_space="oklab"
+            )
+        self.assertIn(len(colors), pixelator.AUTO_CLUSTER_COUNTS[1:])
+
+    def test_assign_inventory(self):
+        """Test tiles are assigned within the inventory at the least cost."""
+        palette = [(0, 0, 0), (255, 255, 255), (128, 128, 128)]
+        pixels = np.zeros((4, 4, 3), dtype=np.uint8)
+        pixels[:, 2:] = 255
+        pixels[0, 0] = 40
+        labels = (pixels[..., 0] > 128).astype(int)
+        found_colors = np.array([(10, 10, 10), (255, 255, 255)])
+
+        # Only 6 black tiles, so the lightest dark tiles become gray
+        indices = pixelator.assign_inventory(
+            labels, pixels, found_colors, palette, [6, 8, 10]
+        )
+        self.assertEqual(np.bincount(indices.ravel()).tolist(), [6, 8, 2])
+        self.assertEqual(indices[0, 0], 2)
+        self.assertTrue((indices[:, 2:] == 1).all())
+
+        with self.assertRaises(ValueError):
+            pixelator.assign_inventory(labels, pixels, found_colors, palette, [4, 4, 4])
+        with self.assertRaises(ValueError):
+            pixelator.assign_inventory(labels, pixels, found_colors, palette, [16, 16])
+
+    def test_assign_inventory_many_clusters(self):
+        """Test a large transportation problem is solved within the inventory."""
+        rng = np.random.default_rng(0)
+        pixels = rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)
+        palette = [tuple(color) for color in rng.integers(0, 256, (128, 3)).tolist()]
+        found_colors = rng.integers(0, 256, (128, 3))
+        labels = rng.integers(0, 128, (64, 64))
+
+        indices = pixelator.assign_inventory(
+            labels, pixels, found_colors, palette, [40] * 128
+        )
+        self.assertEqual(indices.shape, (64, 64))
+        self.assertLessEqual(np.bincount(indices.ravel()).max(), 40)
+
+    def test_cluster_image_colors_color_space(self):
+        """Test clustering in a perceptual color space returns RGB colors."""
+        with Image.open(self.test_image_path_2) as mock_image:
+            for quantizer in ("kmeans", "histogram", "octree"):
+                labels, colors = pixelator.cluster_image_colors(
+                    mock_image, n_colors=4, quantizer=quantizer, color_space="lab"
+                )
+
+                self.assertEqual(labels.shape, mock_image.size[::-1])
+                self.assertEqual(
+                    sorted(map(tuple, colors.tolist())),
+                    [(34, 177, 76), (63, 72, 204), (237, 28, 36), (255, 255, 255)],
+                )
+
+            with self.assertRaises(ValueError):
+                pixelator.cluster_image_colors(mock_image, color_space="unknown")
+
+    def test_cluster_image_colors_array(self):
+        """Test clustering a read-only pixel array matches clustering the image."""
+        with Image.open(self.test_image_path_2) as mock_image:
+            pixels = np.array(mock_image.convert("RGB"))
+            pixels.flags.writeable = False
+
+            for quantizer in ("kmeans", "median_cut"):
+                labels, colors = pixelator.cluster_image_colors(
+                    pixels, n_colors=4, quantizer=quantizer
+                )
+                expected_labels, expected_colors = pixelator.cluster_image_colors(
+                    mock_image, n_colors=4, quantizer=quantizer
+                )
+
+                np.testing.assert_array_equal(labels, expected_labels)
+                np.testing.assert_array_equal(colors, expected_colors)
+
+    def test_palette_lut(self):
+        """Test the lookup table holds the nearest palette color of each bin."""
+        palette = ((255, 0, 0), (0, 0, 0), (255, 255, 255))
+        lut = pixelator.palette_lut(palette)
+
+        self.assertEqual(lut.shape, (32, 32, 32))
+        self.assertEqual(lut[31, 0, 0], 0)
+        self.assertEqual(lut[0, 0, 0], 1)
+        self.assertEqual(lut[31, 31, 31], 2)
+        self.assertIs(pixelator.palette_lut(palette), lut)
+
+    def test_map_to_palette(self):
+        """Test direct mapping with each dithering matches the nearest colors."""
+        palette = [(34, 177, 76), (63, 72, 204), (237, 28, 36), (255, 255, 255)]
+
+        with Image.open(self.test_image_path_2) as mock_image:
+            expected = pixelator.match_colors(
+                np.array(mock_image.convert("RGB")).reshape(-1, 3), palette[::-1]
+            )
+
+            for dither in ("none", "floyd_steinberg"):
+                indices = pixelator.map_to_palette(mock_image, palette[::-1], dither)
+                self.assertEqual(indices.shape, mock_image.size[::-1])
+                self.assertTrue(np.array_equal(indices.ravel(), expected))
+
+            with self.assertRaises(ValueError):
+                pixelator.map_to_palette(mock_image, palette, "unknown")
+
+    def test_map_to_palette_ordered_dither(self):
+        """Test ordered dithering mixes the palette colors around a midtone."""
+        gray = Image.new("RGB", (16, 16), (128, 128, 128))
+        palette = [(0, 0, 0), (255, 255, 255)]
+
+        plain = pixelator.map_to_palette(gray, palette)
+        dithered = pixelator.map_to_palette(gray, palette, "ordered")
+
+        self.assertEqual(len(np.unique(plain)), 1)
+        self.assertAlmostEqual(dithered.mean(), 0.5, delta=0.1)
+
     def test_apply_color_remapping(self):
         """Test applying the color remapping to an image."""
         with Image.open(self.test_image_path_2) as mock_image:
@@ -92,6 +394,71 @@ class TestImageProcessing(unittest.TestCase):
             # Assert all pixels are remapped correctly to black
             self.assertTrue(np.all(remapped_data == [0, 0, 0]))
 
+    def test_apply_color_remapping_missing_color(self):
+        """Test that a color missing from the mapping is reported."""
+        with Image.open(self.test_image_path_2) as mock_image:
+            with self.assertRaises(KeyError):
+                pixelator.apply_color_remapping(mock_image, {(0, 0, 0): (1, 1, 1)})
+
+    def test_apply_color_remapping_labels(self):
+        """Test applying the color remapping to a label array."""
+        labels = np.array([[0, 1], [2, 1]])
+        palette = [(255, 0, 0), (0, 0, 0), (128, 128, 128)]
+
+        remapped_image = pixelator.apply_color_remapping(labels, palette)
+
+        self.assertEqual(remapped_image.size, (2, 2))
+        self.assertEqual(remapped_image.getpixel((0, 0)), (255, 0, 0))
+        self.assertEqual(remapped_image.getpixel((1, 0)), (0, 0, 0))
+        self.assertEqual(remapped_image.getpixel((0, 1)), (128, 128, 128))
+
+    def test_downscale_image_draft(self):
+        """Test a large JPEG is decoded at reduced scale before resizing."""
+        buffer = BytesIO()
+        Image.new("RGB", (1600, 1200), (200, 30, 30)).save(buffer, "JPEG")
+        buffer.seek(0)
+
+        with Image.open(buffer) as large_image:
+            pixelated = pixelator.downscale_image(large_image, (50, 50))
+
+            # Assert the JPEG was decoded at 1/8 scale
+            self.assertEqual(large_image.size, (200, 150))
+
+        self.assertEqual(pixelated.size, (50, 50))
+        self.assertTrue(np.allclose(np.array(pixelated), (200, 30, 30), atol=3))
+
+    def test_tile_image_16_bit(self):
+        """Test a full range 16 bit grayscale PNG is tiled by its content."""
+        buffer = BytesIO()
+        gray = np.tile(np.linspace(0, 65535, 400), (300, 1)).astype(np.uint16)
+        Image.fromarray(gray).save(buffer, "PNG")
+
+        for kwargs in (
+            {},
+            {"quantizer": "direct"},
+            {"quantizer": "median_cut"},
+            {"color_space": "lab"},
+            {"grid": "auto"},
+            {"resample": "block"},
+        ):
+            buffer.seek(0)
+            with Image.open(buffer) as image:
+                self.assertEqual(image.mode, "I;16")
+            buffer.seek(0)
+            result = pixelator.tile_image(
+                buffer, pixel_dimensions=20, palettized=True, **kwargs
+            )
+            self.assertEqual(result.size, (400, 300))
+            # The dark, gray and light parts of the gradient get their own tiles
+            self.assertGreater(len(np.unique(np.asarray(result))), 1, kwargs)
+
+        buffer.seek(0)
+        for tiles, _ in [
+            *pixelator.tile_ladder(buffer.getvalue(), pixel_dimensions=(10, 20)),
+            pixelator.PreparedImage(buffer.getvalue()).tile(pixel_dimensions=20),
+        ]:
+            self.assertGreater(len(np.unique(np.asarray(tiles))), 1)
+
     def test_tile_image(self):
         """Test the full tiling process."""
 
@@ -100,6 +467,426 @@ class TestImageProcessing(unittest.TestCase):
         # Make sure it ran without errors
         self.assertIsNotNone(result_image)
 
+        # Assert the result is upscaled back to the original size
+        with Image.open(self.test_image_path_1) as org_image:
+            self.assertEqual(result_image.size, org_image.size)
+
+    def test_tile_image_palettized_grid(self):
+        """Test the tiling can return the palettized grid itself."""
+
+        result_image = pixelator.tile_image(
+            self.test_image_path_1,
+            pixel_dimensions=25,
+            output_scale=1,
+            palettized=True,
+        )
+
+        self.assertEqual(result_image.size, (25, 25))
+        self.assertEqual(result_image.mode, "P")
+        self.assertEqual(
+            result_image.getpalette(),
+            [channel for color in pixelator.default_tile_colors for channel in color],
+        )
+        self.assertLess(np.array(result_image).max(), 4)
+
+    def test_tile_image_from_memory(self):
+        """Test the tiling accepts a file-like object and bytes."""
+        with open(self.test_image_path_1, "rb") as image_file:
+            image_data = image_file.read()
+
+        from_path = pixelator.tile_image(self.test_image_path_1, pixel_dimensions=25)
+        from_file = pixelator.tile_image(BytesIO(image_data), pixel_dimensions=25)
+        from_bytes = pixelator.tile_image(image_data, pixel_dimensions=25)
+
+        self.assertTrue(np.array_equal(np.array(from_path), np.array(from_file)))
+        self.assertTrue(np.array_equal(np.array(from_path), np.array(from_bytes)))
+
+    def test_tile_image_png(self):
+        """Test the tiling of a format without JPEG EXIF support."""
+        buffer = BytesIO()
+        with Image.open(self.test_image_path_2) as mock_image:
+            mock_image.save(buffer, "PNG")
+
+            result_image = pixelator.tile_image(buffer, pixel_dimensions=10)
+
+            self.assertEqual(result_image.size, mock_image.size)
+
+    def test_tile_images(self):
+        """Test tiling many images with shared and per-image parameters."""
+        results = pixelator.tile_images(
+            [self.test_image_path_1, b"not an image", self.test_image_path_1],
+            params=[{}, {}, {"pixel_dimensions": 5}],
+            pixel_dimensions=10,
+            output_scale=1,
+        )
+        results = {index: (image, error) for index, image, error in results}
+
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self.assertEqual(results[0][0].size, (10, 10))
+        self.assertIsNone(results[0][1])
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], Exception)
+        self.assertEqual(results[2][0].size, (5, 5))
+
+    def test_grid_size(self):
+        """Test the automatic grid preserves the aspect ratio."""
+        self.assertEqual(pixelator.grid_size((3648, 2432), 30), (30, 20))
+        self.assertEqual(pixelator.grid_size((120, 400), 10), (3, 10))
+        self.assertEqual(pixelator.grid_size((1000, 1), 10), (10, 1))
+
+    def test_block_downscale(self):
+        """Test every tile is the mean of an exact block of pixels."""
+        image_data = np.arange(7 * 9 * 3, dtype=np.uint8).reshape(7, 9, 3)
+
+        result_image = pixelator.block_downscale(Image.fromarray(image_data), (4, 3))
+
+        # 2x2 blocks, after cropping one column from the right and the bottom
+        expected = image_data[:6, :8].reshape(3, 2, 4, 2, 3).mean(axis=(1, 3))
+        self.assertEqual(result_image.size, (4, 3))
+        self.assertTrue(np.array_equal(np.array(result_image), np.rint(expected)))
+
+        # Images smaller than the grid are resized instead
+        self.assertEqual(
+            pixelator.block_downscale(Image.fromarray(image_data), (20, 3)).size,
+            (20, 3),
+        )
+
+    def test_upscale_grid(self):
+        """Test upscaling by whole multiples matches a nearest neighbor resize."""
+        grid = Image.fromarray(np.array([[0, 1, 2], [2, 1, 0]], dtype=np.uint8))
+        grid.putpalette([255, 0, 0, 0, 0, 0, 255, 255, 255])
+
+        for size in [(9, 4), (6, 6), (7, 5)]:
+            upscaled = pixelator.upscale_grid(grid, size)
+            expected = grid.resize(size, Image.Resampling.NEAREST)
+
+            self.assertEqual(upscaled.mode, "P")
+            self.assertEqual(upscaled.getpalette(), grid.getpalette())
+            self.assertTrue(np.array_equal(np.array(upscaled), np.array(expected)))
+
+    def test_upscale_indices(self):
+        """Test upscaling arrays matches a nearest neighbor resize of any size."""
+        rng = np.random.default_rng(0)
+        tiles = rng.integers(0, 4, (7, 11), dtype=np.uint8)
+        colors = rng.integers(0, 256, (7, 11, 3), dtype=np.uint8)
+
+        # Whole multiples, and sizes at which the sampling rounds at a boundary
+        for size in [(22, 21), (11, 7), (23, 34), (4003, 2999), (5, 3)]:
+            expected = Image.fromarray(tiles).resize(size, Image.Resampling.NEAREST)
+            upscaled = pixelator.upscale_indices(tiles, size, band_rows=3)
+            np.testing.assert_array_equal(upscaled, np.array(expected))
+
+            expected = Image.fromarray(colors).resize(size, Image.Resampling.NEAREST)
+            np.testing.assert_array_equal(
+                pixelator.upscale_indices(colors, size), np.array(expected)
+            )
+
+        out = np.empty((21, 22), dtype=np.uint8)
+        self.assertIs(pixelator.upscale_indices(tiles, (22, 21), out=out), out)
+
+    def test_tile_grid_rectangular(self):
+        """Test explicit and automatic grids with block downscaling."""
+        for grid, size in [((30, 20), (30, 20)), ("auto", (24, 16))]:
+            tiles, output_size = pixelator.tile_grid(
+                self.test_image_path_1,
+                pixel_dimensions=24,
+                grid=grid,
+                resample="block",
+                output_scale=2,
+            )
+
+            self.assertEqual(tiles.size, size)
+            self.assertEqual(output_size, (size[0] * 2, size[1] * 2))
+
+        with self.assertRaises(ValueError):
+            pixelator.tile_grid(self.test_image_path_1, grid=(0, 10))
+
+    def test_tile_grid(self):
+        """Test the grid is the tiling before it is upscaled."""
+        grid, size = pixelator.tile_grid(self.test_image_path_1, pixel_dimensions=25)
+        result_image = pixelator.tile_image(
+            self.test_image_path_1, pixel_dimensions=25, palettized=True
+        )
+
+        self.assertEqual(grid.size, (25, 25))
+        self.assertEqual(size, result_image.size)
+        self.assertTrue(
+            np.array_equal(
+                np.array(grid.resize(size, Image.Resampling.NEAREST)),
+                np.array(result_image),
+            )
+        )
+
+    def test_tile_array(self):
+        """Test tiling a pixel array writes uint8 indices to out, and caches clusters."""
+        palette = [(255, 0, 0), (0, 0, 0), (128, 128, 128), (255, 255, 255)]
+        with Image.open(self.test_image_path_1) as org_image:
+            pixels = np.array(org_image.convert("RGB").resize((25, 25)))
+
+        for quantizer, dither in [("kmeans", "none"), ("direct", "ordered")]:
+            started = []
+            out = np.empty((25, 25), dtype=np.uint8)
+            indices = pixelator.tile_array(
+                pixels,
+                palette,
+                quantizer,
+                dither=dither,
+                out=out,
+                progress=started.append,
+            )
+
+            self.assertIs(indices, out)
+            self.assertEqual(indices.dtype, np.uint8)
+            self.assertLess(indices.max(), 4)
+            self.assertEqual(started[-1], "remap")
+
+            if quantizer == "direct":
+                expected = pixelator.map_to_palette(
+                    Image.fromarray(pixels), palette, dither
+                )
+                np.testing.assert_array_equal(indices, expected)
+
+        # Clustering an identical grid again reuses the cached clusters
+        hits = pixelator.cluster_cache.hits
+        pixelator.tile_array(pixels, palette)
+        self.assertEqual(pixelator.cluster_cache.hits, hits + 1)
+
+        # More clusters than tile colors, matched to their nearest tile colors
+        indices = pixelator.tile_array(pixels, palette, n_clusters=8, match="nearest")
+        self.assertLess(indices.max(), 4)
+
+        # There are never more clusters than tiles
+        indices = pixelator.tile_array(
+            pixels[:4, :4], palette, n_clusters=64, match="nearest"
+        )
+        self.assertEqual(indices.shape, (4, 4))
+
+        indices = pixelator.tile_array(pixels, palette, inventory=[200] * 4)
+        self.assertLessEqual(np.bincount(indices.ravel()).max(), 200)
+        with self.assertRaises(ValueError):
+            pixelator.tile_array(pixels, palette, "direct", inventory=[200] * 4)
+
+    def test_too_many_tile_colors(self):
+        """Test palettes whose indices do not fit in a uint8 are rejected."""
+        rng = np.random.default_rng(0)
+        pixels = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        palette = [tuple(color) for color in rng.integers(0, 256, (300, 3)).tolist()]
+
+        for tile in (
+            lambda: pixelator.tile_array(pixels, palette, "direct"),
+            lambda: pixelator.tile_array(pixels, palette, n_clusters=4),
+            lambda: pixelator.map_to_palette(pixels, palette),
+            lambda: pixelator.tile_grid(self.test_image_path_2, palette),
+            lambda: pixelator.tile_ladder(self.test_image_path_2, palette),
+            lambda: pixelator.tile_animation(self.test_image_path_2, palette),
+        ):
+            with self.assertRaises(ValueError):
+                tile()
+
+        # The largest palette still maps to its own indices
+        indices = pixelator.tile_array(pixels, palette[:256], "direct")
+        self.assertLess(indices.max(), 256)
+
+    def test_tile_ladder(self):
+        """Test a ladder of grid sizes clusters once and matches each grid size."""
+        started = []
+        palette = [(255, 0, 0), (0, 0, 0), (128, 128, 128), (255, 255, 255)]
+
+        results = pixelator.tile_ladder(
+            self.test_image_path_1,
+            palette,
+            pixel_dimensions=[8, 30, 16],
+            grid="auto",
+            progress=started.append,
+        )
+
+        self.assertEqual(started, ["decode", "downscale", "cluster", "remap"])
+        self.assertEqual(
+            [tiles.size for tiles, _ in results], [(8, 5), (30, 20), (16, 11)]
+        )
+        with Image.open(self.test_image_path_1) as org_image:
+            self.assertTrue(all(size == org_image.size for _, size in results))
+        for tiles, _ in results:
+            self.assertEqual(tiles.mode, "P")
+            self.assertLess(np.array(tiles).max(), 4)
+
+        # The reference grid matches tiling that size on its own
+        tiles, _ = pixelator.tile_grid(self.test_image_path_1, palette, 30, grid="auto")
+        agreement = np.mean(np.array(tiles) == np.array(results[1][0]))
+        self.assertGreater(agreement, 0.9)
+
+        with self.assertRaises(ValueError):
+            pixelator.tile_ladder(self.test_image_path_1, pixel_dimensions=[])
+
+        # There are never more clusters than tiles in the reference grid
+        results = pixelator.tile_ladder(
+            self.test_image_path_1, palette, (4, 5), n_clusters=100, match="nearest"
+        )
+        self.assertEqual([tiles.size for tiles, _ in results], [(4, 4), (5, 5)])
+
+    def test_prepared_image(self):
+        """Test a prepared image tiles like tile_grid, and reuses its clusters."""
+        prepared = pixelator.PreparedImage(self.test_image_path_1, max_side=512)
+
+        with Image.open(self.test_image_path_1) as org_image:
+            self.assertEqual(prepared.size, org_image.size)
+        self.assertEqual(prepared.levels[0].size, (512, 341))
+        self.assertGreater(prepared.nbytes, 512 * 341 * 3)
+
+        tiles, size = prepared.tile(pixel_dimensions=20, grid="auto")
+        self.assertEqual(tiles.size, (20, 13))
+        self.assertEqual(size, prepared.size)
+
+        # A new palette of the same size only remaps the cached clusters
+        started = []
+        hits = pixelator.cluster_cache.hits
+        tiles, size = prepared.tile(
+            [(0, 0, 255), (0, 0, 0), (255, 255, 0), (255, 255, 255)],
+            pixel_dimensions=20,
+            grid="auto",
+            output_scale=3,
+            progress=started.append,
+        )
+        self.assertEqual(pixelator.cluster_cache.hits, hits + 1)
+        self.assertEqual(started, ["downscale", "cluster", "remap"])
+        self.assertEqual(size, (60, 39))
+
+    def test_tile_animation(self):
+        """Test every frame of an animation is tiled with the same clusters."""
+        with Image.open(self.test_image_path_1) as org_image:
+            org_image = org_image.convert("RGB").resize((60, 40))
+        # The frames scroll the image, so their colors are the same
+        frames = [
+            Image.fromarray(np.roll(np.asarray(org_image), 6 * i, axis=1))
+            for i in range(5)
+        ]
+        buffer = BytesIO()
+        frames[0].save(
+            buffer, "GIF", save_all=True, append_images=frames[1:], duration=40
+        )
+
+        started = []
+        grids, size, info = pixelator.tile_animation(
+            buffer.getvalue(),
+            pixel_dimensions=10,
+            grid="auto",
+            sample_frames=2,
+            progress=started.append,
+        )
+
+        self.assertEqual(started, ["decode", "downscale", "cluster", "remap"])
+        self.assertEqual(len(grids), 5)
+        self.assertEqual({tiles.size for tiles in grids}, {(10, 7)})
+        self.assertEqual(size, (60, 40))
+        self.assertEqual(info["durations"], [40] * 5)
+        self.assertEqual(info["format"], "GIF")
+
+        # Every frame shows the colors of the image with the same tile colors
+        counts = [np.bincount(np.array(tiles).ravel(), minlength=4) for tiles in grids]
+        for frame_counts in counts[1:]:
+            self.assertLessEqual(np.abs(frame_counts - counts[0]).sum(), 14)
+
+        for output_format in ("GIF", "WEBP"):
+            encoded = pixelator.encode_animation(grids, size, info, output_format)
+            with Image.open(BytesIO(encoded)) as animation:
+                self.assertEqual(animation.format, output_format)
+                self.assertEqual(animation.n_frames, 5)
+                self.assertEqual(animation.size, (60, 40))
+
+        with self.assertRaises(ValueError):
+            pixelator.tile_animation(buffer.getvalue(), max_frames=4)
+
+        # A grid with fewer tiles than tile colors
+        grids, _, _ = pixelator.tile_animation(
+            buffer.getvalue(), pixel_dimensions=1, sample_frames=1
+        )
+        self.assertEqual({tiles.size for tiles in grids}, {(1, 1)})
+
+    def test_iter_upscaled_png(self):
+        """Test the streamed PNG matches upscaling and encoding with Pillow."""
+        grid, _ = pixelator.tile_grid(self.test_image_path_1, pixel_dimensions=7)
+
+        for size, palettized in itertools.product(
+            [(7, 7), (100, 61), (45, 13)], [True, False]
+        ):
+            chunks = list(
+                pixelator.iter_upscaled_png(grid, size, palettized, band_rows=16)
+            )
+            expected = grid.resize(size, Image.Resampling.NEAREST)
+            if not palettized:
+                expected = expected.convert("RGB")
+
+            with Image.open(BytesIO(b"".join(chunks))) as result_image:
+                self.assertEqual(result_image.mode, expected.mode)
+                self.assertEqual(result_image.size, size)
+                self.assertTrue(
+                    np.array_equal(np.array(result_image), np.array(expected))
+                )
+
+    def test_tile_image_direct(self):
+        """Test the direct quantizer skips clustering and may leave colors unused."""
+        started = []
+        palette = [(255, 0, 0), (0, 0, 0), (255, 255, 255), (0, 255, 255)]
+
+        result_image = pixelator.tile_image(
+            self.test_image_path_2,
+            palette,
+            pixel_dimensions=10,
+            quantizer="direct",
+            dither="ordered",
+            output_scale=1,
+            palettized=True,
+            progress=started.append,
+        )
+
+        self.assertEqual(started, ["decode", "downscale", "remap", "upscale"])
+        self.assertEqual(result_image.size, (10, 10))
+        self.assertLess(np.array(result_image).max(), 4)
+
+    def test_import_is_lazy(self):
+        """Test importing the server does not import the clustering backends."""
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, server.app; "
+                "print(sorted({m.split('.')[0] for m in sys.modules} & {'scipy', 'sklearn'}))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_warm_up(self):
+        """Test the warm-up runs without reporting pipeline stages."""
+        with pixelator.record_stages() as recorded:
+            seconds = pixelator.warm_up()
+
+        self.assertGreater(seconds, 0)
+        self.assertEqual(recorded, [])
+
+    def test_tile_image_stages(self):
+        """Test the pipeline stages are reported to hooks, progress and recorders."""
+        hooked = []
+        started = []
+        pixelator.stage_hooks.append(lambda *stage: hooked.append(stage))
+
+        try:
+            with pixelator.record_stages() as recorded:
+                pixelator.tile_image(
+                    self.test_image_path_1, pixel_dimensions=9, progress=started.append
+                )
+        finally:
+            pixelator.stage_hooks.pop()
+
+        stages = ["decode", "downscale", "cluster", "remap", "upscale"]
+        self.assertEqual(started, stages)
+        self.assertEqual([name for name, _, _ in recorded], stages)
+        self.assertEqual(hooked, recorded)
+        self.assertTrue(all(seconds >= 0 for _, seconds, _ in recorded))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -3,6 +3,7 @@
 import unittest
 
 from server.app import hex_to_rgb, validate_tile_colors
+from server.colors import rgb_to_hex
 
 
 class TestHexToRgb(unittest.TestCase):
@@ -25,6 +26,15 @@ class TestHexToRgb(unittest.TestCase):
             hex_to_rgb("1234")  # Incomplete hex string
 
 
+class TestRgbToHex(unittest.TestCase):
+    """Test the rgb_to_hex function."""
+
+    def test_valid_rgb(self):
+        self.assertEqual(rgb_to_hex((255, 255, 255)), "#FFFFFF")  # White
+        self.assertEqual(rgb_to_hex((165, 42, 42)), "#A52A2A")  # Brown
+        self.assertEqual(rgb_to_hex([0, 128, 0]), "#008000")  # Green
+
+
 class TestValidateTileColors(unittest.TestCase):
     """Test the validate_tile_colors function."""
 
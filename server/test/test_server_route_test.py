@@ -1,9 +1,17 @@
 """Test the server routes."""
 
 from io import BytesIO
+import json
+import time
 import unittest
+import zipfile
+from unittest import mock
 
+from PIL import Image
+
+from server import app as server_app
 from server.app import app
+from server.workers import PoolFullError, WorkerPool
 
 
 class AppTestCase(unittest.TestCase):
@@ -73,6 +81,626 @@ class AppTestCase(unittest.TestCase):
             "tile_colors must be a valid JSON list", response.json["error"]
         )
 
+    def test_process_image_quantizer(self):
+        """Test the route with a selected and an unknown quantizer."""
+
+        for quantizer, status_code in (
+            ("median_cut", 200),
+            ("direct", 200),
+            ("unknown", 400),
+        ):
+            with open("test_image_1.jpg", "rb") as image_file:
+
+                response = self.client.post(
+                    "/",
+                    data={
+                        "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                        "pixel_dimensions": 25,
+                        "quantizer": quantizer,
+                    },
+                    content_type="multipart/form-data",
+                )
+
+            self.assertEqual(response.status_code, status_code)
+
+    def test_process_image_color_space(self):
+        """Test the route with a selected and an unknown color space."""
+
+        for color_space, status_code in (("lab", 200), ("oklab", 200), ("hsv", 400)):
+            with open("test_image_1.jpg", "rb") as image_file:
+
+                response = self.client.post(
+                    "/",
+                    data={
+                        "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                        "pixel_dimensions": 25,
+                        "color_space": color_space,
+                    },
+                    content_type="multipart/form-data",
+                )
+
+            self.assertEqual(response.status_code, status_code)
+
+    def test_process_image_scaled_grid(self):
+        """Test the route returns the tile grid upscaled by the given factor."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+
+            response = self.client.post(
+                "/",
+                data={
+                    "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                    "pixel_dimensions": 25,
+                    "scale": 4,
+                },
+                content_type="multipart/form-data",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "image/png")
+        with Image.open(BytesIO(response.data)) as result_image:
+            self.assertEqual(result_image.size, (100, 100))
+            self.assertEqual(result_image.mode, "P")
+
+    def test_process_image_grid(self):
+        """Test the route with rectangular, automatic and invalid grids."""
+
+        for grid, downscale, status_code, size in (
+            ("30x20", "block", 200, (90, 60)),
+            ("auto", "bicubic", 200, (75, 51)),
+            ("30", "bicubic", 400, None),
+            ("0x20", "bicubic", 400, None),
+            ("30x20", "lanczos", 400, None),
+        ):
+            with open("test_image_1.jpg", "rb") as image_file:
+
+                response = self.client.post(
+                    "/",
+                    data={
+                        "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                        "pixel_dimensions": 25,
+                        "grid": grid,
+                        "downscale": downscale,
+                        "scale": 3,
+                    },
+                    content_type="multipart/form-data",
+                )
+
+            self.assertEqual(response.status_code, status_code)
+            if size is not None:
+                with Image.open(BytesIO(response.data)) as result_image:
+                    self.assertEqual(result_image.size, size)
+
+    def test_process_image_scale_limit(self):
+        """Test the route rejects scales that upscale past the pixel limit."""
+
+        for fields in (
+            {"pixel_dimensions": 10, "scale": 100_000},
+            {"pixel_dimensions": 50, "scale": 2000},
+            {"grid": "300x200", "scale": 100},
+            {"grid": "auto", "pixel_dimensions": 50, "scale": 2000},
+        ):
+            response = self.client.post(
+                "/",
+                data={"image": (BytesIO(b"unused"), "test_image_1.jpg"), **fields},
+                content_type="multipart/form-data",
+            )
+            self.assertEqual(response.status_code, 400, fields)
+
+    def test_process_image_indices(self):
+        """Test the route returns the tile grid as palette indices."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+
+            response = self.client.post(
+                "/",
+                data={
+                    "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                    "tile_colors": '["#FFFFFF", "#000000", "#A52A2A"]',
+                    "pixel_dimensions": 25,
+                    "output": "indices",
+                },
+                content_type="multipart/form-data",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["palette"], ["#FFFFFF", "#000000", "#A52A2A"])
+        self.assertEqual((response.json["width"], response.json["height"]), (25, 25))
+        self.assertEqual(len(response.json["indices"]), 25)
+        self.assertTrue(
+            all(index in (0, 1, 2) for row in response.json["indices"] for index in row)
+        )
+
+    def test_process_image_large_palette(self):
+        """Test the route with cluster counts, matches and tile inventories."""
+
+        tile_colors = json.dumps(
+            [f"#{gray:02X}{gray:02X}{gray:02X}" for gray in range(64)]
+        )
+        for fields, status_code in (
+            ({"clusters": "auto", "match": "nearest"}, 200),
+            ({"clusters": 6, "match": "nearest"}, 200),
+            ({"inventory": json.dumps([10] * 64)}, 200),
+            ({"inventory": json.dumps([1] * 64)}, 400),
+            ({"inventory": json.dumps([10] * 63)}, 400),
+            ({"inventory": json.dumps([10] * 64), "quantizer": "direct"}, 400),
+            ({"clusters": "0"}, 400),
+            ({"clusters": "257"}, 400),
+            # A 20x20 grid has fewer tiles than clusters
+            ({"clusters": "256", "match": "nearest"}, 200),
+            ({"match": "closest"}, 400),
+        ):
+            with open("test_image_1.jpg", "rb") as image_file:
+
+                response = self.client.post(
+                    "/",
+                    data={
+                        "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                        "tile_colors": tile_colors,
+                        "pixel_dimensions": 20,
+                        "output": "indices",
+                        **fields,
+                    },
+                    content_type="multipart/form-data",
+                )
+
+            self.assertEqual(response.status_code, status_code, fields)
+            if status_code == 200 and "inventory" in fields:
+                counts = [0] * 64
+                for row in response.json["indices"]:
+                    for index in row:
+                        counts[index] += 1
+                self.assertLessEqual(max(counts), 10)
+
+    def test_process_image_bom(self):
+        """Test the route returns the bill of materials as JSON or CSV."""
+
+        responses = {}
+        for output in ("bom", "bom_csv", "image_bom"):
+            with open("test_image_1.jpg", "rb") as image_file:
+
+                responses[output] = self.client.post(
+                    "/",
+                    data={
+                        "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                        "tile_colors": '["#FFFFFF", "#000000", "#A52A2A"]',
+                        "pixel_dimensions": 25,
+                        "output": output,
+                        "scale": 40,
+                    },
+                    content_type="multipart/form-data",
+                )
+            self.assertEqual(responses[output].status_code, 200)
+
+        bom = responses["bom"].json
+        self.assertEqual((bom["width"], bom["height"], bom["total"]), (25, 25, 625))
+        self.assertEqual(
+            [color["color"] for color in bom["colors"]],
+            ["#FFFFFF", "#000000", "#A52A2A"],
+        )
+        self.assertEqual(len(bom["indices"]), 25)
+
+        self.assertEqual(responses["bom_csv"].content_type, "text/csv; charset=utf-8")
+        lines = responses["bom_csv"].data.decode().splitlines()
+        self.assertEqual(lines[0], "index,color,count")
+        self.assertEqual(
+            [int(line.split(",")[2]) for line in lines[1:]],
+            [color["count"] for color in bom["colors"]],
+        )
+
+        # The image, at its scale, alongside the same bill of materials
+        self.assertEqual(responses["image_bom"].content_type, "application/zip")
+        with zipfile.ZipFile(BytesIO(responses["image_bom"].data)) as archive:
+            self.assertEqual(archive.namelist(), ["tiled.png", "bom.json"])
+            with Image.open(BytesIO(archive.read("tiled.png"))) as tiled:
+                self.assertEqual(tiled.size, (1000, 1000))
+            self.assertEqual(json.loads(archive.read("bom.json")), bom)
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            response = self.client.post(
+                "/ladder",
+                data={
+                    "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                    "ladder": "10,20",
+                    "output": "bom",
+                },
+                content_type="multipart/form-data",
+            )
+        self.assertEqual(response.status_code, 400)
+
+    def test_process_image_cached(self):
+        """Test that resubmitting the same image and parameters hits the cache."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            image_data = image_file.read()
+
+        responses = [
+            self.client.post(
+                "/",
+                data={
+                    "image": (BytesIO(image_data), "test_image_1.jpg"),
+                    "pixel_dimensions": 20,
+                    "scale": 2,
+                },
+                content_type="multipart/form-data",
+            )
+            for _ in range(2)
+        ]
+
+        self.assertEqual(responses[1].status_code, 200)
+        self.assertEqual(responses[1].headers["X-Cache"], "HIT")
+        self.assertEqual(responses[0].data, responses[1].data)
+        self.assertGreater(
+            self.client.get("/cache").json["results"]["memory"]["hits"], 0
+        )
+
+    def test_process_image_streamed(self):
+        """Test a streamed PNG is the same as the buffered one, and is cached."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            image_data = image_file.read()
+
+        def post(**fields):
+            return self.client.post(
+                "/",
+                data={
+                    "image": (BytesIO(image_data), "test_image_1.jpg"),
+                    "pixel_dimensions": 13,
+                    **fields,
+                },
+                content_type="multipart/form-data",
+            )
+
+        streamed = post(stream="true", scale=3)
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(streamed.content_type, "image/png")
+        self.assertTrue(streamed.is_streamed)
+        self.assertTrue(streamed.data.startswith(b"\x89PNG"))
+        self.assertEqual(post(scale=3).headers["X-Cache"], "HIT")
+
+        buffered = post(scale=4)
+        streamed = post(stream="1", scale=4)
+        with Image.open(BytesIO(streamed.data)) as streamed_image:
+            with Image.open(BytesIO(buffered.data)) as buffered_image:
+                self.assertEqual(streamed_image.size, (52, 52))
+                self.assertEqual(
+                    list(streamed_image.convert("RGB").getdata()),
+                    list(buffered_image.convert("RGB").getdata()),
+                )
+
+    def test_process_ladder(self):
+        """Test the ladder route returns every grid size as PNGs or indices."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            image_data = image_file.read()
+
+        def post(**fields):
+            return self.client.post(
+                "/ladder",
+                data={"image": (BytesIO(image_data), "test_image_1.jpg"), **fields},
+                content_type="multipart/form-data",
+            )
+
+        response = post(ladder="20,10,20", scale=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "application/zip")
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            self.assertEqual(archive.namelist(), ["10.png", "20.png"])
+            with Image.open(BytesIO(archive.read("20.png"))) as result_image:
+                self.assertEqual(result_image.size, (40, 40))
+
+        response = post(ladder="6,12", output="indices", grid="auto")
+        self.assertEqual(response.status_code, 200)
+        grids = response.json["grids"]
+        self.assertEqual([grid["pixel_dimensions"] for grid in grids], [6, 12])
+        self.assertEqual([grid["width"] for grid in grids], [6, 12])
+        self.assertEqual([len(grid["indices"]) for grid in grids], [4, 8])
+
+        # There are never more clusters than tiles in the reference grid
+        response = post(ladder="4,5", clusters=100, match="nearest")
+        self.assertEqual(response.status_code, 200)
+
+        for fields in (
+            {},
+            {"ladder": "10,x"},
+            {"ladder": "10", "grid": "4x4"},
+            {"ladder": "10,501"},
+        ):
+            self.assertEqual(post(**fields).status_code, 400)
+
+    def test_process_animation(self):
+        """Test the animate route tiles every frame of a GIF."""
+
+        with Image.open("test_image_1.jpg") as org_image:
+            frame = org_image.convert("RGB").resize((30, 20))
+        buffer = BytesIO()
+        frame.save(
+            buffer,
+            "GIF",
+            save_all=True,
+            append_images=[frame.rotate(180), frame],
+            duration=[30, 60, 90],
+        )
+        image_data = buffer.getvalue()
+
+        def post(**fields):
+            return self.client.post(
+                "/animate",
+                data={"image": (BytesIO(image_data), "animation.gif"), **fields},
+                content_type="multipart/form-data",
+            )
+
+        response = post(pixel_dimensions=5, scale=3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "image/gif")
+        with Image.open(BytesIO(response.data)) as animation:
+            self.assertEqual(animation.n_frames, 3)
+            self.assertEqual(animation.size, (15, 15))
+
+        response = post(pixel_dimensions=5, format="webp")
+        self.assertEqual(response.content_type, "image/webp")
+
+        response = post(pixel_dimensions=5, output="indices")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["durations"], [30, 60, 90])
+        self.assertEqual(len(response.json["frames"]), 3)
+        # The first and last frames are the same
+        self.assertEqual(
+            response.json["frames"][0]["indices"],
+            response.json["frames"][2]["indices"],
+        )
+
+        self.assertEqual(post(format="png").status_code, 400)
+        with mock.patch.object(server_app, "MAX_ANIMATION_FRAMES", 2):
+            self.assertEqual(post(pixel_dimensions=6).status_code, 400)
+
+    def test_uploaded_images(self):
+        """Test tiling an uploaded image by its id, then deleting it."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            image_data = image_file.read()
+
+        response = self.client.post(
+            "/images",
+            data={"image": (BytesIO(image_data), "test_image_1.jpg")},
+            content_type="multipart/form-data",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json["width"], 3648)
+        tile_url = response.json["tile_url"]
+
+        for tile_colors in ('["#FF0000", "#000000"]', '["#0000FF", "#FFFF00"]'):
+            response = self.client.post(
+                tile_url,
+                data={"tile_colors": tile_colors, "pixel_dimensions": 12, "scale": 2},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["X-Cache"], "MISS")
+            with Image.open(BytesIO(response.data)) as result_image:
+                self.assertEqual(result_image.size, (24, 24))
+
+        response = self.client.post(
+            tile_url, data={"pixel_dimensions": 12, "output": "indices"}
+        )
+        self.assertEqual(response.json["width"], 12)
+        self.assertEqual(
+            self.client.post(tile_url, data={"pixel_dimensions": 0}).status_code, 400
+        )
+        response = self.client.post(
+            tile_url, data={"pixel_dimensions": 50, "inventory": "[1, 1, 1, 1]"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.client.delete(tile_url[: -len("/tile")]).status_code, 204)
+        self.assertEqual(self.client.delete(tile_url[: -len("/tile")]).status_code, 404)
+        self.assertEqual(
+            self.client.post(tile_url, data={"pixel_dimensions": 13}).status_code, 404
+        )
+
+    def test_process_batch(self):
+        """Test the batch route with shared and per-image parameters."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            image_data = image_file.read()
+
+        response = self.client.post(
+            "/batch",
+            data={
+                "images": [
+                    (BytesIO(image_data), "first.jpg"),
+                    (BytesIO(b"not an image"), "broken.jpg"),
+                    (BytesIO(image_data), "third.jpg"),
+                ],
+                "pixel_dimensions": 10,
+                "scale": 1,
+                "params": json.dumps([{}, {}, {"output": "indices"}]),
+            },
+            content_type="multipart/form-data",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "application/zip")
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                ["000_first.png", "002_third.json", "errors.json"],
+            )
+            errors = json.loads(archive.read("errors.json"))
+            self.assertEqual([error["index"] for error in errors], [1])
+            self.assertEqual(json.loads(archive.read("002_third.json"))["width"], 10)
+
+    def test_process_batch_pool(self):
+        """Test a batch larger than the worker pool waits for free workers."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            image_data = image_file.read()
+
+        worker_pool = WorkerPool(workers=1, max_queue=1)
+        try:
+            with mock.patch("server.app.worker_pool", worker_pool):
+                response = self.client.post(
+                    "/batch",
+                    data={
+                        "images": [
+                            (BytesIO(image_data), f"{index}.jpg") for index in range(5)
+                        ],
+                        "pixel_dimensions": 6,
+                        "scale": 1,
+                    },
+                    content_type="multipart/form-data",
+                )
+                data = response.data
+        finally:
+            worker_pool.shutdown()
+
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            self.assertEqual(len(archive.namelist()), 6)
+            self.assertEqual(json.loads(archive.read("errors.json")), [])
+
+    def test_process_batch_invalid(self):
+        """Test the batch route rejects missing images and invalid parameters."""
+
+        response = self.client.post(
+            "/batch", data={}, content_type="multipart/form-data"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(
+            "/batch",
+            data={
+                "images": [(BytesIO(b""), "first.jpg")],
+                "params": json.dumps([{}, {}]),
+            },
+            content_type="multipart/form-data",
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_process_image_pool_full(self):
+        """Test the route applies backpressure when the worker pool is full."""
+
+        worker_pool = mock.Mock()
+        worker_pool.run.side_effect = PoolFullError("The worker pool queue is full")
+
+        with open("test_image_1.jpg", "rb") as image_file:
+            with mock.patch("server.app.worker_pool", worker_pool):
+                response = self.client.post(
+                    "/",
+                    data={
+                        "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                        "pixel_dimensions": 7,
+                    },
+                    content_type="multipart/form-data",
+                )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_jobs(self):
+        """Test submitting a job, polling its status and fetching its result."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+
+            response = self.client.post(
+                "/jobs",
+                data={
+                    "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                    "pixel_dimensions": 12,
+                    "output": "indices",
+                },
+                content_type="multipart/form-data",
+            )
+
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json["status_url"]
+        result_url = response.json["result_url"]
+        self.assertEqual(response.headers["Location"], status_url)
+
+        for _ in range(500):
+            status = self.client.get(status_url).json
+            if status["status"] in ("done", "failed"):
+                break
+            if status["status"] != "done":
+                self.assertEqual(self.client.get(result_url).status_code, 409)
+            time.sleep(0.02)
+
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(status["stage"], "done")
+
+        response = self.client.get(result_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, "application/json")
+        self.assertEqual(response.json["width"], 12)
+
+    def test_jobs_unknown(self):
+        """Test the job routes with an unknown job id."""
+        self.assertEqual(self.client.get("/jobs/unknown").status_code, 404)
+        self.assertEqual(self.client.get("/jobs/unknown/result").status_code, 404)
+
+    def test_health_and_readiness(self):
+        """Test the server only reports ready once it has warmed up."""
+        server_app.ready.clear()
+
+        self.assertEqual(self.client.get("/healthz").status_code, 200)
+        self.assertEqual(self.client.get("/readyz").status_code, 503)
+
+        server_app.start_warm_up().join()
+
+        self.assertEqual(self.client.get("/readyz").status_code, 200)
+        self.assertIn(
+            'pixelator_startup_seconds{phase="warm_up"}',
+            self.client.get("/metrics").get_data(as_text=True),
+        )
+
+    def test_metrics(self):
+        """Test the Server-Timing header and the metrics endpoint."""
+
+        with open("test_image_1.jpg", "rb") as image_file:
+
+            response = self.client.post(
+                "/",
+                data={
+                    "image": (BytesIO(image_file.read()), "test_image_1.jpg"),
+                    "pixel_dimensions": 11,
+                },
+                content_type="multipart/form-data",
+            )
+
+        server_timing = ", ".join(response.headers.getlist("Server-Timing"))
+        for stage in ("decode", "cluster", "encode", "total"):
+            self.assertIn(f"{stage};dur=", server_timing)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        for sample in (
+            'pixelator_stage_seconds_count{stage="cluster"}',
+            'pixelator_request_seconds_count{route="/"}',
+            "pixelator_input_megapixels_count",
+            "pixelator_grid_size_count",
+            "pixelator_palette_size_count",
+            'pixelator_cache_hits_total{cache="results"}',
+            'pixelator_queue_depth{queue="jobs"}',
+        ):
+            self.assertIn(sample, response.text)
+
+    def test_metrics_worker_cluster_cache(self):
+        """Test cluster cache counts returned by pooled jobs reach /metrics."""
+
+        def clusters(text: str, counter: str) -> int:
+            prefix = f'pixelator_cache_{counter}_total{{cache="clusters"}} '
+            (line,) = [line for line in text.splitlines() if line.startswith(prefix)]
+            return int(line[len(prefix) :])
+
+        before = self.client.get("/metrics").text
+        result = server_app.call_with_stages(server_app.cluster_cache.get, "unknown")
+        self.assertEqual(result[0], None)
+        self.assertEqual(result[2], (0, 1))
+
+        server_app.record_worker([], (2, 1))
+        after = self.client.get("/metrics").text
+        self.assertEqual(clusters(after, "hits"), clusters(before, "hits") + 2)
+        self.assertEqual(clusters(after, "misses"), clusters(before, "misses") + 2)
+
     def test_process_image_missing_optional_params(self):
         """Test the route when optional parameters are not provided."""
 
@@ -0,0 +1,160 @@
+# pylint: disable=missing-module-docstring
+import os
+import time
+import unittest
+
+import numpy as np
+
+from server.workers import PoolFullError, SharedBuffer, WorkerPool
+
+
+def _report_stages(stages: list, progress) -> int:
+    for stage in stages:
+        progress(stage)
+    return len(stages)
+
+
+def _first_rows(array: np.ndarray) -> np.ndarray:
+    return array[:4]
+
+
+class TestWorkerPool(unittest.TestCase):
+    """Tests for the WorkerPool class."""
+
+    def setUp(self):
+        self.pool = WorkerPool(workers=1, max_queue=0, timeout=30)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_run(self):
+        self.assertEqual(self.pool.run(pow, 2, 10), 1024)
+        self.assertNotEqual(self.pool.run(os.getpid), os.getpid())
+
+    def test_progress(self):
+        stages = []
+        result = self.pool.run(
+            _report_stages, ["decode", "cluster"], progress=stages.append
+        )
+
+        self.assertEqual(result, 2)
+        deadline = time.monotonic() + 10
+        while len(stages) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(stages, ["decode", "cluster"])
+
+    def test_full_queue(self):
+        future = self.pool.submit(time.sleep, 1)
+
+        with self.assertRaises(PoolFullError):
+            self.pool.submit(pow, 2, 10)
+
+        # Blocking submissions wait for the slot instead
+        self.assertEqual(self.pool.submit(pow, 2, 10, block=True).result(), 1024)
+        self.assertTrue(future.done())
+
+        # The slot is released once the job finishes
+        self.assertEqual(self.pool.run(pow, 2, 10), 1024)
+        self.assertEqual(self.pool.stats()["active"], 0)
+
+    def test_timeout_replaces_workers(self):
+        worker_pid = self.pool.run(os.getpid)
+
+        with self.assertRaises(TimeoutError):
+            self.pool.run(time.sleep, 30, timeout=0.5)
+
+        self.assertNotEqual(self.pool.run(os.getpid), worker_pid)
+
+    def test_timeout_spares_other_jobs(self):
+        pool = WorkerPool(workers=2, max_queue=2)
+        try:
+            pool.start()
+            healthy = pool.submit(time.sleep, 3)
+
+            start = time.perf_counter()
+            with self.assertRaises(TimeoutError):
+                pool.run(time.sleep, 30, timeout=0.5)
+
+            # The timeout returns at once, without waiting for a new worker
+            self.assertLess(time.perf_counter() - start, 2)
+
+            # The job running on the other worker is not affected
+            self.assertIsNone(healthy.result(timeout=30))
+            self.assertEqual(pool.run(pow, 2, 10, timeout=30), 1024)
+        finally:
+            pool.shutdown()
+
+    def test_shutdown_cancels_queued_jobs(self):
+        pool = WorkerPool(workers=1, max_queue=1)
+        pool.start()
+        running = pool.submit(time.sleep, 1)
+        queued = pool.submit(bytes, os.urandom(100_000))
+        deadline = time.monotonic() + 10
+        while not running.running() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        pool.shutdown()
+
+        self.assertIsNone(running.result(timeout=30))
+        self.assertTrue(queued.cancelled())
+        self.assertEqual(pool.stats()["active"], 0)
+
+    def test_shared_memory(self):
+        data = os.urandom(100_000)
+        array = np.arange(50_000, dtype=np.int32).reshape(200, 250)
+
+        # Large arguments are passed as views of shared memory
+        self.assertIs(self.pool.run(type, data), memoryview)
+        self.assertIs(self.pool.run(type, b"small"), bytes)
+
+        # Large results come back through shared memory too
+        self.assertEqual(self.pool.run(bytes, data), data)
+        np.testing.assert_array_equal(self.pool.run(np.negative, array), -array)
+
+        # Results that are views of shared arguments are copied out of them
+        np.testing.assert_array_equal(self.pool.run(np.asarray, array), array)
+        np.testing.assert_array_equal(self.pool.run(_first_rows, array), array[:4])
+        self.assertEqual(self.pool.run(np.asarray, data).tobytes(), data)
+
+        pool = WorkerPool(workers=1, shared_min_bytes=None)
+        try:
+            self.assertIs(pool.run(type, data), bytes)
+        finally:
+            pool.shutdown()
+
+
+class TestSharedBuffer(unittest.TestCase):
+    """Tests for the SharedBuffer class."""
+
+    def test_bytes(self):
+        buffer = SharedBuffer.share(b"shared")
+
+        with buffer.open() as view:
+            self.assertEqual(view.tobytes(), b"shared")
+            self.assertTrue(view.readonly)
+        self.assertEqual(buffer.take(), b"shared")
+
+        # The memory is freed once taken
+        with self.assertRaises(FileNotFoundError):
+            buffer.load()
+        buffer.unlink()
+
+    def test_array(self):
+        array = np.arange(12, dtype=np.uint8).reshape(3, 4)[:, ::2]
+        buffer = SharedBuffer.share(array)
+
+        try:
+            with buffer.open() as view:
+                np.testing.assert_array_equal(view, array)
+                self.assertFalse(view.flags.writeable)
+                del view
+            loaded = buffer.load()
+            np.testing.assert_array_equal(loaded, array)
+            self.assertEqual(loaded.dtype, np.uint8)
+        finally:
+            buffer.unlink()
+
+
+if __name__ == "__main__":
+    unittest.main()
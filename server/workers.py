@@ -0,0 +1,582 @@
+# pylint: disable=missing-module-docstring
+# pylint: disable=protected-access
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator
+
+import numpy as np
+
+from threadpoolctl import threadpool_limits
+
+
+class PoolFullError(Exception):
+    """Raised when a job is submitted to a WorkerPool whose queue is full."""
+
+
+def _init_worker(threads: int):
+    """Limit the BLAS/OpenMP threads of a worker process and warm up the pipeline."""
+    for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    threadpool_limits(limits=threads)
+
+    # Import the heavy dependencies and warm up, before the first job arrives
+    from server.pixelator import warm_up  # pylint: disable=import-outside-toplevel
+
+    warm_up()
+
+
+def _ready() -> int:
+    """A no-op job used to start the worker processes."""
+    return os.getpid()
+
+
+class SharedBuffer:
+    """A handle to bytes or an array in shared memory.
+
+    Only the handle is pickled, so passing it to a worker process does not copy
+    the data through a pipe. The shared memory lives until unlink() is called,
+    by whichever process consumes the buffer last.
+    """
+
+    def __init__(self, name: str, nbytes: int, dtype=None, shape=None):
+        """Create a handle to existing shared memory, see share().
+
+        Args:
+            name (str): The name of the shared memory block.
+            nbytes (int): The size of the data, which may be smaller than the
+            block.
+            dtype (optional): The dtype of an array. Defaults to None, bytes.
+            shape (tuple, optional): The shape of an array. Defaults to None.
+        """
+        self.name = name
+        self.nbytes = nbytes
+        self.dtype = dtype
+        self.shape = shape
+
+    @classmethod
+    def share(cls, value: bytes | np.ndarray) -> "SharedBuffer":
+        """Copy bytes or an array into a new shared memory block.
+
+        Args:
+            value (bytes | np.ndarray): The data to share.
+
+        Returns:
+            SharedBuffer: The handle to the data.
+        """
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            buffer = cls("", value.nbytes, value.dtype.str, value.shape)
+        else:
+            buffer = cls("", len(value))
+
+        memory = SharedMemory(create=True, size=max(buffer.nbytes, 1))
+        buffer.name = memory.name
+        view = memory.buf[: buffer.nbytes]
+        view[:] = memoryview(value).cast("B")
+        view.release()
+        memory.close()
+        return buffer
+
+    @contextmanager
+    def open(self) -> Iterator[memoryview | np.ndarray]:
+        """Map the shared memory without copying it.
+
+        Yields:
+            memoryview | np.ndarray: A read-only view of the bytes, or the
+            array. It must not be referenced after the block.
+        """
+        memory = SharedMemory(name=self.name)
+        try:
+            if self.dtype is None:
+                view = memory.buf[: self.nbytes]
+                readonly = view.toreadonly()
+                try:
+                    yield readonly
+                finally:
+                    readonly.release()
+                    view.release()
+            else:
+                array = np.ndarray(self.shape, self.dtype, buffer=memory.buf)
+                array.flags.writeable = False
+                yield array
+        finally:
+            memory.close()
+
+    def load(self) -> bytes | np.ndarray:
+        """Copy the data out of shared memory.
+
+        Returns:
+            bytes | np.ndarray: The bytes or the array.
+        """
+        memory = SharedMemory(name=self.name)
+        try:
+            if self.dtype is None:
+                return bytes(memory.buf[: self.nbytes])
+            return np.ndarray(self.shape, self.dtype, buffer=memory.buf).copy()
+        finally:
+            memory.close()
+
+    def unlink(self):
+        """Free the shared memory. The buffer cannot be opened afterwards."""
+        try:
+            memory = SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        memory.close()
+        memory.unlink()
+
+    def take(self) -> bytes | np.ndarray:
+        """Copy the data out of shared memory and free it, see load()."""
+        try:
+            return self.load()
+        finally:
+            self.unlink()
+
+
+def _share(value, min_bytes: int):
+    """Move bytes and arrays of at least min_bytes, including those in tuples and
+    lists, into shared memory."""
+    if isinstance(value, np.ndarray) and value.nbytes >= max(min_bytes, 1):
+        return SharedBuffer.share(value)
+    if isinstance(value, (bytes, bytearray)) and len(value) >= max(min_bytes, 1):
+        return SharedBuffer.share(value)
+    if isinstance(value, (tuple, list)):
+        return type(value)(_share(item, min_bytes) for item in value)
+    return value
+
+
+def _take(value):
+    """Undo _share, freeing the shared memory."""
+    if isinstance(value, SharedBuffer):
+        return value.take()
+    if isinstance(value, (tuple, list)):
+        return type(value)(_take(item) for item in value)
+    return value
+
+
+def _detach(value, views: list):
+    """Copy the arrays, including those in tuples and lists, that share memory
+    with the views of shared arguments, so they outlive the views."""
+    if isinstance(value, np.ndarray) and any(
+        isinstance(view, (memoryview, np.ndarray)) and np.shares_memory(value, view)
+        for view in views
+    ):
+        return value.copy()
+    if isinstance(value, (tuple, list)):
+        return type(value)(_detach(item, views) for item in value)
+    return value
+
+
+def _run_shared(fn, args: tuple, kwargs: dict, min_bytes: int):
+    """Run a job whose arguments and result are passed through shared memory.
+
+    The shared arguments are given to fn as views, without copying them, and
+    are freed by the submitting process. The shared parts of the result are
+    freed by the submitting process once it has read them. Results that are, or
+    are views of, shared arguments are copied before those are unmapped.
+    """
+    with ExitStack() as stack:
+        views = [
+            stack.enter_context(arg.open()) if isinstance(arg, SharedBuffer) else arg
+            for arg in args
+        ]
+        result = _detach(fn(*views, **kwargs), views)
+        # Drop the views, so the shared memory can be unmapped
+        del views
+    return _share(result, min_bytes)
+
+
+def _run_with_progress(progress_queue, job_id: int, fn, *args, **kwargs):
+    """Run a job, sending the stages it reports through its progress keyword
+    argument to the submitting process."""
+    return fn(
+        *args, progress=lambda stage: progress_queue.put((job_id, stage)), **kwargs
+    )
+
+
+class WorkerPool:
+    """A pool of worker processes with pinned thread limits and a bounded queue.
+
+    Every worker limits its BLAS/OpenMP thread pools (used by KMeans) to
+    threads_per_worker, so the pool can use every core without oversubscribing
+    them. At most max_queue jobs wait for a free worker; submitting more raises
+    PoolFullError, so callers can apply backpressure.
+
+    Every worker process is owned by a slot, a thread that takes jobs from the
+    queue and runs them on its process one at a time. A job that runs longer
+    than its timeout is abandoned and only the process running it is killed;
+    its slot starts a new process in the background, while the other workers
+    keep running their jobs. A pathological input therefore cannot stall or
+    fail the rest of the pool.
+
+    Positional bytes and array arguments, and bytes and arrays in results, of
+    at least shared_min_bytes are passed through shared memory instead of being
+    pickled through a pipe. The jobs receive such arguments as read-only
+    memoryviews or arrays, which are only valid while the job runs.
+
+    Jobs submitted with a progress callback report their stages through a
+    queue of a multiprocessing manager, started with the first such job, and
+    the callback is called with them in this process.
+
+    The processes are started by start(), or by the first submitted job.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        threads_per_worker=1,
+        max_queue=None,
+        timeout=None,
+        shared_min_bytes: int | None = 64 * 1024,
+    ):
+        """Create the pool.
+
+        Args:
+            workers (int, optional): Number of worker processes. Defaults to
+            None, which uses the number of CPUs.
+            threads_per_worker (int, optional): Maximum number of BLAS/OpenMP
+            threads in each worker. Defaults to 1.
+            max_queue (int, optional): Maximum number of jobs waiting for a
+            worker. Defaults to None, which allows two per worker.
+            timeout (float, optional): Default number of seconds a job may run
+            in run(). Defaults to None, which waits indefinitely.
+            shared_min_bytes (int, optional): Size from which arguments and
+            results are passed through shared memory. Defaults to 64 KiB. None
+            pickles everything.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.threads_per_worker = threads_per_worker
+        self.max_queue = self.workers * 2 if max_queue is None else max_queue
+        self.timeout = timeout
+        self.shared_min_bytes = shared_min_bytes
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self._active = 0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._ready = []
+        # The executor of every slot, and the future of the job it runs
+        self._executors = {}
+        self._running = {}
+        self._timed_out = set()
+        # The function freeing the queue slot of every unfinished job
+        self._releases = {}
+        # The manager and queue the jobs report progress through, and the
+        # progress callback of every unfinished job
+        self._manager = None
+        self._progress_queue = None
+        self._progress = {}
+        self._job_ids = itertools.count()
+
+    def _spawn(self) -> ProcessPoolExecutor:
+        """Start a worker process, and wait until it is warmed up."""
+        executor = ProcessPoolExecutor(
+            1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.threads_per_worker,),
+        )
+        executor.submit(_ready).result()
+        return executor
+
+    def start(self):
+        """Start the worker processes if they are not running, and wait until they are."""
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue()
+                self._ready = [threading.Event() for _ in range(self.workers)]
+                self._threads = [
+                    threading.Thread(
+                        target=self._serve,
+                        args=(slot, self._queue, self._ready[slot]),
+                        name=f"worker-{slot}",
+                        daemon=True,
+                    )
+                    for slot in range(self.workers)
+                ]
+                for thread in self._threads:
+                    thread.start()
+            ready = self._ready
+
+        for event in ready:
+            event.wait()
+
+    def _serve(self, slot: int, jobs: queue.Queue, ready: threading.Event):
+        """Run the jobs of the queue on the process of a slot, until shutdown."""
+        executor = self._spawn()
+        with self._lock:
+            self._executors[slot] = executor
+        ready.set()
+
+        while (job := jobs.get()) is not None:
+            fn, args, kwargs, future, release = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self._lock:
+                self._running[slot] = future
+            try:
+                result = executor.submit(fn, *args, **kwargs).result()
+            except BrokenProcessPool as e:
+                # The process was killed or crashed, so replace it
+                with self._lock:
+                    timed_out = future in self._timed_out
+                    self._timed_out.discard(future)
+                    del self._running[slot]
+                release()
+                if timed_out:
+                    future.set_exception(TimeoutError("The job did not finish in time"))
+                else:
+                    future.set_exception(e)
+                executor.shutdown(wait=False)
+                executor = self._spawn()
+                with self._lock:
+                    self._executors[slot] = executor
+                continue
+            except BaseException as e:
+                release()
+                future.set_exception(e)
+            else:
+                release()
+                try:
+                    future.set_result(_take(result))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._lock:
+                del self._running[slot]
+
+        executor.shutdown(wait=True)
+        with self._lock:
+            if self._executors.get(slot) is executor:
+                del self._executors[slot]
+
+    def _start_progress(self):
+        """Start the manager and the thread forwarding the progress of jobs."""
+        with self._lock:
+            if self._progress_queue is not None:
+                return self._progress_queue
+            self._manager = multiprocessing.get_context("spawn").Manager()
+            self._progress_queue = self._manager.Queue()
+            progress_queue = self._progress_queue
+
+        def forward():
+            while (item := progress_queue.get()) is not None:
+                job_id, stage = item
+                if stage is None:
+                    # The job is done
+                    self._progress.pop(job_id, None)
+                    continue
+                callback = self._progress.get(job_id)
+                if callback is not None:
+                    callback(stage)
+
+        threading.Thread(target=forward, name="worker-progress", daemon=True).start()
+        return progress_queue
+
+    def submit(self, fn, *args, progress=None, block=False, **kwargs) -> Future:
+        """Submit a job to the pool.
+
+        Args:
+            fn: The function to run. It and its arguments must be picklable.
+            *args: Positional arguments of fn.
+            progress (optional): Called in this process with the name of each
+            stage the job reports, through a progress callback fn is given as
+            a keyword argument. Defaults to None, which gives fn no callback.
+            block (bool, optional): Whether to wait for a free worker or queue
+            slot, for at most the timeout of the pool, rather than failing at
+            once. Defaults to False.
+            **kwargs: Keyword arguments of fn.
+
+        Returns:
+            Future: The future result of the job.
+
+        Raises:
+            PoolFullError: If every worker is busy and the queue is full.
+        """
+        if not self._slots.acquire(
+            blocking=block, timeout=self.timeout if block else None
+        ):
+            raise PoolFullError("The worker pool queue is full")
+
+        shared = []
+        progress_queue = None
+        job_id = next(self._job_ids)
+        try:
+            if progress is not None:
+                progress_queue = self._start_progress()
+                fn, args = _run_with_progress, (progress_queue, job_id, fn, *args)
+                self._progress[job_id] = progress
+
+            if self.shared_min_bytes is not None:
+                args = tuple(_share(arg, self.shared_min_bytes) for arg in args)
+                shared = [arg for arg in args if isinstance(arg, SharedBuffer)]
+                fn, args, kwargs = (
+                    _run_shared,
+                    (fn, args, kwargs, self.shared_min_bytes),
+                    {},
+                )
+
+            self.start()
+        except BaseException:
+            for buffer in shared:
+                buffer.unlink()
+            self._progress.pop(job_id, None)
+            self._slots.release()
+            raise
+
+        future = Future()
+        released = threading.Event()
+
+        def release():
+            # Free the slot and the shared arguments once, as soon as the job
+            # is done or abandoned, before its result is set
+            with self._lock:
+                if released.is_set():
+                    return
+                released.set()
+                self._active -= 1
+            if progress_queue is not None:
+                # The stages the job reported are already queued, so the
+                # forwarding thread drops the callback after passing them on
+                try:
+                    progress_queue.put((job_id, None))
+                except (OSError, EOFError):
+                    self._progress.pop(job_id, None)
+            for buffer in shared:
+                buffer.unlink()
+            self._slots.release()
+
+        future.add_done_callback(lambda future: future.cancelled() and release())
+        self._releases[future] = release
+        future.add_done_callback(lambda future: self._releases.pop(future, None))
+        with self._lock:
+            self._active += 1
+            self._queue.put((fn, args, kwargs, future, release))
+        return future
+
+    def run(self, fn, *args, timeout=None, **kwargs):
+        """Run a job in the pool and wait for its result.
+
+        Args:
+            fn: The function to run. It and its arguments must be picklable.
+            *args: Positional arguments of fn.
+            timeout (float, optional): Number of seconds to wait for the result.
+            Defaults to None, which uses the timeout of the pool.
+            **kwargs: Keyword arguments of fn.
+
+        Returns:
+            The result of the job.
+
+        Keyword arguments, including progress, are passed on to submit().
+
+        Raises:
+            PoolFullError: If every worker is busy and the queue is full.
+            TimeoutError: If the job did not finish in time. It is cancelled if
+            it is still queued, and otherwise the process running it is killed
+            and replaced in the background. Other jobs are not affected.
+        """
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError as exc:
+            self.kill(future)
+            raise TimeoutError("The job did not finish in time") from exc
+
+    def kill(self, future: Future):
+        """Abandon a job, failing it with TimeoutError.
+
+        A queued job is cancelled. A running job's worker process is killed,
+        and its slot starts a new one in the background.
+
+        Args:
+            future (Future): The future returned by submit().
+        """
+        if future.cancel():
+            return
+
+        with self._lock:
+            executors = [
+                self._executors[slot]
+                for slot, running in self._running.items()
+                if running is future
+            ]
+            if executors:
+                self._timed_out.add(future)
+            release = self._releases.get(future)
+
+        # The abandoned job no longer takes a place in the queue
+        if release is not None:
+            release()
+        for executor in executors:
+            _terminate(executor)
+
+    def restart(self):
+        """Kill every worker process. Each slot starts a new one in the background.
+
+        Running jobs fail with BrokenProcessPool; queued jobs run on the new
+        processes.
+        """
+        with self._lock:
+            executors = list(self._executors.values())
+
+        for executor in executors:
+            _terminate(executor)
+
+    def shutdown(self):
+        """Stop the worker processes after their current jobs finish.
+
+        Queued jobs are cancelled.
+        """
+        with self._lock:
+            jobs, self._queue = self._queue, None
+            threads, self._threads = self._threads, []
+            manager, self._manager = self._manager, None
+            progress_queue, self._progress_queue = self._progress_queue, None
+
+        if progress_queue is not None:
+            progress_queue.put(None)
+            manager.shutdown()
+        if jobs is None:
+            return
+
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                # Cancelling releases the slot and the shared arguments
+                _, _, _, future, _ = job
+                future.cancel()
+        for _ in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+
+    def stats(self) -> dict:
+        """Get the size and load of the pool.
+
+        Returns:
+            dict: The number of workers, the number of jobs submitted and not
+            yet finished, and the maximum number of queued jobs.
+        """
+        return {
+            "workers": self.workers,
+            "active": self._active,
+            "max_queue": self.max_queue,
+        }
+
+
+def _terminate(executor: ProcessPoolExecutor):
+    """Kill the worker processes of an executor, breaking it."""
+    for process in list((executor._processes or {}).values()):
+        process.terminate()